@@ -0,0 +1,537 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import time
+from threading import Thread, Lock
+
+from peer import Peer, FORMATOS_SUPORTADOS, POLITICAS_LENTOS, codificar_membros, configurar_log, decodificar_membros, log
+
+# Marca as mensagens de chat geradas pelo benchmark: "#bench <seq> <instante do envio>"
+MARCADOR = "#bench"
+
+# =======================================================================
+# Peer que, em vez de exibir as mensagens de chat, mede quantas chegaram
+# e quanto tempo levaram desde o envio (os peers rodam na mesma máquina,
+# então o relógio do remetente e do destinatário é o mesmo)
+# =======================================================================
+class PeerMedido(Peer):
+    def __init__(self, *args, **opcoes):
+        super().__init__(*args, **opcoes)
+        self.latencias = []  # segundos entre o envio e a entrega de cada mensagem
+        self.ultima_entrega = None  # momento (time.time()) da última mensagem entregue
+        self.primeira_entrega = None  # momento (time.time()) da primeira mensagem entregue
+        self.lock_medidas = Lock()
+
+    def tratar_texto(self, corpo, conn):
+        partes = corpo.split()
+        if MARCADOR not in partes or corpo.startswith("Você"):
+            return
+        enviado = float(partes[partes.index(MARCADOR) + 2])
+        agora = time.time()
+        with self.lock_medidas:
+            self.latencias.append(agora - enviado)
+            self.ultima_entrega = agora
+            if self.primeira_entrega is None:
+                self.primeira_entrega = agora
+
+# A recepção em vários processos (--processos-recepcao) só vale para o coordenador
+# (peer 0), que é o peer que recebe de todos os outros
+def opcoes_do_peer(opcoes, indice):
+    if indice == 0:
+        return opcoes
+    return {chave: valor for chave, valor in opcoes.items() if chave != "processos_recepcao"}
+
+# =======================================================================
+# Grupo de peers executados no mesmo processo. O peer de índice 0 é
+# sempre o coordenador da sala
+# =======================================================================
+class Grupo:
+    def __init__(self, indices, porta_base, opcoes):
+        self.peers = [PeerMedido(f"peer{i}", "localhost", porta_base + i, **opcoes_do_peer(opcoes, i)) for i in indices]
+        self.indices = list(indices)
+        self.porta_base = porta_base
+
+    def iniciar(self):
+        coordenador = ("localhost", self.porta_base)
+        for i, p in zip(self.indices, self.peers):
+            p.iniciar_sem_terminal(None if i == 0 else coordenador)
+        return True
+
+    def tamanhos(self):
+        return [len(p.membros) for p in self.peers if p.ativo]
+
+    # Cada peer do grupo que estiver em remetentes envia quantidade mensagens,
+    # no máximo taxa mensagens por segundo (0 = sem limite), com carga bytes a mais
+    def enviar(self, remetentes, quantidade, taxa, carga=0):
+        enchimento = " " + "x" * carga if carga else ""
+
+        def enviar_de(p):
+            inicio = time.time()
+            for seq in range(quantidade):
+                if taxa:
+                    atraso = inicio + seq / taxa - time.time()
+                    if atraso > 0:
+                        time.sleep(atraso)
+                p.enviar_mensagem(f"{MARCADOR} {seq} {time.time():.6f}{enchimento}")
+
+        threads = [Thread(target=enviar_de, args=(p,)) for i, p in zip(self.indices, self.peers) if i in remetentes]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return True
+
+    def coletar(self):
+        latencias = []
+        ultima = None
+        for p in self.peers:
+            with p.lock_medidas:
+                latencias.extend(p.latencias)
+                if p.ultima_entrega is not None:
+                    ultima = max(ultima or 0, p.ultima_entrega)
+        return {"latencias": latencias, "ultima_entrega": ultima}
+
+    def parar(self):
+        for p in self.peers:
+            p.parar()
+        return True
+
+# ============================================================
+# Executa um grupo em outro processo, atendendo os comandos
+# ("iniciar", "enviar", ...) recebidos pela conexão
+# ============================================================
+def executar_grupo(conexao, indices, porta_base, opcoes, nivel_log):
+    sys.stdout = open(os.devnull, "w")
+    configurar_log(nivel_log)
+    grupo = Grupo(indices, porta_base, opcoes)
+    while True:
+        metodo, args = conexao.recv()
+        conexao.send(getattr(grupo, metodo)(*args))
+        if metodo == "parar":
+            return
+
+# Representa, no processo principal, um grupo que roda em outro processo
+class GrupoRemoto:
+    def __init__(self, indices, porta_base, opcoes):
+        self.conexao, outra_ponta = multiprocessing.Pipe()
+        self.processo = multiprocessing.Process(
+            target=executar_grupo, args=(outra_ponta, indices, porta_base, opcoes, log.level), daemon=True
+        )
+        self.processo.start()
+
+    def chamar(self, metodo, *args):
+        self.conexao.send((metodo, args))
+        return self.conexao.recv()
+
+    def __getattr__(self, metodo):
+        return lambda *args: self.chamar(metodo, *args)
+
+# Chama o mesmo método em todos os grupos ao mesmo tempo e devolve os resultados
+def em_todos(grupos, metodo, *args):
+    resultados = [None] * len(grupos)
+
+    def chamar(i, grupo):
+        resultados[i] = getattr(grupo, metodo)(*args)
+
+    threads = [Thread(target=chamar, args=(i, g)) for i, g in enumerate(grupos)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return resultados
+
+# ============================================================
+# Monta uma sala com tamanho peers divididos em processos
+# processos (o primeiro grupo, com o coordenador, roda no
+# processo principal) e espera todos conhecerem a sala inteira
+# ============================================================
+def montar_sala(tamanho, processos, porta_base, opcoes, timeout=30):
+    divisao = [list(range(tamanho))[i::processos] for i in range(processos)]
+    grupos = [Grupo(divisao[0], porta_base, opcoes)]
+    grupos += [GrupoRemoto(indices, porta_base, opcoes) for indices in divisao[1:] if indices]
+
+    grupos[0].iniciar()  # cria a sala antes de os outros grupos entrarem
+    em_todos(grupos[1:], "iniciar")
+
+    limite = time.time() + timeout
+    while time.time() < limite:
+        if all(t == tamanho for ts in em_todos(grupos, "tamanhos") for t in ts):
+            return grupos
+        time.sleep(0.05)
+    raise RuntimeError(f"a sala de {tamanho} peers não convergiu em {timeout} s")
+
+def percentis(valores):
+    if not valores:
+        return {}
+    valores = sorted(valores)
+
+    def p(q):
+        return valores[min(len(valores) - 1, math.ceil(q / 100 * len(valores)) - 1)] * 1000
+
+    return {
+        "p50_ms": p(50),
+        "p90_ms": p(90),
+        "p99_ms": p(99),
+        "max_ms": valores[-1] * 1000,
+        "media_ms": sum(valores) / len(valores) * 1000,
+    }
+
+# ===============================================================================
+# Vazão e latência: remetentes peers enviam mensagens cada um e o benchmark espera
+# todas chegarem a todos os outros peers da sala
+# ===============================================================================
+def cenario_vazao(args, porta_base, opcoes):
+    grupos = montar_sala(args.peers, args.processos, porta_base, opcoes)
+    try:
+        remetentes = list(range(1, min(args.remetentes, args.peers - 1) + 1))
+        esperadas = len(remetentes) * args.mensagens * (args.peers - 1)
+
+        inicio = time.time()
+        em_todos(grupos, "enviar", remetentes, args.mensagens, args.taxa, args.carga)
+        fim_envio = time.time()
+
+        limite = fim_envio + args.timeout
+        while True:
+            coletas = em_todos(grupos, "coletar")
+            latencias = [x for c in coletas for x in c["latencias"]]
+            if len(latencias) >= esperadas or time.time() > limite:
+                break
+            time.sleep(0.05)
+        ultima = max((c["ultima_entrega"] for c in coletas if c["ultima_entrega"]), default=fim_envio)
+        duracao = max(ultima - inicio, 1e-9)
+
+        return {
+            "peers": args.peers,
+            "processos": args.processos,
+            "remetentes": len(remetentes),
+            "mensagens_por_remetente": args.mensagens,
+            "entregas_esperadas": esperadas,
+            "entregas": len(latencias),
+            "perdidas": esperadas - len(latencias),
+            "duracao_s": duracao,
+            "envios_por_s": len(remetentes) * args.mensagens / max(fim_envio - inicio, 1e-9),
+            "entregas_por_s": len(latencias) / duracao,
+            "latencia": percentis(latencias),
+        }
+    finally:
+        em_todos(grupos, "parar")
+
+# ===============================================================================
+# Tempo de entrada em função do tamanho da sala: a sala cresce um peer por vez e,
+# a cada entrada, mede o tempo do JOIN e o tempo até todos conhecerem o novo peer
+# ===============================================================================
+def cenario_entrada(args, porta_base, opcoes):
+    peers = [PeerMedido("peer0", "localhost", porta_base, **opcoes)]
+    peers[0].iniciar_sem_terminal()
+    coordenador = ("localhost", porta_base)
+    resultados = []
+    try:
+        for tamanho in range(2, args.peers + 1):
+            p = PeerMedido(f"peer{tamanho - 1}", "localhost", porta_base + tamanho - 1, **opcoes_do_peer(opcoes, tamanho - 1))
+            Thread(target=p.inicia_servidor, daemon=True).start()
+            p.pronto.wait(5)
+            peers.append(p)
+
+            bytes_antes = peers[0].metricas.instantaneo()["contadores"].get("bytes_enviados", 0)
+            inicio = time.time()
+            p.iniciar_rede(coordenador)
+            entrada = time.time() - inicio
+            limite = inicio + args.timeout
+            while any(len(q.membros) < tamanho for q in peers) and time.time() < limite:
+                time.sleep(0.001)
+            convergencia = time.time() - inicio
+            time.sleep(0.01)  # a fila de saída do coordenador termina de enviar o DELTA (ou UPDATE e MAP_UPDATE)
+
+            if tamanho in args.tamanhos or tamanho == args.peers:
+                resultados.append({
+                    "tamanho": tamanho,
+                    "entrada_ms": entrada * 1000,
+                    "convergencia_ms": convergencia * 1000,
+                    "bytes_enviados_coordenador": peers[0].metricas.instantaneo()["contadores"].get("bytes_enviados", 0) - bytes_antes,
+                })
+        return resultados
+    finally:
+        for p in peers:
+            p.parar()
+
+# ===============================================================================
+# Failover: derruba o coordenador (sem aviso) e mede o tempo até a queda ser
+# detectada e até todos os peers restantes concordarem com o novo coordenador
+# ===============================================================================
+def cenario_failover(args, porta_base, opcoes):
+    grupo = montar_sala(args.peers, 1, porta_base, opcoes)[0]
+    peers = grupo.peers
+    try:
+        inicio = time.time()
+        peers[0].parar()
+        restantes = peers[1:]
+
+        deteccao = None
+        limite = inicio + args.timeout
+        while time.time() < limite:
+            if deteccao is None and any(p.inicio_eleicao for p in restantes):
+                deteccao = min(p.inicio_eleicao for p in restantes if p.inicio_eleicao) - inicio
+            atuais = {p.coordenador_atual for p in restantes}
+            if len(atuais) == 1:
+                novo = atuais.pop()
+                if novo != peers[0].endereco and any(p.coordenador and p.endereco == novo for p in restantes):
+                    break
+            time.sleep(0.005)
+        else:
+            return {"peers": args.peers, "concluido": False}
+
+        return {
+            "peers": args.peers,
+            "concluido": True,
+            "intervalo_heartbeat_s": args.heartbeat,
+            "deteccao_ms": deteccao * 1000 if deteccao is not None else None,
+            "failover_ms": (time.time() - inicio) * 1000,
+            "eleicao_max_ms": max((p.duracao_eleicao or 0) for p in restantes) * 1000,
+            "limite_eleicao_ms": restantes[0].tempo_max_eleicao() * 1000,
+        }
+    finally:
+        grupo.parar()
+
+# ===============================================================================
+# Tempestade de entradas: peers - 1 peers entram ao mesmo tempo na sala do
+# coordenador, que envia uma mensagem de chat a cada 5 ms. Para cada um, mede o
+# tempo desde a criação do peer até a resposta do JOIN e até a primeira mensagem
+# de chat recebida, como quando muitos peers reiniciam juntos. Todos usam a porta
+# 0 (escolhida pelo sistema) e rodam no mesmo processo, então com muitos peers o
+# resultado inclui a disputa pela CPU
+# ===============================================================================
+def cenario_tempestade(args, porta_base, opcoes):
+    # A recepção em vários processos precisa de uma porta fixa
+    coordenador = PeerMedido("peer0", "localhost", porta_base if opcoes.get("processos_recepcao") else 0, **opcoes)
+    coordenador.iniciar_sem_terminal()
+    ativo = True
+
+    def conversar():
+        seq = 0
+        while ativo:
+            coordenador.enviar_mensagem(f"{MARCADOR} {seq} {time.time():.6f}")
+            seq += 1
+            time.sleep(0.005)
+
+    Thread(target=conversar, daemon=True).start()
+    medidas = {}  # mapeia índice -> (peer, início, fim do JOIN)
+    lock = Lock()
+
+    def entrar(i):
+        inicio = time.time()
+        p = PeerMedido(f"peer{i}", "localhost", 0, **opcoes_do_peer(opcoes, i))
+        entrou = p.iniciar_sem_terminal(coordenador.endereco)
+        with lock:
+            medidas[i] = (p, inicio, time.time() if entrou else None)
+
+    threads = [Thread(target=entrar, args=(i,)) for i in range(1, args.peers)]
+    try:
+        inicio = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        limite = time.time() + args.timeout
+        while time.time() < limite and any(p.primeira_entrega is None for p, _, _ in medidas.values()):
+            time.sleep(0.01)
+        ativo = False
+
+        entradas = [fim - comeco for _, comeco, fim in medidas.values() if fim is not None]
+        primeiras = [p.primeira_entrega - comeco for p, comeco, _ in medidas.values() if p.primeira_entrega is not None]
+        return {
+            "peers": args.peers,
+            "entraram": len(entradas),
+            "receberam": len(primeiras),
+            "membros_coordenador": len(coordenador.membros),
+            "duracao_s": time.time() - inicio,
+            "entrada": percentis(entradas),
+            "primeira_mensagem": percentis(primeiras),
+        }
+    finally:
+        ativo = False
+        coordenador.parar()
+        for p, _, _ in medidas.values():
+            p.parar()
+
+# ===============================================================================
+# Consumidor lento: um membro a mais da sala aceita as conexões e nunca lê (como
+# um peer travado). Os remetentes enviam como no cenário de vazão e o benchmark
+# mede a latência até os outros peers, o tempo que os remetentes levaram para
+# enviar (só a política "esperar" os segura) e o que aconteceu com a fila do
+# membro travado. Precisa de --pool para haver uma conexão que encha
+# ===============================================================================
+def cenario_lento(args, porta_base, opcoes):
+    grupo = montar_sala(args.peers, 1, porta_base, opcoes)[0]
+    travado = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    travado.bind(("localhost", porta_base + args.peers))
+    travado.listen(args.peers)
+    aceitas = []
+
+    def aceitar():
+        while True:
+            try:
+                aceitas.append(travado.accept()[0])
+            except OSError:
+                return
+
+    Thread(target=aceitar, daemon=True).start()
+    try:
+        remetentes = list(range(1, min(args.remetentes, args.peers - 1) + 1))
+        # Só os remetentes conhecem o membro travado (a sala não fica sabendo dele)
+        for i in remetentes:
+            grupo.peers[i].membros.adicionar("localhost", porta_base + args.peers, 10 ** 6, "travado")
+        esperadas = len(remetentes) * args.mensagens * (args.peers - 1)
+
+        inicio = time.time()
+        grupo.enviar(remetentes, args.mensagens, args.taxa, args.carga)
+        fim_envio = time.time()
+
+        limite = fim_envio + args.timeout
+        while True:
+            latencias = grupo.coletar()["latencias"]
+            if len(latencias) >= esperadas or time.time() > limite:
+                break
+            time.sleep(0.05)
+
+        return {
+            "peers": args.peers,
+            "politica": args.politica_lenta,
+            "remetentes": len(remetentes),
+            "mensagens_por_remetente": args.mensagens,
+            "entregas_esperadas": esperadas,
+            "perdidas": esperadas - len(latencias),
+            "envio_s": fim_envio - inicio,
+            "latencia": percentis(latencias),
+            "fila_travado": [grupo.peers[i].metricas_envio().get(f"localhost:{porta_base + args.peers}") for i in remetentes],
+        }
+    finally:
+        travado.close()
+        for conexao in aceitas:
+            conexao.close()
+        grupo.parar()
+
+# ===============================================================================
+# Codificação dos corpos de membros: para uma tabela de cada tamanho, o tamanho do
+# MAP_UPDATE e do UPDATE e o custo médio de codificar e decodificar em cada formato
+# (JSON, compacto, JSON com zlib e compacto com zlib). Não abre conexões
+# ===============================================================================
+def cenario_codificacao(args, porta_base, opcoes):
+    combinacoes = {"json": (), "compacto": ("compacto",), "json+zlib": ("zlib",), "compacto+zlib": FORMATOS_SUPORTADOS}
+    resultados = []
+    for tamanho in args.tamanhos:
+        linhas = [["localhost", porta_base + i, i, f"peer{i}"] for i in range(tamanho)]
+        corpos = {
+            "MAP_UPDATE": {"membros": linhas, "versao": [int(time.time() * 1000), tamanho]},
+            "UPDATE": {"enderecos": [linha[:2] for linha in linhas]},
+        }
+        for nome, dados in corpos.items():
+            for formato, formatos in combinacoes.items():
+                repeticoes = max(10, 20000 // tamanho)
+                inicio = time.perf_counter()
+                for _ in range(repeticoes):
+                    corpo = codificar_membros(dados, formatos)
+                codificacao = (time.perf_counter() - inicio) / repeticoes
+                inicio = time.perf_counter()
+                for _ in range(repeticoes):
+                    decodificar_membros(corpo)
+                decodificacao = (time.perf_counter() - inicio) / repeticoes
+                resultados.append({
+                    "tamanho": tamanho,
+                    "corpo": nome,
+                    "formato": formato,
+                    "bytes": len(corpo),
+                    "codificacao_us": codificacao * 1e6,
+                    "decodificacao_us": decodificacao * 1e6,
+                })
+    return resultados
+
+CENARIOS = {
+    "vazao": cenario_vazao,
+    "entrada": cenario_entrada,
+    "failover": cenario_failover,
+    "codificacao": cenario_codificacao,
+    "lento": cenario_lento,
+    "tempestade": cenario_tempestade,
+}
+
+def lista_inteiros(texto):
+    return [int(x) for x in texto.split(",") if x]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark do protocolo do chat (peer.py), com resultado em JSON.")
+    parser.add_argument("--cenarios", default="vazao,entrada,failover",
+                        help="cenários separados por vírgula: " + ", ".join(CENARIOS))
+    parser.add_argument("--peers", type=int, default=8, help="tamanho da sala")
+    parser.add_argument("--processos", type=int, default=1, help="processos entre os quais os peers são divididos (vazão)")
+    parser.add_argument("--remetentes", type=int, default=2, help="peers que enviam mensagens (vazão)")
+    parser.add_argument("--mensagens", type=int, default=500, help="mensagens por remetente (vazão)")
+    parser.add_argument("--taxa", type=float, default=0, help="mensagens por segundo por remetente; 0 = sem limite")
+    parser.add_argument("--carga", type=int, default=0, help="bytes a mais em cada mensagem (vazão, lento)")
+    parser.add_argument("--tamanhos", type=lista_inteiros, default=[2, 4, 8, 16, 32, 64],
+                        help="tamanhos de sala registrados no cenário de entrada")
+    parser.add_argument("--repeticoes", type=int, default=1, help="repetições de cada cenário")
+    parser.add_argument("--heartbeat", type=float, default=1.0, help="intervalo de heartbeat (s)")
+    parser.add_argument("--disseminacao", default="direta", choices=["direta", "arvore", "gossip", "ordenada"])
+    parser.add_argument("--fanout", type=int, default=3)
+    parser.add_argument("--pool", action="store_true", help="usa conexões persistentes (PoolConexoes)")
+    parser.add_argument("--formatos", default=",".join(FORMATOS_SUPORTADOS),
+                        help="formatos dos corpos de membros aceitos pelos peers (compacto, zlib); vazio = só JSON")
+    parser.add_argument("--processos-recepcao", type=int, default=0,
+                        help="processos que leem as conexões do coordenador (recepcao.py); 0 = nenhum")
+    parser.add_argument("--politica-lenta", default="descartar_antigas", choices=list(POLITICAS_LENTOS),
+                        help="o que fazer com um destino que não dá conta das mensagens (ver EnviadorLotes)")
+    parser.add_argument("--porta-base", type=int, default=20000)
+    parser.add_argument("--timeout", type=float, default=60, help="tempo máximo (s) de espera em cada cenário")
+    parser.add_argument("--log", default="WARNING", help="nível do log dos peers (INFO mostra as mensagens do sistema)")
+    parser.add_argument("--saida", help="arquivo onde salvar o JSON (padrão: saída padrão)")
+    args = parser.parse_args()
+    configurar_log(args.log)
+
+    opcoes = {
+        "usar_pool": args.pool,
+        "intervalo_heartbeat": args.heartbeat,
+        "disseminacao": args.disseminacao,
+        "fanout": args.fanout,
+        "processos_recepcao": args.processos_recepcao,
+        "formatos": tuple(f for f in args.formatos.split(",") if f),
+        "politica_lenta": args.politica_lenta,
+    }
+    resultado = {
+        "benchmark": "peer",
+        "versao": 1,
+        "inicio": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "ambiente": {
+            "python": platform.python_version(),
+            "plataforma": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "parametros": vars(args),
+        "resultados": {},
+    }
+
+    # Os peers imprimem mensagens do sistema (inclusive threads de peers já parados, até
+    # o fim do processo); só o JSON deve ir para a saída padrão
+    saida_padrao = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    porta = args.porta_base
+    for nome in args.cenarios.split(","):
+        rodadas = []
+        for _ in range(args.repeticoes):
+            rodadas.append(CENARIOS[nome](args, porta, opcoes))
+            porta += args.peers + 1  # portas novas a cada rodada
+        resultado["resultados"][nome] = rodadas
+
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as arquivo:
+            arquivo.write(texto + "\n")
+    else:
+        print(texto, file=saida_padrao)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,446 @@
+import json
+import sys
+import time
+from collections import deque
+from threading import Thread, Lock, Condition
+
+from peer import (
+    Peer,
+    codificar_quadro,
+    requisitar,
+    TIPO_BLOCO_IDS,
+    TIPO_CHAT,
+    TIPO_RAIZ,
+    TIPO_RESUMO_SHARD,
+    TIPO_SHARD_PEDIDO,
+)
+from salas import PeerSala, ServidorSalas
+
+# ==========================================================================================
+# Modo hierárquico: em vez de um único coordenador para todos os membros, os membros são
+# divididos em shards de até tamanho_shard peers. Cada shard é uma sala (ver salas.py) com
+# o próprio coordenador (o subcoordenador), que recebe os JOINs, os heartbeats e as
+# alterações de membros só daquele shard. Os subcoordenadores são membros de uma segunda
+# sala, "topo", cujo coordenador é a raiz: ela conhece apenas os subcoordenadores e um
+# resumo de cada shard, escolhe o shard de quem entra e reserva blocos de IDs para os
+# subcoordenadores, que atribuem os IDs sem consultar a raiz a cada JOIN. Como shard e
+# topo são salas independentes, a eleição de um shard e a do topo também são
+# =========================================================================================
+TOPO = "topo"  # sala dos subcoordenadores; o coordenador dela é a raiz
+TAMANHO_BLOCO = 1024  # IDs por bloco: o bloco k tem os IDs de k * TAMANHO_BLOCO a (k + 1) * TAMANHO_BLOCO - 1
+
+# ============================================================
+# Membro de um shard. Se for o subcoordenador, também repassa
+# as mensagens do shard para o topo (ver NoHierarquico.subir)
+# ============================================================
+class PeerShard(PeerSala):
+    def __init__(self, servidor, sala, nome, no=None, **opcoes):
+        super().__init__(servidor, sala, nome, **opcoes)
+        self.no = no
+        self.tratadores[TIPO_RAIZ] = self.tratar_raiz
+
+    # Os IDs vêm dos blocos reservados pela raiz, então são únicos em todos os shards.
+    # Conseguir um bloco pode exigir a rede (preparar_ids, fora da trava da tabela);
+    # gerar_id, chamado sob a trava, só tira o próximo ID
+    def preparar_ids(self):
+        self.no.garantir_bloco()
+
+    def gerar_id(self):
+        return self.no.gerar_id()
+
+    def criar_rede(self):
+        self.preparar_ids()
+        super().criar_rede()
+
+    # Quem vence a eleição do shard entra no topo antes de se anunciar. Se outro peer se
+    # anunciou nesse meio-tempo, ele fica com o shard e este sai do topo
+    def assumir_coordenacao(self):
+        self.no.entrar_topo()
+        try:
+            self.preparar_ids()  # para os IDs recalculados depois da eleição
+        except RuntimeError as e:
+            self.log.error(f"[ERRO] {e}")
+        if not super().assumir_coordenacao():
+            if self.no.topo is not None:
+                Thread(target=self.no.sair_topo, daemon=True).start()
+            return False
+        self.no.anunciar_raiz()
+        return True
+
+    def tratar_novo_coordenador(self, corpo, conn=None):
+        super().tratar_novo_coordenador(corpo, conn)
+        if self.no.topo is not None:
+            # Outro peer ficou com o shard: este deixa de representá-lo no topo
+            Thread(target=self.no.sair_topo, daemon=True).start()
+
+    def tratar_join(self, corpo, conn):
+        super().tratar_join(corpo, conn)
+        ip, porta = corpo.split()[:2]
+        self.no.anunciar_raiz((ip, int(porta)))
+
+    def tratar_raiz(self, corpo, conn):
+        dados = json.loads(corpo)
+        self.no.raiz = tuple(dados["raiz"])
+        self.no.conhecidos_topo = [tuple(e) for e in dados["topo"]]
+
+    def tratar_chat(self, corpo, conn):
+        dados = json.loads(corpo)
+        nova = dados["id"] not in self.mensagens_vistas
+        super().tratar_chat(corpo, conn)
+        if nova and self.coordenador:
+            self.no.subir(dados)
+
+    def repassar_chat(self, dados, origem=None):
+        super().repassar_chat(dados, origem)
+        if origem is None and self.coordenador:
+            self.no.subir(dados)  # mensagem do próprio subcoordenador
+
+    def tratar_texto(self, corpo, conn):
+        Peer.tratar_texto(self, corpo, conn)  # sem o prefixo da sala: o shard é transparente para o usuário
+
+# ======================================================================================
+# Membro do topo (um subcoordenador). O coordenador do topo é a raiz: guarda o resumo
+# de cada shard, escolhe o shard de quem entra e reserva os blocos de IDs. Depois de
+# uma eleição no topo, a nova raiz pergunta aos subcoordenadores o maior bloco que
+# conhecem e só volta a reservar blocos depois de espera_blocos segundos
+# ======================================================================================
+class PeerTopo(PeerSala):
+    def __init__(self, servidor, sala, nome, no=None, **opcoes):
+        super().__init__(servidor, sala, nome, **opcoes)
+        self.no = no
+        self.lock_resumos = Lock()
+        self.resumos = {}  # só na raiz: mapeia (ip, porta) do subcoordenador -> resumo do shard
+        self.proximo_bloco = 0  # só na raiz: próximo bloco de IDs a reservar
+        self.blocos_liberados = 0.0  # momento (time.time()) a partir do qual a raiz reserva blocos
+        self.espera_blocos = 1.0
+        self.proximo_resumo = 0.0
+        self.topo_anunciado = None  # resumo dos membros do topo na última vez que o shard foi avisado
+        self.tratadores[TIPO_RESUMO_SHARD] = self.tratar_resumo
+        self.tratadores[TIPO_BLOCO_IDS] = self.tratar_bloco_ids
+
+    def assumir_coordenacao(self):
+        if not super().assumir_coordenacao():
+            return False
+        with self.lock_resumos:
+            self.proximo_bloco = max(self.proximo_bloco, self.no.maior_bloco_conhecido() + 1)
+            self.blocos_liberados = time.time() + self.espera_blocos
+        self.difundir(codificar_quadro(TIPO_BLOCO_IDS, json.dumps({"estado": [self.ip, self.porta]})))
+        self.no.definir_raiz(self.endereco)
+        return True
+
+    def tratar_novo_coordenador(self, corpo, conn=None):
+        super().tratar_novo_coordenador(corpo, conn)
+        self.no.definir_raiz(self.coordenador_atual)
+
+    # As mensagens de outro shard chegam pelo topo e descem para o shard deste host
+    def tratar_chat(self, corpo, conn):
+        self.no.descer(json.loads(corpo))
+
+    def verificar(self):
+        super().verificar()
+        if time.time() >= self.proximo_resumo:
+            self.proximo_resumo = time.time() + self.intervalo_heartbeat
+            self.enviar_resumo()
+
+    def enviar_resumo(self):
+        shard = self.no.shard
+        if shard is None or not shard.coordenador:
+            return
+        resumo = {"shard": shard.sala, "membros": len(shard.membros), "maior_bloco": self.no.maior_bloco_conhecido()}
+        if self.coordenador:
+            self.guardar_resumo(self.endereco, resumo)
+        elif self.coordenador_atual is not None:
+            quadro = codificar_quadro(TIPO_RESUMO_SHARD, json.dumps({**resumo, "de": [self.ip, self.porta]}))
+            self.enviar_sem_bloquear(*self.coordenador_atual, quadro)
+        # Os membros do shard guardam os subcoordenadores, para achar a raiz se o seu falhar
+        if self.membros.resumo() != self.topo_anunciado:
+            self.topo_anunciado = self.membros.resumo()
+            self.no.anunciar_raiz()
+
+    def tratar_resumo(self, corpo, conn):
+        dados = json.loads(corpo)
+        if self.coordenador:
+            self.guardar_resumo(tuple(dados.pop("de")), dados)
+
+    def guardar_resumo(self, endereco, resumo):
+        with self.lock_resumos:
+            self.resumos[endereco] = resumo
+            self.proximo_bloco = max(self.proximo_bloco, resumo["maior_bloco"] + 1)
+
+    # ======================================================================================
+    # Escolhe o shard de um peer que vai entrar: o de menos membros entre os que ainda têm
+    # vaga, ou um shard novo, de que ele será o subcoordenador. A vaga fica reservada até
+    # o próximo resumo daquele shard, para que vários JOINs seguidos não lotem um só
+    # ======================================================================================
+    def escolher_shard(self, endereco):
+        with self.lock_resumos:
+            self.resumos = {e: r for e, r in self.resumos.items() if e in self.membros}
+            livres = [(r["membros"], e) for e, r in self.resumos.items() if r["membros"] < self.no.tamanho_shard]
+            if not livres:
+                return {"shard": f"shard-{endereco[0]}:{endereco[1]}", "coordenador": None, "raiz": [self.ip, self.porta]}
+            _, escolhido = min(livres)
+            self.resumos[escolhido]["membros"] += 1
+            return {"shard": self.resumos[escolhido]["shard"], "coordenador": list(escolhido), "raiz": [self.ip, self.porta]}
+
+    # Reserva o próximo bloco de IDs (só na raiz); None logo depois de assumir o topo
+    def reservar_bloco(self):
+        with self.lock_resumos:
+            if not self.coordenador or time.time() < self.blocos_liberados:
+                return None
+            bloco = self.proximo_bloco
+            self.proximo_bloco += 1
+            return bloco
+
+    def tratar_bloco_ids(self, corpo, conn):
+        dados = json.loads(corpo)
+        if "pedido" in dados:
+            bloco = self.reservar_bloco()
+            if bloco is not None:
+                quadro = codificar_quadro(TIPO_BLOCO_IDS, json.dumps({"bloco": bloco}))
+                self.enviar_sem_bloquear(*dados["pedido"], quadro)
+        elif "bloco" in dados:
+            self.no.receber_bloco(dados["bloco"])
+        elif "estado" in dados:
+            quadro = codificar_quadro(TIPO_BLOCO_IDS, json.dumps({"maior": self.no.maior_bloco_conhecido()}))
+            self.enviar_sem_bloquear(*dados["estado"], quadro)
+        elif "maior" in dados:
+            with self.lock_resumos:
+                self.proximo_bloco = max(self.proximo_bloco, dados["maior"] + 1)
+
+# ==========================================================================================
+# Um peer no modo hierárquico: um ServidorSalas com a sala do shard e, nos subcoordenadores,
+# a sala do topo. Guarda o endereço da raiz e os blocos de IDs deste host
+# ==========================================================================================
+class NoHierarquico:
+    def __init__(self, servidor, nome, tamanho_shard=64, **opcoes):
+        if opcoes.get("disseminacao") == "ordenada":
+            raise ValueError("O modo ordenado não é suportado entre shards.")
+        self.servidor = servidor
+        self.nome = nome
+        self.tamanho_shard = tamanho_shard
+        self.opcoes = opcoes  # opções das salas (shard e topo)
+        self.shard = None
+        self.topo = None
+        self.raiz = None
+        self.conhecidos_topo = []  # subcoordenadores conhecidos, para achar a raiz
+        self.lock_topo = Lock()
+        self.condicao_ids = Condition()
+        self.blocos = deque()  # blocos de IDs ainda não usados: [próximo ID, fim)
+        self.maior_bloco = -1
+        self.pedido_bloco = 0.0  # momento (time.monotonic()) do último pedido de bloco
+        servidor.tratadores[TIPO_SHARD_PEDIDO] = self.tratar_shard_pedido
+
+    # ====================================================================================
+    # Entra pelo contato informado (qualquer peer do chat, que encaminha à raiz) no shard
+    # escolhido pela raiz; sem contato (ou se ninguém responder), cria o topo e o shard
+    # ====================================================================================
+    def entrar(self, contato=None):
+        ip, porta = self.servidor.endereco
+        resposta = None
+        for _ in range(3):
+            if contato is None:
+                break
+            try:
+                resposta = json.loads(requisitar(*contato, codificar_quadro(TIPO_SHARD_PEDIDO, f"{ip} {porta}"),
+                                                   transporte=self.servidor.transporte))
+            except (OSError, TypeError, ValueError):
+                resposta = None
+                break
+            if "shard" in resposta:
+                break
+            contato = tuple(resposta["raiz"]) if resposta.get("raiz") else None
+            resposta = None
+
+        if resposta is None:
+            self.topo = self.servidor.entrar(TOPO, self.nome, None, classe=PeerTopo, no=self, **self.opcoes)
+            self.raiz = self.servidor.endereco
+            self.shard = self.servidor.entrar(f"shard-{ip}:{porta}", self.nome, None, classe=PeerShard, no=self, **self.opcoes)
+        else:
+            self.raiz = tuple(resposta["raiz"])
+            coordenador = tuple(resposta["coordenador"]) if resposta["coordenador"] else None
+            # Se o subcoordenador não responder, o shard é criado (e este peer entra no topo)
+            self.shard = self.servidor.entrar(resposta["shard"], self.nome, coordenador, classe=PeerShard, no=self, **self.opcoes)
+        if self.shard.coordenador:
+            self.entrar_topo()
+            self.topo.enviar_resumo()
+        return self.shard
+
+    def entrar_topo(self):
+        with self.lock_topo:
+            if self.topo is not None:
+                return
+            raiz = self.localizar_raiz()
+            self.topo = self.servidor.entrar(TOPO, self.nome, raiz, classe=PeerTopo, no=self, **self.opcoes)
+            if not self.topo.coordenador:
+                self.raiz = self.topo.coordenador_atual
+
+    def sair_topo(self):
+        with self.lock_topo:
+            if self.topo is not None and (self.shard is None or not self.shard.coordenador):
+                self.topo = None
+                self.servidor.sair(TOPO)
+
+    # ====================================================================================
+    # Procura a raiz atual entre a raiz conhecida e os subcoordenadores conhecidos (cada
+    # um responde com a raiz que conhece). Usado por quem vence a eleição de um shard, já
+    # que a raiz pode ter falhado junto com o subcoordenador anterior
+    # ====================================================================================
+    def localizar_raiz(self, timeout=10):
+        limite = time.monotonic() + timeout
+        while True:
+            candidatos = [e for e in dict.fromkeys([self.raiz, *self.conhecidos_topo]) if e and e != self.servidor.endereco]
+            if not candidatos:
+                return None
+            for contato in candidatos:
+                try:
+                    resposta = json.loads(requisitar(*contato, codificar_quadro(TIPO_SHARD_PEDIDO, "raiz"), timeout=2,
+                                                       transporte=self.servidor.transporte))
+                except (OSError, TypeError, ValueError):
+                    continue
+                if resposta.get("raiz") and tuple(resposta["raiz"]) == contato:
+                    return contato
+                if resposta.get("raiz") and tuple(resposta["raiz"]) not in candidatos:
+                    self.conhecidos_topo.insert(0, tuple(resposta["raiz"]))
+            if time.monotonic() >= limite:
+                return None
+            time.sleep(0.5)
+
+    def tratar_shard_pedido(self, corpo, conn):
+        pedido = corpo.decode('utf-8').split()
+        topo = self.topo
+        if topo is None or not topo.coordenador or pedido == ["raiz"]:
+            raiz = topo.endereco if topo is not None and topo.coordenador else self.raiz
+            conn.send(json.dumps({"raiz": list(raiz) if raiz else None}).encode('utf-8'))
+            return
+        conn.send(json.dumps(topo.escolher_shard((pedido[0], int(pedido[1])))).encode('utf-8'))
+
+    def definir_raiz(self, endereco):
+        self.raiz = endereco
+        self.anunciar_raiz()
+
+    # Avisa os membros do shard (ou só destino) da raiz e dos subcoordenadores atuais
+    def anunciar_raiz(self, destino=None):
+        shard, topo = self.shard, self.topo
+        if shard is None or topo is None or not shard.coordenador or self.raiz is None:
+            return
+        quadro = codificar_quadro(TIPO_RAIZ, json.dumps({"raiz": list(self.raiz), "topo": [list(e) for e in topo.membros.enderecos()]}))
+        if destino is not None:
+            shard.enviar_sem_bloquear(*destino, quadro)
+        else:
+            shard.difundir(quadro)
+
+    # ======================================================================================
+    # Mensagens entre shards: o subcoordenador do autor repassa a mensagem aos outros
+    # subcoordenadores (subir) e cada um a repassa aos membros do próprio shard (descer)
+    # ======================================================================================
+    def subir(self, dados):
+        topo = self.topo
+        if topo is not None:
+            topo.difundir(codificar_quadro(TIPO_CHAT, json.dumps({**dados, "de": [topo.ip, topo.porta]})))
+
+    def descer(self, dados):
+        shard = self.shard
+        if shard is None or not shard.mensagens_vistas.registrar(dados["id"]):
+            return
+        shard.registrar_no_historico(dados)
+        shard.tratar_texto(dados["texto"], None)
+        shard.difundir(codificar_quadro(TIPO_CHAT, json.dumps({**dados, "de": [shard.ip, shard.porta]})))
+
+    # ====================================================================================
+    # IDs: cada subcoordenador atribui IDs dos próprios blocos e pede outro à raiz quando
+    # resta menos de um quarto de bloco, para que os JOINs quase nunca esperem por ela.
+    # garantir_bloco entra no topo e espera um bloco (se preciso); gerar_id nunca espera
+    # ====================================================================================
+    def garantir_bloco(self, timeout=5):
+        if self.topo is None:
+            self.entrar_topo()
+        with self.condicao_ids:
+            limite = time.monotonic() + timeout
+            while not self.blocos:
+                if time.monotonic() >= self.pedido_bloco + 1:
+                    self.pedir_bloco()  # o pedido (ou a resposta) pode ter se perdido
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    raise RuntimeError("A raiz não reservou um bloco de IDs.")
+                # Na raiz, pedir_bloco já reserva o bloco, e não há o que esperar
+                if not self.blocos:
+                    self.condicao_ids.wait(min(restante, 1.0))
+
+    def gerar_id(self):
+        with self.condicao_ids:
+            if not self.blocos:
+                raise RuntimeError("Nenhum bloco de IDs disponível.")
+            bloco = self.blocos[0]
+            novo_id = bloco[0]
+            bloco[0] += 1
+            if bloco[0] == bloco[1]:
+                self.blocos.popleft()
+            restantes = sum(fim - proximo for proximo, fim in self.blocos)
+            if restantes < TAMANHO_BLOCO // 4 and time.monotonic() >= self.pedido_bloco + 1:
+                self.pedir_bloco()
+            return novo_id
+
+    def pedir_bloco(self):
+        self.pedido_bloco = time.monotonic()
+        topo = self.topo
+        if topo.coordenador:
+            bloco = topo.reservar_bloco()
+            if bloco is not None:
+                self.receber_bloco(bloco)
+        elif topo.coordenador_atual is not None:
+            quadro = codificar_quadro(TIPO_BLOCO_IDS, json.dumps({"pedido": [topo.ip, topo.porta]}))
+            topo.enviar_sem_bloquear(*topo.coordenador_atual, quadro)
+
+    def receber_bloco(self, bloco):
+        with self.condicao_ids:
+            self.blocos.append([bloco * TAMANHO_BLOCO, (bloco + 1) * TAMANHO_BLOCO])
+            self.maior_bloco = max(self.maior_bloco, bloco)
+            self.condicao_ids.notify_all()
+
+    # Maior bloco em uso que este host conhece: os seus e os dos IDs do seu shard
+    # (que podem ter vindo de um subcoordenador que já falhou)
+    def maior_bloco_conhecido(self):
+        shard = self.shard
+        maior_id = shard.membros.maior_id() if shard is not None else -1
+        return max(self.maior_bloco, maior_id // TAMANHO_BLOCO if maior_id >= 0 else -1)
+
+    def encerrar(self):
+        self.servidor.encerrar()
+
+# ============================================================
+# Uso interativo: python hierarquia.py <nome> <porta> [porta_de_um_peer]
+# ============================================================
+def main():
+    if len(sys.argv) not in (3, 4) or not all(a.isdigit() for a in sys.argv[2:]):
+        print("Uso: python hierarquia.py <nome> <porta> [porta_de_um_peer]")
+        sys.exit(1)
+    nome, porta = sys.argv[1], int(sys.argv[2])
+    servidor = ServidorSalas("localhost", porta)
+    if not servidor.iniciar():
+        sys.exit(1)
+    no = NoHierarquico(servidor, nome)
+    shard = no.entrar(("localhost", int(sys.argv[3])) if len(sys.argv) == 4 else None)
+    print("[SISTEMA] Comandos: 'LIST' (membros do shard), 'SHARDS' (na raiz) e 'EXIT'.")
+
+    while True:
+        try:
+            entrada = input().strip()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if entrada == "EXIT":
+            break
+        elif entrada == "LIST":
+            for membro in shard.membros:
+                print(f"{membro.nome or 'Desconhecido'} [{membro.id}] -> {membro.endereco}")
+        elif entrada == "SHARDS":
+            if no.topo is not None and no.topo.coordenador:
+                for endereco, resumo in list(no.topo.resumos.items()):
+                    print(f"{resumo['shard']}: {resumo['membros']} membros, subcoordenador {endereco}")
+            else:
+                print(f"[SISTEMA] A raiz é {no.raiz}.")
+        elif entrada:
+            shard.enviar_mensagem(entrada)
+    no.encerrar()
+
+if __name__ == "__main__":
+    main()
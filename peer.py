@@ -1,14 +1,1770 @@
+import argparse
 import socket
 import time
 import json
-from threading import Thread
+import struct
+import math
+import mmap
+import bisect
+from threading import Thread, Lock, RLock, Condition, Timer, Event
+from collections import deque, OrderedDict
+import random
+import select
 import atexit
 import signal
 import sys
+import os
+import threading
+import logging
+import logging.handlers
+import queue
+import hashlib
+import tempfile
+import zlib
 
 # Constante usada para verificar se um peer digitou 'EXIT' para sair
 EXITING = False
 
+# =======================================================================
+# Relógio usado pelo protocolo (instantes, prazos, heartbeat, detector de
+# falhas e filas de saída). Por padrão é o do sistema; o simulador troca
+# pelo relógio virtual da simulação com relogio.usar(fonte), onde fonte
+# tem time() e monotonic()
+# =======================================================================
+class Relogio:
+    def __init__(self):
+        self.usar(time)
+
+    # As funções da fonte viram atributos, para que ler o relógio custe o mesmo que time.time()
+    def usar(self, fonte):
+        self.time = fonte.time
+        self.monotonic = fonte.monotonic
+
+relogio = Relogio()
+
+# =======================================================================
+# LOG - as mensagens do sistema passam pelo logger "chat". Quem registra
+# só coloca o registro em uma fila; uma thread própria (QueueListener)
+# escreve no terminal e, opcionalmente, em um arquivo JSON (uma linha por
+# registro), para que o terminal nunca segure o recebimento de mensagens
+# =======================================================================
+log = logging.getLogger("chat")
+_ouvinte_log = None
+
+# Escreve no sys.stdout do momento da escrita (que pode ter sido redirecionado depois)
+class SaidaConsole(logging.Handler):
+    def emit(self, registro):
+        try:
+            sys.stdout.write(self.format(registro) + "\n")
+            sys.stdout.flush()
+        except Exception:
+            self.handleError(registro)
+
+class FormatadorJson(logging.Formatter):
+    def format(self, registro):
+        dados = {
+            "instante": registro.created,
+            "nivel": registro.levelname,
+            "mensagem": registro.getMessage().strip(),
+            "thread": registro.threadName,
+        }
+        for campo in ("peer", "evento"):
+            if hasattr(registro, campo):
+                dados[campo] = getattr(registro, campo)
+        return json.dumps(dados, ensure_ascii=False)
+
+# ============================================================
+# Configura o log (nível e arquivo JSON opcional). Chamado
+# automaticamente com os valores padrão ao criar um Peer
+# ============================================================
+def configurar_log(nivel="INFO", arquivo_json=None):
+    global _ouvinte_log
+    if _ouvinte_log is not None:
+        _ouvinte_log.stop()
+
+    console = SaidaConsole()
+    console.setFormatter(logging.Formatter("%(message)s"))
+    destinos = [console]
+    if arquivo_json:
+        arquivo = logging.FileHandler(arquivo_json, encoding="utf-8")
+        arquivo.setFormatter(FormatadorJson())
+        destinos.append(arquivo)
+
+    fila = queue.SimpleQueue()
+    log.handlers = [logging.handlers.QueueHandler(fila)]
+    log.setLevel(nivel)
+    log.propagate = False
+    _ouvinte_log = logging.handlers.QueueListener(fila, *destinos)
+    _ouvinte_log.start()
+
+# Acrescenta o peer de origem (e campos extras, como evento) aos registros
+class LogPeer(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        kwargs["extra"] = {**self.extra, **kwargs.get("extra", {})}
+        return msg, kwargs
+
+def _parar_log():
+    if _ouvinte_log is not None:
+        _ouvinte_log.stop()  # escreve o que ainda estiver na fila
+
+atexit.register(_parar_log)
+
+# =======================================================================
+# PROTOCOLO - quadros binários com prefixo de tamanho e byte de tipo
+#
+# Toda conexão começa com PREAMBULO_QUADROS. Depois dele, cada mensagem é
+# um quadro: 4 bytes com o tamanho do corpo (big-endian), 1 byte com o tipo
+# da mensagem e o corpo. Várias mensagens podem trafegar na mesma conexão
+# =======================================================================
+PREAMBULO_QUADROS = b"SDQ1"
+CABECALHO_QUADRO = struct.Struct("!IB")
+TAMANHO_MAX_QUADRO = 16 * 1024 * 1024  # quadros maiores que isso são considerados inválidos
+
+# Tipos de mensagem (byte de tipo do quadro)
+TIPO_TEXTO = 0  # mensagem de chat (ou aviso do sistema) exibida ao usuário
+TIPO_JOIN = 1
+TIPO_UPDATE = 2
+TIPO_HEARTBEAT = 3
+TIPO_START_ELECTION = 4
+TIPO_ELECTION = 5
+TIPO_COORDINATOR = 6
+TIPO_REMOVE_COORDINATOR = 7
+TIPO_MAP_UPDATE = 8
+TIPO_EXIT = 9
+TIPO_RESPOSTA = 10  # resposta a uma mensagem enviada com wait_response (ex.: JOIN)
+TIPO_DELTA = 11  # alteração incremental (versionada) da lista de membros
+TIPO_SYNC_REQUEST = 12  # pedido do estado dos membros ao coordenador ("ip porta epoca seq resumo formatos")
+TIPO_HELLO = 13  # primeiro quadro de cada conexão: identifica o peer de origem ("ip porta")
+TIPO_OK = 14  # resposta de um candidato com ID maior a um ELECTION ("id")
+TIPO_CHAT = 15  # mensagem de chat com ID, repassada entre os peers (JSON: id, texto, de)
+TIPO_LOTE = 16  # vários quadros completos agrupados em um só (ver EnviadorLotes)
+TIPO_STATS = 17  # pedido das métricas do peer; a resposta é o JSON de Peer.exportar_metricas()
+TIPO_HISTORICO = 18  # mensagens anteriores enviadas a quem entra na sala (JSON: log, ate, mensagens)
+TIPO_SEQ_PEDIDO = 19  # modo ordenado: mensagem de chat enviada ao coordenador para ser numerada (JSON: id, texto, de)
+TIPO_ORDEM = 20  # modo ordenado: lote de mensagens numeradas pelo coordenador (JSON: [[seq, mensagem], ...])
+TIPO_RETRANSMITIR = 21  # modo ordenado: pedido das mensagens que faltam ("ip porta de ate")
+TIPO_SEQ_STATE = 22  # modo ordenado: estado da numeração trocado com o novo coordenador após a eleição
+TIPO_ESTADO = 23  # resposta ao SYNC_REQUEST: versão e diferença (ou tabela completa, com zlib) dos membros
+TIPO_SALA = 24  # envelope de um quadro de uma sala (ver salas.py): tamanho do nome, nome e o quadro
+TIPO_SHARD_PEDIDO = 25  # modo hierárquico: pedido do shard em que entrar ("ip porta") ou do endereço da raiz ("raiz")
+TIPO_RESUMO_SHARD = 26  # modo hierárquico: resumo de um shard enviado à raiz (JSON: shard, membros, maior_bloco, de)
+TIPO_BLOCO_IDS = 27  # modo hierárquico: pedido, entrega e sincronização dos blocos de IDs (JSON)
+TIPO_RAIZ = 28  # modo hierárquico: endereço da raiz e dos subcoordenadores, enviado aos membros de um shard (JSON)
+
+# Nome de cada tipo, usado nas métricas
+NOMES_TIPOS = {
+    TIPO_TEXTO: "TEXTO", TIPO_JOIN: "JOIN", TIPO_UPDATE: "UPDATE", TIPO_HEARTBEAT: "HEARTBEAT",
+    TIPO_START_ELECTION: "START_ELECTION", TIPO_ELECTION: "ELECTION", TIPO_COORDINATOR: "COORDINATOR",
+    TIPO_REMOVE_COORDINATOR: "REMOVE_COORDINATOR", TIPO_MAP_UPDATE: "MAP_UPDATE", TIPO_EXIT: "EXIT",
+    TIPO_RESPOSTA: "RESPOSTA", TIPO_DELTA: "DELTA", TIPO_SYNC_REQUEST: "SYNC_REQUEST", TIPO_HELLO: "HELLO",
+    TIPO_OK: "OK", TIPO_CHAT: "CHAT", TIPO_LOTE: "LOTE", TIPO_STATS: "STATS",
+    TIPO_HISTORICO: "HISTORICO", TIPO_SEQ_PEDIDO: "SEQ_PEDIDO", TIPO_ORDEM: "ORDEM",
+    TIPO_RETRANSMITIR: "RETRANSMITIR", TIPO_SEQ_STATE: "SEQ_STATE", TIPO_ESTADO: "ESTADO",
+    TIPO_SALA: "SALA", TIPO_SHARD_PEDIDO: "SHARD_PEDIDO", TIPO_RESUMO_SHARD: "RESUMO_SHARD",
+    TIPO_BLOCO_IDS: "BLOCO_IDS", TIPO_RAIZ: "RAIZ",
+}
+
+# Tipos cujo corpo é entregue ao tratador em bytes, sem decodificar como texto
+TIPOS_BINARIOS = {TIPO_ESTADO, TIPO_UPDATE, TIPO_MAP_UPDATE, TIPO_DELTA}
+
+# Prioridade de tratamento de cada tipo de mensagem recebida (menor = mais urgente).
+# Heartbeat e eleição nunca esperam atrás de mensagens de chat
+PRIORIDADE_CONTROLE = 0
+PRIORIDADE_MEMBROS = 1
+PRIORIDADE_CHAT = 2
+NOMES_PRIORIDADES = ("controle", "membros", "chat")
+PRIORIDADE_POR_TIPO = {
+    TIPO_HEARTBEAT: PRIORIDADE_CONTROLE,
+    TIPO_START_ELECTION: PRIORIDADE_CONTROLE,
+    TIPO_ELECTION: PRIORIDADE_CONTROLE,
+    TIPO_OK: PRIORIDADE_CONTROLE,
+    TIPO_COORDINATOR: PRIORIDADE_CONTROLE,
+    TIPO_REMOVE_COORDINATOR: PRIORIDADE_CONTROLE,
+    TIPO_STATS: PRIORIDADE_CONTROLE,
+    TIPO_BLOCO_IDS: PRIORIDADE_CONTROLE,
+    TIPO_RAIZ: PRIORIDADE_CONTROLE,
+    TIPO_JOIN: PRIORIDADE_MEMBROS,
+    TIPO_UPDATE: PRIORIDADE_MEMBROS,
+    TIPO_MAP_UPDATE: PRIORIDADE_MEMBROS,
+    TIPO_EXIT: PRIORIDADE_MEMBROS,
+    TIPO_DELTA: PRIORIDADE_MEMBROS,
+    TIPO_SYNC_REQUEST: PRIORIDADE_MEMBROS,
+    TIPO_SEQ_STATE: PRIORIDADE_MEMBROS,
+    TIPO_ESTADO: PRIORIDADE_MEMBROS,
+    TIPO_SHARD_PEDIDO: PRIORIDADE_MEMBROS,
+    TIPO_RESUMO_SHARD: PRIORIDADE_MEMBROS,
+    TIPO_TEXTO: PRIORIDADE_CHAT,
+    TIPO_CHAT: PRIORIDADE_CHAT,
+    TIPO_HISTORICO: PRIORIDADE_CHAT,
+    TIPO_SEQ_PEDIDO: PRIORIDADE_CHAT,
+    TIPO_ORDEM: PRIORIDADE_CHAT,
+    TIPO_RETRANSMITIR: PRIORIDADE_CHAT,
+}
+
+# Usado para converter mensagens de texto no formato antigo ("JOIN ip porta nome", etc.)
+TIPOS_POR_PALAVRA = {
+    "JOIN": TIPO_JOIN,
+    "UPDATE": TIPO_UPDATE,
+    "HEARTBEAT": TIPO_HEARTBEAT,
+    "START_ELECTION": TIPO_START_ELECTION,
+    "ELECTION": TIPO_ELECTION,
+    "OK": TIPO_OK,
+    "COORDINATOR": TIPO_COORDINATOR,
+    "REMOVE_COORDINATOR": TIPO_REMOVE_COORDINATOR,
+    "MAP_UPDATE": TIPO_MAP_UPDATE,
+    "EXIT": TIPO_EXIT,
+    "DELTA": TIPO_DELTA,
+    "SYNC_REQUEST": TIPO_SYNC_REQUEST,
+    "STATS": TIPO_STATS,
+}
+
+# =========================================================================================
+# Codificação dos corpos de membros (UPDATE, MAP_UPDATE, DELTA e ESTADO), as maiores
+# mensagens de uma sala grande. Além do JSON, há um formato compacto binário: os hosts
+# (quase sempre os mesmos) aparecem uma única vez, em uma tabela no início, e as linhas
+# usam o índice do host; portas, IDs e a versão são varints (7 bits por byte). As linhas
+# vão por colunas (todos os hosts, depois todas as portas, ...), para que os varints
+# sejam lidos em um único laço. Acima de limite_compressao bytes, o corpo pode ir
+# comprimido com zlib. O primeiro byte diz o formato: "{" é JSON, MARCA_COMPACTO é o
+# formato compacto e MARCA_ZLIB é zlib (de um dos outros dois). Os formatos usados com
+# cada peer são combinados no JOIN
+# =========================================================================================
+FORMATOS_SUPORTADOS = ("compacto", "zlib")
+MARCA_COMPACTO = b"\x01"
+MARCA_ZLIB = b"\x02"
+MODOS_ESTADO = ("igual", "diferenca", "completo")
+# Campos do formato compacto, na ordem em que são gravados. Um byte de presença (bit i =
+# campo i) vem depois da tabela de hosts; um campo fora desta lista faz o corpo ir em JSON
+CAMPOS_COMPACTOS = ("versao", "resumo", "modo", "membros", "adicionados", "removidos", "enderecos")
+
+def codificar_membros(dados, formatos=FORMATOS_SUPORTADOS, limite_compressao=1024):
+    corpo = None
+    if "compacto" in formatos:
+        try:
+            corpo = codificar_compacto(dados)
+        except (KeyError, ValueError, TypeError):
+            corpo = None
+    if corpo is None:
+        corpo = json.dumps(dados, separators=(",", ":")).encode('utf-8')
+    if "zlib" in formatos and len(corpo) > limite_compressao:
+        comprimido = zlib.compress(corpo)
+        if len(comprimido) + 1 < len(corpo):
+            return MARCA_ZLIB + comprimido
+    return corpo
+
+def decodificar_membros(corpo):
+    marca = corpo[:1]
+    if marca == MARCA_ZLIB:
+        return decodificar_membros(zlib.decompress(corpo[1:]))
+    if marca == MARCA_COMPACTO:
+        return decodificar_compacto(corpo)
+    return json.loads(corpo)
+
+def escrever_varint(saida, valor):
+    escrever_varints(saida, (valor,))
+
+def escrever_varints(saida, valores):
+    for valor in valores:
+        if valor < 0:
+            raise ValueError("varint negativo")
+        while valor >= 0x80:
+            saida.append((valor & 0x7F) | 0x80)
+            valor >>= 7
+        saida.append(valor)
+
+def ler_varint(dados, posicao):
+    valores, posicao = ler_varints(dados, posicao, 1)
+    return valores[0], posicao
+
+def ler_varints(dados, posicao, quantidade):
+    valores = []
+    for _ in range(quantidade):
+        byte = dados[posicao]
+        posicao += 1
+        if byte >= 0x80:
+            valor = byte & 0x7F
+            deslocamento = 7
+            while True:
+                byte = dados[posicao]
+                posicao += 1
+                valor |= (byte & 0x7F) << deslocamento
+                if byte < 0x80:
+                    break
+                deslocamento += 7
+            byte = valor
+        valores.append(byte)
+    return valores, posicao
+
+# Texto (ou None, gravado como 0) com o tamanho + 1 na frente
+def escrever_texto(saida, texto):
+    if texto is None:
+        saida.append(0)
+        return
+    dados = texto.encode('utf-8')
+    escrever_varint(saida, len(dados) + 1)
+    saida += dados
+
+def ler_texto(dados, posicao):
+    tamanho, posicao = ler_varint(dados, posicao)
+    if tamanho == 0:
+        return None, posicao
+    return dados[posicao:posicao + tamanho - 1].decode('utf-8'), posicao + tamanho - 1
+
+def codificar_compacto(dados):
+    hosts = {}  # mapeia host -> índice na tabela de hosts
+    corpo = bytearray()
+    presenca = 0
+    for bit, campo in enumerate(CAMPOS_COMPACTOS):
+        if campo not in dados:
+            continue
+        presenca |= 1 << bit
+        valor = dados[campo]
+        if campo == "versao":
+            escrever_varint(corpo, valor[0])
+            escrever_varint(corpo, valor[1])
+        elif campo == "resumo":
+            resumo = bytes.fromhex(valor)
+            corpo.append(len(resumo))
+            corpo += resumo
+        elif campo == "modo":
+            corpo.append(MODOS_ESTADO.index(valor))
+        elif campo in ("membros", "adicionados"):
+            # Colunas: hosts, portas, IDs + 1 (0 = sem ID), tamanhos dos nomes + 1 (0 = sem
+            # nome) e, por fim, os nomes em sequência
+            nomes = [None if nome is None else nome.encode('utf-8') for _, _, _, nome in valor]
+            escrever_varint(corpo, len(valor))
+            escrever_varints(corpo, [hosts.setdefault(ip, len(hosts)) for ip, _, _, _ in valor])
+            escrever_varints(corpo, [porta for _, porta, _, _ in valor])
+            escrever_varints(corpo, [0 if id is None else id + 1 for _, _, id, _ in valor])
+            escrever_varints(corpo, [0 if nome is None else len(nome) + 1 for nome in nomes])
+            corpo += b"".join(nome for nome in nomes if nome)
+        else:  # removidos e enderecos: só [ip, porta]
+            escrever_varint(corpo, len(valor))
+            escrever_varints(corpo, [hosts.setdefault(ip, len(hosts)) for ip, _ in valor])
+            escrever_varints(corpo, [porta for _, porta in valor])
+    if bin(presenca).count("1") != len(dados):
+        raise KeyError("campo fora do formato compacto")
+
+    saida = bytearray(MARCA_COMPACTO)
+    escrever_varint(saida, len(hosts))
+    for host in hosts:
+        escrever_texto(saida, host)
+    saida.append(presenca)
+    return bytes(saida + corpo)
+
+def decodificar_compacto(corpo):
+    quantidade, posicao = ler_varint(corpo, 1)
+    hosts = []
+    for _ in range(quantidade):
+        host, posicao = ler_texto(corpo, posicao)
+        hosts.append(host)
+    presenca = corpo[posicao]
+    posicao += 1
+
+    dados = {}
+    for bit, campo in enumerate(CAMPOS_COMPACTOS):
+        if not presenca & (1 << bit):
+            continue
+        if campo == "versao":
+            epoca, posicao = ler_varint(corpo, posicao)
+            seq, posicao = ler_varint(corpo, posicao)
+            dados[campo] = [epoca, seq]
+        elif campo == "resumo":
+            tamanho = corpo[posicao]
+            dados[campo] = corpo[posicao + 1:posicao + 1 + tamanho].hex()
+            posicao += 1 + tamanho
+        elif campo == "modo":
+            dados[campo] = MODOS_ESTADO[corpo[posicao]]
+            posicao += 1
+        elif campo in ("membros", "adicionados"):
+            n, posicao = ler_varint(corpo, posicao)
+            numeros, posicao = ler_varints(corpo, posicao, 4 * n)
+            nomes = []
+            for tamanho in numeros[3 * n:]:
+                if tamanho:
+                    nomes.append(corpo[posicao:posicao + tamanho - 1].decode('utf-8'))
+                    posicao += tamanho - 1
+                else:
+                    nomes.append(None)
+            dados[campo] = [
+                [hosts[host], porta, id - 1 if id else None, nome]
+                for host, porta, id, nome in zip(numeros[:n], numeros[n:2 * n], numeros[2 * n:3 * n], nomes)
+            ]
+        else:
+            n, posicao = ler_varint(corpo, posicao)
+            numeros, posicao = ler_varints(corpo, posicao, 2 * n)
+            dados[campo] = [[hosts[host], porta] for host, porta in zip(numeros[:n], numeros[n:])]
+    return dados
+
+# ============================================================
+# Monta um quadro (cabeçalho + corpo) pronto para ser enviado
+# ============================================================
+def codificar_quadro(tipo, corpo=b""):
+    if isinstance(corpo, str):
+        corpo = corpo.encode('utf-8')
+    return CABECALHO_QUADRO.pack(len(corpo), tipo) + corpo
+
+# ========================================================================
+# Identifica o tipo de uma mensagem de texto no formato antigo, separando
+# a palavra reservada do restante da mensagem
+# ========================================================================
+def tipo_da_mensagem(msg):
+    palavra, _, corpo = msg.partition(" ")
+    tipo = TIPOS_POR_PALAVRA.get(palavra)
+    if tipo is None:
+        return TIPO_TEXTO, msg
+    return tipo, corpo
+
+# =======================================================================
+# Decodificador incremental de quadros: recebe os bytes na ordem em que
+# chegam do socket (leituras parciais ou com vários quadros de uma vez)
+# e devolve os quadros completos
+# =======================================================================
+class DecodificadorQuadros:
+    def __init__(self, tamanho_max=TAMANHO_MAX_QUADRO):
+        self.buffer = bytearray()
+        self.tamanho_max = tamanho_max
+
+    def alimentar(self, dados):
+        self.buffer += dados
+        quadros = []
+        inicio = 0
+        tamanho_cabecalho = CABECALHO_QUADRO.size
+        while len(self.buffer) - inicio >= tamanho_cabecalho:
+            tamanho, tipo = CABECALHO_QUADRO.unpack_from(self.buffer, inicio)
+            if tamanho > self.tamanho_max:
+                raise ValueError(f"quadro de {tamanho} bytes excede o limite de {self.tamanho_max}")
+            fim = inicio + tamanho_cabecalho + tamanho
+            if len(self.buffer) < fim:
+                break
+            quadros.append((tipo, bytes(self.buffer[inicio + tamanho_cabecalho:fim])))
+            inicio = fim
+        if inicio:
+            del self.buffer[:inicio]
+        return quadros
+
+# ============================================================
+# Abre os quadros TIPO_LOTE recebidos, devolvendo os quadros
+# de dentro deles na ordem em que foram enviados
+# ============================================================
+def expandir_lotes(quadros):
+    for tipo, corpo in quadros:
+        if tipo == TIPO_LOTE:
+            yield from DecodificadorQuadros().alimentar(corpo)
+        else:
+            yield tipo, corpo
+
+# Envelope de sala: vários chats (salas) compartilham a mesma porta e as mesmas conexões,
+# então cada quadro leva o nome da sala a que pertence
+def envelopar_sala(sala, quadro):
+    nome = sala.encode('utf-8')
+    return codificar_quadro(TIPO_SALA, bytes([len(nome)]) + nome + quadro)
+
+# Retorna (sala, tipo, corpo) do quadro contido no envelope
+def abrir_sala(corpo):
+    fim_nome = 1 + corpo[0]
+    _, tipo = CABECALHO_QUADRO.unpack_from(corpo, fim_nome)
+    return corpo[1:fim_nome].decode('utf-8'), tipo, corpo[fim_nome + CABECALHO_QUADRO.size:]
+
+# =======================================================================
+# Envolve o socket de uma conexão em quadros, para que as respostas dos
+# tratadores (conn.send(...)) sejam enviadas como quadros TIPO_RESPOSTA
+# =======================================================================
+class ConexaoQuadros:
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = Lock()
+
+    def send(self, dados):
+        with self.lock:
+            self.sock.sendall(codificar_quadro(TIPO_RESPOSTA, dados))
+        return len(dados)
+
+# Tipos dos quadros contidos em um buffer de quadros completos (abrindo os lotes),
+# lendo só os cabeçalhos
+def tipos_dos_quadros(dados):
+    tipos = []
+    inicio = 0
+    while inicio + CABECALHO_QUADRO.size <= len(dados):
+        tamanho, tipo = CABECALHO_QUADRO.unpack_from(dados, inicio)
+        inicio += CABECALHO_QUADRO.size
+        if tipo == TIPO_LOTE:
+            tipos.extend(tipos_dos_quadros(dados[inicio:inicio + tamanho]))
+        else:
+            tipos.append(tipo)
+        inicio += tamanho
+    return tipos
+
+# =======================================================================
+# MÉTRICAS - histograma com baldes fixos (em ms, escala aproximadamente
+# logarítmica), barato o bastante para ser usado a cada mensagem
+# =======================================================================
+LIMITES_HISTOGRAMA = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+class Histograma:
+    __slots__ = ("baldes", "contagem", "soma", "maximo")
+
+    def __init__(self):
+        self.baldes = [0] * (len(LIMITES_HISTOGRAMA) + 1)  # o último balde é "acima de 10 s"
+        self.contagem = 0
+        self.soma = 0.0
+        self.maximo = 0.0
+
+    def observar(self, valor):
+        i = 0
+        while i < len(LIMITES_HISTOGRAMA) and valor > LIMITES_HISTOGRAMA[i]:
+            i += 1
+        self.baldes[i] += 1
+        self.contagem += 1
+        self.soma += valor
+        if valor > self.maximo:
+            self.maximo = valor
+
+    # Percentil aproximado: limite superior do balde onde ele cai
+    def percentil(self, q):
+        alvo = q / 100 * self.contagem
+        acumulado = 0
+        for i, quantidade in enumerate(self.baldes):
+            acumulado += quantidade
+            if acumulado >= alvo and quantidade:
+                return LIMITES_HISTOGRAMA[i] if i < len(LIMITES_HISTOGRAMA) else self.maximo
+        return 0.0
+
+    def resumo(self):
+        nomes = [f"<={limite}" for limite in LIMITES_HISTOGRAMA] + [f">{LIMITES_HISTOGRAMA[-1]}"]
+        return {
+            "contagem": self.contagem,
+            "media": self.soma / self.contagem if self.contagem else 0.0,
+            "p50": self.percentil(50),
+            "p99": self.percentil(99),
+            "max": self.maximo,
+            "baldes": {nome: n for nome, n in zip(nomes, self.baldes) if n},
+        }
+
+# =======================================================================
+# Contadores e histogramas de um peer, além de medidores (funções lidas
+# só na hora de exportar, como o número de threads vivas)
+# =======================================================================
+class Metricas:
+    def __init__(self):
+        self.contadores = {}
+        self.histogramas = {}
+        self.medidores = {}
+        self.lock = Lock()
+
+    def incrementar(self, nome, valor=1):
+        with self.lock:
+            self.contadores[nome] = self.contadores.get(nome, 0) + valor
+
+    def observar(self, nome, valor):
+        with self.lock:
+            histograma = self.histogramas.get(nome)
+            if histograma is None:
+                histograma = self.histogramas[nome] = Histograma()
+            histograma.observar(valor)
+
+    def registrar_medidor(self, nome, funcao):
+        self.medidores[nome] = funcao
+
+    # Conta os quadros e os bytes que saíram pela rede
+    def contar_envio(self, dados):
+        with self.lock:
+            for tipo in tipos_dos_quadros(dados):
+                nome = "enviadas." + NOMES_TIPOS.get(tipo, str(tipo))
+                self.contadores[nome] = self.contadores.get(nome, 0) + 1
+            self.contadores["bytes_enviados"] = self.contadores.get("bytes_enviados", 0) + len(dados)
+
+    def instantaneo(self):
+        with self.lock:
+            dados = {
+                "contadores": dict(sorted(self.contadores.items())),
+                "histogramas_ms": {nome: h.resumo() for nome, h in sorted(self.histogramas.items())},
+            }
+        dados["medidores"] = {nome: funcao() for nome, funcao in self.medidores.items()}
+        return dados
+
+# ============================================================
+# Pede as métricas de um peer em execução (quadro TIPO_STATS)
+# ============================================================
+def pedir_metricas(ip, porta, timeout=5, transporte=None):
+    resposta = requisitar(ip, porta, codificar_quadro(TIPO_STATS), timeout, transporte)
+    return json.loads(resposta) if resposta is not None else None
+
+# Envia um quadro em uma conexão própria (sem HELLO), aberta pelo transporte informado
+# (padrão: TransporteTCP), e retorna o corpo da resposta (RESPOSTA), ou None se a
+# conexão for fechada antes dela
+def requisitar(ip, porta, quadro, timeout=5, transporte=None):
+    transporte = transporte if transporte is not None else TransporteTCP()
+    s = transporte.conectar((ip, porta), timeout)
+    try:
+        s.sendall(PREAMBULO_QUADROS + quadro)
+        decodificador = DecodificadorQuadros()
+        while True:
+            data = s.recv(65536)
+            if not data:
+                return None
+            for tipo, corpo in decodificador.alimentar(data):
+                if tipo == TIPO_RESPOSTA:
+                    return corpo
+    finally:
+        s.close()
+
+# =======================================================================
+# Conexão persistente com um peer, usada pelo pool de conexões
+# =======================================================================
+class ConexaoPersistente:
+    __slots__ = ("sock", "lock", "ultimo_uso")
+
+    def __init__(self, sock):
+        self.sock = sock  # socket TCP já conectado ao peer
+        self.lock = Lock()  # garante que duas threads não escrevam ao mesmo tempo no socket
+        self.ultimo_uso = relogio.time()  # usado para despejar conexões ociosas
+
+    # Verifica se o outro lado ainda está com a conexão aberta. O servidor só
+    # responde a mensagens enviadas com wait_response, que não passam pelo pool,
+    # então qualquer dado disponível para leitura significa que a conexão foi
+    # fechada (EOF) ou resetada
+    def viva(self):
+        try:
+            legivel, _, _ = select.select([self.sock], [], [], 0)
+            if not legivel:
+                return True
+            return self.sock.recv(1, socket.MSG_PEEK) != b""
+        except (OSError, ValueError):
+            return False
+
+    def fechar(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+# =======================================================================
+# Pool de conexões: mantém uma única conexão TCP de longa duração para
+# cada peer, com reconexão em caso de falha e despejo de conexões ociosas
+# =======================================================================
+class PoolConexoes:
+    def __init__(self, timeout=5, tempo_ocioso=60, saudacao=b"", metricas=None, transporte=None):
+        self.transporte = transporte if transporte is not None else TransporteTCP()
+        self.timeout = timeout  # timeout de conexão e envio (segundos)
+        self.metricas = metricas  # Metricas do peer (opcional): latência e falhas de conexão
+        self.saudacao = saudacao  # quadro HELLO enviado logo após o preâmbulo
+        self.tempo_ocioso = tempo_ocioso  # conexões sem uso por mais tempo que isso são fechadas
+        self.conexoes = {}  # mapeia (ip, porta) -> ConexaoPersistente
+        self.lock = Lock()  # protege o dicionário de conexões
+        self.ativo = True
+        Thread(target=self.despejar_ociosas, daemon=True).start()
+
+    # ============================================================
+    # Envia um quadro pela conexão persistente do peer, abrindo
+    # (ou reabrindo) a conexão quando necessário
+    # ============================================================
+    def enviar(self, ip, porta, quadro):
+        # Uma nova tentativa é feita caso a conexão reaproveitada tenha caído
+        for _ in range(2):
+            conexao = self.obter(ip, porta)
+            if conexao is None:
+                return False
+            with conexao.lock:
+                try:
+                    conexao.sock.sendall(quadro)
+                    conexao.ultimo_uso = relogio.time()
+                    if self.metricas is not None:
+                        self.metricas.contar_envio(quadro)
+                    return True
+                except OSError:
+                    self.descartar((ip, porta), conexao)
+        return False
+
+    def obter(self, ip, porta):
+        destino = (ip, porta)
+        with self.lock:
+            conexao = self.conexoes.get(destino)
+        if conexao is not None:
+            if conexao.viva():
+                return conexao
+            self.descartar(destino, conexao)
+
+        inicio = relogio.monotonic()
+        try:
+            s = self.transporte.conectar(destino, self.timeout)
+            s.sendall(PREAMBULO_QUADROS + self.saudacao)
+        except OSError:
+            if self.metricas is not None:
+                self.metricas.incrementar("conexao.falhas")
+            return None
+        if self.metricas is not None:
+            self.metricas.observar("conexao", (relogio.monotonic() - inicio) * 1000)
+
+        nova = ConexaoPersistente(s)
+        with self.lock:
+            # Outra thread pode ter conectado ao mesmo peer enquanto isso
+            existente = self.conexoes.get(destino)
+            if existente is not None:
+                nova.fechar()
+                return existente
+            self.conexoes[destino] = nova
+        return nova
+
+    def descartar(self, destino, conexao):
+        with self.lock:
+            if self.conexoes.get(destino) is conexao:
+                del self.conexoes[destino]
+        conexao.fechar()
+
+    # Fecha a conexão com o destino mesmo com um envio em andamento (o sendall bloqueado
+    # falha na hora)
+    def desconectar(self, destino):
+        with self.lock:
+            conexao = self.conexoes.pop(destino, None)
+        if conexao is not None:
+            try:
+                conexao.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conexao.fechar()
+
+    # ============================================================
+    # Fecha periodicamente as conexões que ficaram ociosas
+    # ============================================================
+    def despejar_ociosas(self):
+        while self.ativo:
+            time.sleep(max(1, self.tempo_ocioso / 4))
+            agora = relogio.time()
+            with self.lock:
+                ociosas = [(d, c) for d, c in self.conexoes.items() if agora - c.ultimo_uso > self.tempo_ocioso]
+            for destino, conexao in ociosas:
+                self.descartar(destino, conexao)
+
+    def fechar(self):
+        self.ativo = False
+        with self.lock:
+            conexoes = list(self.conexoes.values())
+            self.conexoes.clear()
+        for conexao in conexoes:
+            conexao.fechar()
+
+# =======================================================================
+# Registro de um membro do chat (endereço, ID, nome e última atividade).
+# Depois de publicado na tabela, o ID e o nome não mudam: alterá-los cria
+# outro registro (ver TabelaMembros). Só a última atividade é alterada no
+# lugar, com uma única atribuição
+# =======================================================================
+class Membro:
+    __slots__ = ("ip", "porta", "id", "nome", "ultima_atividade")
+
+    def __init__(self, ip, porta, id=None, nome=None):
+        self.ip = ip
+        self.porta = porta
+        self.id = id  # ID atribuído pelo coordenador (None enquanto desconhecido)
+        self.nome = nome  # nome de usuário (None enquanto desconhecido)
+        self.ultima_atividade = None  # momento (relogio.time()) da última atividade recebida
+
+    @property
+    def endereco(self):
+        return (self.ip, self.porta)
+
+    # Forma compacta usada nas mensagens: [ip, porta, id, nome]
+    def linha(self):
+        return [self.ip, self.porta, self.id, self.nome]
+
+    # O próprio registro, se o ID e o nome informados (None = manter) já são os atuais,
+    # ou uma cópia com os novos valores
+    def alterado(self, id=None, nome=None):
+        if (id is None or id == self.id) and (nome is None or nome == self.nome):
+            return self
+        membro = Membro(self.ip, self.porta, self.id if id is None else id, self.nome if nome is None else nome)
+        membro.ultima_atividade = self.ultima_atividade
+        return membro
+
+# =======================================================================
+# Uma versão da tabela de membros. Nunca é alterada depois de criada: a
+# tabela publica uma versão nova a cada alteração
+# =======================================================================
+class VersaoMembros:
+    __slots__ = ("por_endereco", "por_id", "membros", "enderecos")
+
+    def __init__(self, por_endereco, por_id):
+        self.por_endereco = por_endereco  # mapeia (ip, porta) -> Membro
+        self.por_id = por_id  # mapeia id -> Membro
+        self.membros = tuple(por_endereco.values())
+        self.enderecos = tuple(por_endereco)
+
+# =======================================================================
+# Tabela de membros do chat, indexada por endereço e por ID (busca em O(1)).
+# A ordem de inclusão é preservada. É copy-on-write: quem altera monta uma
+# VersaoMembros nova e a publica com uma única atribuição, então quem lê
+# (heartbeat, difusão, eleição) nunca trava nem copia a tabela e sempre vê
+# uma versão inteira. As alterações passam todas pela trava da tabela, que
+# o Peer também usa para alterar a tabela e a versão (seq) juntas
+# =======================================================================
+class TabelaMembros:
+    def __init__(self):
+        self.atual = VersaoMembros({}, {})
+        self.trava = RLock()  # única trava de escrita; a leitura não trava
+        self.ids_anteriores = {}  # mapeia (ip, porta) -> id de quem saiu (reaproveitado se voltar)
+
+    def __len__(self):
+        return len(self.atual.membros)
+
+    def __contains__(self, endereco):
+        return endereco in self.atual.por_endereco
+
+    def __iter__(self):
+        return iter(self.atual.membros)
+
+    def obter(self, endereco):
+        return self.atual.por_endereco.get(endereco)
+
+    def obter_por_id(self, id):
+        return self.atual.por_id.get(id)
+
+    def enderecos(self):
+        return self.atual.enderecos
+
+    def maior_id(self):
+        return max(self.atual.por_id, default=-1)
+
+    # Inclui um membro ou atualiza o ID e o nome de um membro já existente
+    def adicionar(self, ip, porta, id=None, nome=None):
+        with self.trava:
+            return self.aplicar([(ip, porta, id, nome)])[0][0]
+
+    def definir_id(self, membro, id):
+        self.adicionar(membro.ip, membro.porta, id)
+
+    def remover(self, endereco):
+        with self.trava:
+            removidos = self.aplicar(removidos=[endereco])[1]
+            return removidos[0] if removidos else None
+
+    # Aplica várias inclusões (linhas [ip, porta, id, nome], com None para manter o ID ou
+    # o nome atuais) e remoções (endereços) publicando uma única versão. Retorna os
+    # membros incluídos ou atualizados e os removidos
+    def aplicar(self, adicionados=(), removidos=()):
+        with self.trava:
+            por_endereco = dict(self.atual.por_endereco)
+            por_id = dict(self.atual.por_id)
+            saida = []
+            for endereco in removidos:
+                membro = por_endereco.pop(tuple(endereco), None)
+                if membro is not None:
+                    saida.append(membro)
+                    if membro.id is not None:
+                        if por_id.get(membro.id) is membro:
+                            del por_id[membro.id]
+                        self.ids_anteriores[membro.endereco] = membro.id
+            entrada = []
+            for ip, porta, id, nome in adicionados:
+                antigo = por_endereco.get((ip, porta))
+                membro = (antigo or Membro(ip, porta)).alterado(id, nome)
+                if antigo is not None and antigo.id is not None and por_id.get(antigo.id) is antigo:
+                    del por_id[antigo.id]
+                if membro.id is not None:
+                    por_id[membro.id] = membro
+                por_endereco[(ip, porta)] = membro
+                entrada.append(membro)
+            self.atual = VersaoMembros(por_endereco, por_id)
+            return entrada, saida
+
+    # Mantém apenas os endereços informados (na ordem informada), incluindo os que
+    # ainda não existiam. Retorna os membros removidos
+    def manter_apenas(self, enderecos):
+        with self.trava:
+            antigos = dict(self.atual.por_endereco)
+            por_endereco = {}
+            for endereco in enderecos:
+                por_endereco[endereco] = antigos.pop(endereco, None) or Membro(*endereco)
+            por_id = {id: membro for id, membro in self.atual.por_id.items() if membro.endereco in por_endereco}
+            self.atual = VersaoMembros(por_endereco, por_id)
+            return list(antigos.values())
+
+    # Substitui o conteúdo da tabela pelas linhas [ip, porta, id, nome] recebidas,
+    # reaproveitando os registros que não mudaram (e a última atividade de todos)
+    def substituir(self, linhas):
+        with self.trava:
+            antigos = self.atual.por_endereco
+            por_endereco = {}
+            por_id = {}
+            for ip, porta, id, nome in linhas:
+                antigo = antigos.get((ip, porta))
+                if antigo is not None and antigo.id == id and antigo.nome == nome:
+                    membro = antigo
+                else:
+                    membro = Membro(ip, porta, id, nome)
+                    if antigo is not None:
+                        membro.ultima_atividade = antigo.ultima_atividade
+                por_endereco[(ip, porta)] = membro
+                if id is not None:
+                    por_id[id] = membro
+            self.atual = VersaoMembros(por_endereco, por_id)
+
+    def linhas(self):
+        return [membro.linha() for membro in self.atual.membros]
+
+    # Resumo (hash) do conteúdo da tabela, independente da ordem dos membros. Dois peers
+    # com o mesmo resumo têm a mesma visão da sala
+    def resumo(self):
+        linhas = sorted(self.linhas(), key=lambda linha: (linha[0], linha[1]))
+        return hashlib.sha1(json.dumps(linhas).encode('utf-8')).hexdigest()[:16]
+
+# ===================================================================================
+# Papel do peer na sala: o coordenador atual, se é o próprio peer e se há uma eleição
+# em andamento. Como a tabela de membros, não muda depois de criado: o Peer troca o
+# papel inteiro de uma vez (sob lock_eleicao), então quem lê nunca vê o coordenador
+# novo com a marca de coordenador do antigo, nem duas eleições começando juntas
+# ===================================================================================
+class Papel:
+    __slots__ = ("coordenador_atual", "coordenador", "em_eleicao")
+
+    def __init__(self, coordenador_atual=None, coordenador=False, em_eleicao=False):
+        self.coordenador_atual = coordenador_atual  # (ip, porta) do coordenador (None enquanto fora da sala)
+        self.coordenador = coordenador  # o próprio peer é o coordenador
+        self.em_eleicao = em_eleicao  # o peer está em uma eleição
+
+    def com(self, **mudancas):
+        campos = {"coordenador_atual": self.coordenador_atual, "coordenador": self.coordenador,
+                  "em_eleicao": self.em_eleicao}
+        campos.update(mudancas)
+        return Papel(**campos)
+
+# ==========================================================================
+# Detector de falhas phi-accrual: em vez de um limite fixo de tempo sem
+# heartbeat, calcula a suspeita (phi) de que um peer falhou a partir da
+# distribuição dos intervalos entre as mensagens recebidas dele. phi = 8
+# significa uma chance de 1 em 10^8 de a suspeita estar errada
+# ==========================================================================
+class DetectorFalhas:
+    def __init__(self, intervalo_esperado=5.0, limiar_phi=8.0, janela=100, desvio_minimo=None, relogio=time.time):
+        self.intervalo_esperado = intervalo_esperado  # intervalo (s) entre heartbeats
+        self.limiar_phi = limiar_phi  # acima desse valor, o peer é considerado suspeito
+        self.janela = janela  # quantidade de intervalos usados no cálculo
+        self.desvio_minimo = desvio_minimo if desvio_minimo is not None else intervalo_esperado / 5
+        self.relogio = relogio
+        self.intervalos = {}  # mapeia (ip, porta) -> deque com os últimos intervalos
+        self.ultima_chegada = {}  # mapeia (ip, porta) -> momento da última mensagem recebida
+        self.ultima_amostra = {}  # mapeia (ip, porta) -> momento da última amostra de intervalo
+
+    # Registra uma mensagem recebida do peer. Mensagens muito próximas (rajadas de chat)
+    # renovam a última chegada, mas não viram amostra de intervalo, para não distorcer a média
+    def registrar(self, endereco, agora=None):
+        agora = self.relogio() if agora is None else agora
+        self.ultima_chegada[endereco] = agora
+        anterior = self.ultima_amostra.get(endereco)
+        if anterior is None:
+            # Começa com o intervalo esperado, para poder suspeitar antes da 2ª mensagem
+            self.intervalos[endereco] = deque([self.intervalo_esperado], maxlen=self.janela)
+            self.ultima_amostra[endereco] = agora
+        elif agora - anterior >= self.intervalo_esperado / 2:
+            self.intervalos[endereco].append(agora - anterior)
+            self.ultima_amostra[endereco] = agora
+
+    def esquecer(self, endereco):
+        self.intervalos.pop(endereco, None)
+        self.ultima_chegada.pop(endereco, None)
+        self.ultima_amostra.pop(endereco, None)
+
+    # Retorna phi para o peer (None se nada foi recebido dele ainda)
+    def phi(self, endereco, agora=None):
+        ultima = self.ultima_chegada.get(endereco)
+        if ultima is None:
+            return None
+        agora = self.relogio() if agora is None else agora
+        intervalos = self.intervalos[endereco]
+        media = sum(intervalos) / len(intervalos)
+        variancia = sum((x - media) ** 2 for x in intervalos) / len(intervalos)
+        desvio = max(math.sqrt(variancia), self.desvio_minimo)
+
+        # Aproximação logística da distribuição normal acumulada. y é limitado para
+        # que exp() não estoure; nesse limite phi já passa de qualquer limiar usado
+        y = min(max((agora - ultima - media) / desvio, -20.0), 20.0)
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if y > 0:
+            return -math.log10(e / (1.0 + e))
+        return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+    def suspeito(self, endereco, agora=None):
+        phi = self.phi(endereco, agora)
+        return phi is not None and phi > self.limiar_phi
+
+# ==========================================================================
+# Guarda os IDs das últimas mensagens de chat vistas (LRU), para que uma
+# mensagem repassada por mais de um caminho seja exibida uma única vez
+# ==========================================================================
+class MensagensVistas:
+    def __init__(self, capacidade=4096):
+        self.capacidade = capacidade
+        self.ids = OrderedDict()
+        self.lock = Lock()
+
+    def __contains__(self, id_mensagem):
+        with self.lock:
+            return id_mensagem in self.ids
+
+    # Registra o ID; retorna False se ele já tinha sido visto
+    def registrar(self, id_mensagem):
+        with self.lock:
+            if id_mensagem in self.ids:
+                self.ids.move_to_end(id_mensagem)
+                return False
+            self.ids[id_mensagem] = None
+            if len(self.ids) > self.capacidade:
+                self.ids.popitem(last=False)
+            return True
+
+# ==========================================================================
+# HISTÓRICO - log de mensagens de chat somente de acréscimo, dividido em
+# segmentos. Cada registro tem cabeçalho (seq, tamanho) e o JSON da
+# mensagem. Cada segmento tem um índice esparso (um par seq -> posição a
+# cada intervalo_indice bytes), guardado em memória e em um arquivo .idx,
+# e é lido por mmap. Quando o segmento ativo passa de tamanho_segmento, um
+# novo é aberto; os mais antigos são apagados quando o total passa de
+# limite_bytes ou de max_segmentos, então disco e memória ficam limitados
+# ==========================================================================
+CABECALHO_REGISTRO = struct.Struct("!QI")
+ENTRADA_INDICE = struct.Struct("!QQ")
+
+class Segmento:
+    def __init__(self, diretorio, base):
+        self.base = base  # seq do primeiro registro do segmento
+        self.caminho = os.path.join(diretorio, f"{base:020d}.log")
+        self.caminho_indice = os.path.join(diretorio, f"{base:020d}.idx")
+        self.indice = []  # pares (seq, posição), esparsos
+        self.proximo = base  # seq do próximo registro
+        self.tamanho = 0
+        self.arquivo = None  # aberto para acréscimo só no segmento ativo
+        self.arquivo_indice = None
+        self.mapa = None
+        self.ultimo_indexado = 0  # posição da última entrada do índice
+
+    # Reabre um segmento existente: carrega o índice e, a partir da última
+    # entrada dele, percorre os registros até o fim, descartando um registro
+    # incompleto (gravação interrompida por uma queda)
+    def carregar(self):
+        if os.path.exists(self.caminho_indice):
+            with open(self.caminho_indice, "rb") as arquivo:
+                dados = arquivo.read()
+            fim = len(dados) - len(dados) % ENTRADA_INDICE.size
+            self.indice = [ENTRADA_INDICE.unpack_from(dados, i) for i in range(0, fim, ENTRADA_INDICE.size)]
+        tamanho = os.path.getsize(self.caminho)
+        self.indice = [(seq, pos) for seq, pos in self.indice if pos < tamanho]
+        seq, pos = self.indice[-1] if self.indice else (self.base, 0)
+        self.ultimo_indexado = pos
+        with open(self.caminho, "rb") as arquivo:
+            arquivo.seek(pos)
+            while pos + CABECALHO_REGISTRO.size <= tamanho:
+                lido_seq, comprimento = CABECALHO_REGISTRO.unpack(arquivo.read(CABECALHO_REGISTRO.size))
+                if lido_seq != seq or pos + CABECALHO_REGISTRO.size + comprimento > tamanho:
+                    break
+                arquivo.seek(comprimento, os.SEEK_CUR)
+                pos += CABECALHO_REGISTRO.size + comprimento
+                seq += 1
+        self.proximo = seq
+        self.tamanho = pos
+        if pos < tamanho:
+            os.truncate(self.caminho, pos)
+
+    def abrir_para_escrita(self):
+        self.arquivo = open(self.caminho, "ab")
+        self.arquivo_indice = open(self.caminho_indice, "ab")
+
+    def acrescentar(self, corpo, intervalo_indice):
+        if self.tamanho - self.ultimo_indexado >= intervalo_indice:
+            self.indice.append((self.proximo, self.tamanho))
+            self.arquivo_indice.write(ENTRADA_INDICE.pack(self.proximo, self.tamanho))
+            self.arquivo_indice.flush()
+            self.ultimo_indexado = self.tamanho
+        self.arquivo.write(CABECALHO_REGISTRO.pack(self.proximo, len(corpo)) + corpo)
+        self.arquivo.flush()
+        self.tamanho += CABECALHO_REGISTRO.size + len(corpo)
+        self.proximo += 1
+
+    # Registros a partir de seq (até limite_bytes de corpo), lidos pelo mmap. O mapa do
+    # segmento ativo é refeito quando o arquivo cresceu desde o último mapeamento
+    def ler(self, seq, limite_bytes):
+        if self.tamanho == 0 or seq >= self.proximo:
+            return []
+        if self.mapa is None or len(self.mapa) < self.tamanho:
+            if self.mapa is not None:
+                self.mapa.close()
+            with open(self.caminho, "rb") as arquivo:
+                self.mapa = mmap.mmap(arquivo.fileno(), self.tamanho, access=mmap.ACCESS_READ)
+        i = bisect.bisect_right(self.indice, (seq, float("inf")))
+        atual, pos = self.indice[i - 1] if i else (self.base, 0)
+        registros = []
+        lidos = 0
+        while pos < self.tamanho and lidos < limite_bytes:
+            atual, comprimento = CABECALHO_REGISTRO.unpack_from(self.mapa, pos)
+            inicio = pos + CABECALHO_REGISTRO.size
+            if atual >= seq:
+                registros.append((atual, self.mapa[inicio:inicio + comprimento]))
+                lidos += comprimento
+            pos = inicio + comprimento
+        return registros
+
+    def fechar(self):
+        for arquivo in (self.arquivo, self.arquivo_indice, self.mapa):
+            if arquivo is not None:
+                arquivo.close()
+        self.arquivo = self.arquivo_indice = self.mapa = None
+
+    def apagar(self):
+        self.fechar()
+        for caminho in (self.caminho, self.caminho_indice):
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+
+class HistoricoChat:
+    def __init__(self, diretorio, tamanho_segmento=4 * 1024 * 1024, limite_bytes=64 * 1024 * 1024,
+                 max_segmentos=16, intervalo_indice=4096):
+        self.diretorio = diretorio
+        self.tamanho_segmento = tamanho_segmento
+        self.limite_bytes = limite_bytes
+        self.max_segmentos = max_segmentos
+        self.intervalo_indice = intervalo_indice
+        self.lock = Lock()
+        self.fechado = False
+        os.makedirs(diretorio, exist_ok=True)
+
+        # Identifica este log; as seqs só valem dentro dele (um peer que pede "desde"
+        # de outro log recebe só as últimas mensagens)
+        caminho_id = os.path.join(diretorio, "log.id")
+        if not os.path.exists(caminho_id):
+            with open(caminho_id, "w") as arquivo:
+                arquivo.write(os.urandom(8).hex())
+        with open(caminho_id) as arquivo:
+            self.identificador = arquivo.read().strip()
+        self.caminho_posicao = os.path.join(diretorio, "posicao")
+
+        bases = sorted(int(nome[:-4]) for nome in os.listdir(diretorio) if nome.endswith(".log"))
+        self.segmentos = [Segmento(diretorio, base) for base in bases]
+        for segmento in self.segmentos:
+            segmento.carregar()
+        if not self.segmentos:
+            self.segmentos.append(Segmento(diretorio, 1))
+        self.segmentos[-1].abrir_para_escrita()
+
+    def primeiro(self):
+        return self.segmentos[0].base
+
+    def ultimo(self):
+        return self.segmentos[-1].proximo - 1  # 0 se o log ainda está vazio
+
+    # Acrescenta uma mensagem (bytes) e retorna a seq atribuída a ela (None se o log já foi fechado)
+    def acrescentar(self, corpo):
+        with self.lock:
+            if self.fechado:
+                return None
+            ativo = self.segmentos[-1]
+            if ativo.tamanho >= self.tamanho_segmento:
+                ativo.fechar()
+                ativo = Segmento(self.diretorio, ativo.proximo)
+                ativo.abrir_para_escrita()
+                self.segmentos.append(ativo)
+                self.aplicar_retencao()
+            seq = ativo.proximo
+            ativo.acrescentar(corpo, self.intervalo_indice)
+            return seq
+
+    # Apaga os segmentos mais antigos (nunca o ativo) enquanto o log passar dos limites.
+    # As mensagens não têm chave, então compactar o log é descartar o começo dele
+    def aplicar_retencao(self):
+        while len(self.segmentos) > 1 and (
+            len(self.segmentos) > self.max_segmentos
+            or sum(s.tamanho for s in self.segmentos) > self.limite_bytes
+        ):
+            self.segmentos.pop(0).apagar()
+
+    # Lista de (seq, corpo) a partir de desde, com no máximo limite_bytes de corpos
+    def ler(self, desde, limite_bytes=TAMANHO_MAX_QUADRO // 2):
+        with self.lock:
+            desde = max(desde, self.primeiro())
+            bases = [s.base for s in self.segmentos]
+            registros = []
+            restante = limite_bytes
+            for segmento in self.segmentos[max(bisect.bisect_right(bases, desde) - 1, 0):]:
+                lidos = segmento.ler(max(desde, segmento.base), restante)
+                registros += lidos
+                restante -= sum(len(corpo) for _, corpo in lidos)
+                if restante <= 0:
+                    break
+            return registros
+
+    def ultimas(self, quantidade):
+        return self.ler(self.ultimo() - quantidade + 1)
+
+    # Posição ("log:seq") até onde o peer já recebeu o histórico de outro log, guardada
+    # para que, depois de reiniciar, ele peça ao coordenador só o que perdeu
+    def ler_posicao(self):
+        try:
+            with open(self.caminho_posicao) as arquivo:
+                log, _, seq = arquivo.read().strip().partition(":")
+            return (log, int(seq))
+        except (OSError, ValueError):
+            return None
+
+    def gravar_posicao(self, log, seq):
+        temporario = self.caminho_posicao + ".tmp"
+        with open(temporario, "w") as arquivo:
+            arquivo.write(f"{log}:{seq}")
+        os.replace(temporario, self.caminho_posicao)
+
+    def fechar(self):
+        with self.lock:
+            self.fechado = True
+            for segmento in self.segmentos:
+                segmento.fechar()
+
+# ==========================================================================
+# Pool limitado de trabalhadores que tratam as mensagens recebidas. Cada
+# prioridade tem sua própria fila limitada; os trabalhadores sempre atendem
+# primeiro a fila mais urgente e há um trabalhador reservado só para as
+# mensagens de controle. A fila de membros é tratada uma mensagem por vez,
+# para que UPDATE, MAP_UPDATE e EXIT sejam aplicados na ordem de chegada
+# ==========================================================================
+class PoolTrabalhadores:
+    def __init__(self, num_trabalhadores=4, tamanho_fila=1024, espera_max=1.0):
+        self.tamanho_fila = tamanho_fila  # limite de mensagens aguardando em cada fila
+        self.espera_max = espera_max  # tempo máximo (s) que quem submete espera por espaço na fila
+        self.num_trabalhadores = num_trabalhadores
+        self.filas = [deque() for _ in NOMES_PRIORIDADES]
+        self.exclusivas = {PRIORIDADE_MEMBROS}  # filas tratadas por um trabalhador de cada vez
+        self.em_execucao = [0] * len(NOMES_PRIORIDADES)
+        self.cond = Condition()
+
+        # Métricas
+        self.processadas = [0] * len(NOMES_PRIORIDADES)
+        self.descartadas = [0] * len(NOMES_PRIORIDADES)
+        self.maior_profundidade = [0] * len(NOMES_PRIORIDADES)
+
+        for _ in range(num_trabalhadores):
+            Thread(target=self.trabalhar, args=(range(len(NOMES_PRIORIDADES)),), daemon=True).start()
+        # Trabalhador reservado: mensagens de controle nunca ficam presas atrás das demais
+        Thread(target=self.trabalhar, args=((PRIORIDADE_CONTROLE,),), daemon=True).start()
+
+    # ==========================================================================
+    # Coloca uma tarefa na fila da prioridade indicada. Se a fila estiver cheia,
+    # espera (segurando quem está lendo a conexão) até espera_max segundos e,
+    # depois disso, descarta a tarefa e retorna False
+    # ==========================================================================
+    def submeter(self, prioridade, funcao, *args):
+        fila = self.filas[prioridade]
+        with self.cond:
+            limite = relogio.time() + self.espera_max
+            while len(fila) >= self.tamanho_fila:
+                restante = limite - relogio.time()
+                if restante <= 0:
+                    self.descartadas[prioridade] += 1
+                    return False
+                self.cond.wait(restante)
+            fila.append((funcao, args))
+            if len(fila) > self.maior_profundidade[prioridade]:
+                self.maior_profundidade[prioridade] = len(fila)
+            self.cond.notify_all()
+        return True
+
+    def proxima(self, prioridades):
+        for prioridade in prioridades:
+            if self.filas[prioridade] and not (prioridade in self.exclusivas and self.em_execucao[prioridade]):
+                return prioridade
+        return None
+
+    def trabalhar(self, prioridades):
+        while True:
+            with self.cond:
+                prioridade = self.proxima(prioridades)
+                while prioridade is None:
+                    self.cond.wait()
+                    prioridade = self.proxima(prioridades)
+                funcao, args = self.filas[prioridade].popleft()
+                self.em_execucao[prioridade] += 1
+                self.cond.notify_all()
+            try:
+                funcao(*args)
+            except Exception as e:
+                log.error(f"[ERRO SERVIDOR] {e}")
+            finally:
+                with self.cond:
+                    self.em_execucao[prioridade] -= 1
+                    self.processadas[prioridade] += 1
+                    self.cond.notify_all()
+
+    # ============================================================
+    # Profundidade das filas e contadores, por prioridade
+    # ============================================================
+    def metricas(self):
+        with self.cond:
+            return {
+                "trabalhadores": self.num_trabalhadores,
+                "profundidade": {n: len(self.filas[i]) for i, n in enumerate(NOMES_PRIORIDADES)},
+                "maior_profundidade": dict(zip(NOMES_PRIORIDADES, self.maior_profundidade)),
+                "em_execucao": dict(zip(NOMES_PRIORIDADES, self.em_execucao)),
+                "processadas": dict(zip(NOMES_PRIORIDADES, self.processadas)),
+                "descartadas": dict(zip(NOMES_PRIORIDADES, self.descartadas)),
+            }
+
+# ==========================================================================
+# Disjuntor de um destino: depois de falhas_max envios seguidos com falha,
+# abre e, por espera segundos, nenhum envio é tentado (os quadros para o
+# destino são recusados na hora). Passada a espera, o próximo envio é uma
+# tentativa: se der certo, o disjuntor fecha; se falhar, abre de novo com
+# o dobro da espera (até espera_max)
+# ==========================================================================
+class Disjuntor:
+    def __init__(self, falhas_max=3, espera=0.5, espera_max=5.0):
+        self.falhas_max = falhas_max
+        self.espera_inicial = espera
+        self.espera_max = espera_max
+        self.espera = espera  # próxima espera, dobrada a cada abertura seguida
+        self.falhas = 0  # envios seguidos com falha
+        self.aberto_ate = 0.0  # momento (relogio.monotonic()) até o qual nenhum envio é tentado
+        self.aberturas = 0
+
+    def permite(self, agora):
+        return agora >= self.aberto_ate
+
+    def estado(self, agora):
+        if agora < self.aberto_ate:
+            return "aberto"
+        return "meio_aberto" if self.falhas >= self.falhas_max else "fechado"
+
+    def sucesso(self):
+        self.falhas = 0
+        self.espera = self.espera_inicial
+
+    # Retorna True se o disjuntor abriu com esta falha
+    def falha(self, agora):
+        self.falhas += 1
+        if self.falhas < self.falhas_max:
+            return False
+        self.abrir(agora)
+        return True
+
+    def abrir(self, agora):
+        self.aberto_ate = agora + self.espera
+        self.espera = min(self.espera * 2, self.espera_max)
+        self.aberturas += 1
+
+# ==========================================================================
+# Transbordo em disco de uma fila de saída (política "disco"): os quadros
+# que não cabem na fila vão, na ordem, para um arquivo (tamanho, momento em
+# que entraram e quadro) e voltam para a fila quando ela esvazia. O arquivo
+# volta a zero sempre que é lido até o fim
+# ==========================================================================
+CABECALHO_TRANSBORDO = struct.Struct("!Id")
+
+class Transbordo:
+    def __init__(self, caminho, limite_bytes=64 * 1024 * 1024):
+        self.caminho = caminho
+        self.limite_bytes = limite_bytes  # quadros além disso são descartados
+        self.arquivo = open(caminho, "w+b")
+        self.leitura = 0  # posição do próximo quadro a ler
+        self.escrita = 0  # fim do arquivo
+        self.quadros = 0  # quadros guardados e ainda não lidos
+
+    @property
+    def bytes(self):
+        return self.escrita - self.leitura
+
+    def guardar(self, quadro, momento):
+        if self.bytes + len(quadro) > self.limite_bytes:
+            return False
+        self.arquivo.seek(self.escrita)
+        self.arquivo.write(CABECALHO_TRANSBORDO.pack(len(quadro), momento) + quadro)
+        self.escrita = self.arquivo.tell()
+        self.quadros += 1
+        return True
+
+    # Lê os próximos quadros, até limite_bytes (pelo menos um), com o momento em que
+    # entraram na fila
+    def ler(self, limite_bytes):
+        self.arquivo.seek(self.leitura)
+        lidos = []
+        tamanho = 0
+        while self.quadros and (not lidos or tamanho < limite_bytes):
+            n, momento = CABECALHO_TRANSBORDO.unpack(self.arquivo.read(CABECALHO_TRANSBORDO.size))
+            lidos.append((self.arquivo.read(n), momento))
+            tamanho += n
+            self.quadros -= 1
+        self.leitura = self.arquivo.tell()
+        if not self.quadros:
+            self.arquivo.seek(0)
+            self.arquivo.truncate()
+            self.leitura = self.escrita = 0
+        return lidos
+
+    def fechar(self):
+        self.arquivo.close()
+        try:
+            os.remove(self.caminho)
+        except OSError:
+            pass
+
+# ==========================================================================
+# Fila de saída de um destino: os quadros esperando envio (com o momento em
+# que entraram na fila) e as métricas de envio daquele destino. Os créditos
+# do destino são os bytes que podem estar pendentes para ele (na fila ou em
+# envio); o crédito de um lote só volta quando o destino aceita os dados
+# (o envio termina), então segue a janela TCP de quem recebe: um peer que
+# lê devagar esgota os próprios créditos sem atrasar os outros destinos
+# ==========================================================================
+class FilaSaida:
+    def __init__(self):
+        self.quadros = deque()  # (quadro, momento em que entrou na fila)
+        self.bytes = 0  # total de bytes esperando envio
+        self.em_voo = 0  # bytes do lote em envio (créditos ainda não devolvidos)
+        self.transbordo = None  # Transbordo (política "disco"), criado quando a fila transborda
+        self.enviadas = 0
+        self.lotes = 0
+        self.descartadas = 0
+        self.transbordadas = 0  # quadros que passaram pelo disco
+        self.desconexoes = 0  # vezes em que o destino foi desconectado por lentidão
+        self.latencia_total = 0.0
+        self.latencia_max = 0.0
+        self.em_envio = False  # um lote retirado desta fila está sendo enviado
+        self.ultimo_progresso = relogio.monotonic()  # fim do último envio (ou criação da fila)
+
+    def adicionar(self, quadro, momento=None):
+        self.quadros.append((quadro, relogio.monotonic() if momento is None else momento))
+        self.bytes += len(quadro)
+
+    # Cabe mais um quadro: a fila tem menos de limite_fila quadros e sobram créditos
+    # (uma fila vazia sempre aceita um quadro, mesmo maior que os créditos)
+    def tem_espaco(self, quadro, limite_fila, limite_creditos):
+        if len(self.quadros) >= limite_fila:
+            return False
+        return not self.quadros or self.bytes + self.em_voo + len(quadro) <= limite_creditos
+
+    def descartar_primeiro(self):
+        quadro, _ = self.quadros.popleft()
+        self.bytes -= len(quadro)
+        self.descartadas += 1
+
+    def descartar_todos(self):
+        self.descartadas += len(self.quadros)
+        self.quadros.clear()
+        self.bytes = 0
+        if self.transbordo is not None:
+            self.descartadas += self.transbordo.quadros
+            self.fechar_transbordo()
+
+    # Traz de volta do disco os próximos quadros quando a fila esvazia. Retorna True
+    # se há quadros na fila
+    def recarregar(self, limite_bytes):
+        if not self.quadros and self.transbordo is not None and self.transbordo.quadros:
+            for quadro, momento in self.transbordo.ler(limite_bytes):
+                self.adicionar(quadro, momento)
+        return bool(self.quadros)
+
+    def fechar_transbordo(self):
+        if self.transbordo is not None:
+            self.transbordo.fechar()
+            self.transbordo = None
+
+    # Retira quadros do início da fila até limite_bytes (pelo menos um). Um quadro sozinho
+    # é enviado como está; dois ou mais viram um quadro TIPO_LOTE
+    def retirar_lote(self, limite_bytes):
+        primeiro = self.quadros[0][1]
+        partes = []
+        tamanho = 0
+        while self.quadros and (not partes or tamanho + len(self.quadros[0][0]) <= limite_bytes):
+            quadro, _ = self.quadros.popleft()
+            partes.append(quadro)
+            tamanho += len(quadro)
+        self.bytes -= tamanho
+        self.em_voo = tamanho
+        if len(partes) == 1:
+            return partes[0], 1, primeiro
+        return codificar_quadro(TIPO_LOTE, b"".join(partes)), len(partes), primeiro
+
+    # A latência de envio é medida do momento em que o quadro mais antigo do lote
+    # entrou na fila até o fim do envio
+    def registrar_envio(self, quantidade, primeiro):
+        self.ultimo_progresso = relogio.monotonic()
+        latencia = self.ultimo_progresso - primeiro
+        self.em_voo = 0
+        self.enviadas += quantidade
+        self.lotes += 1
+        self.latencia_total += latencia
+        self.latencia_max = max(self.latencia_max, latencia)
+
+    def metricas(self):
+        return {
+            "fila": len(self.quadros),
+            "bytes": self.bytes,
+            "em_voo": self.em_voo,
+            "transbordo_bytes": self.transbordo.bytes if self.transbordo is not None else 0,
+            "enviadas": self.enviadas,
+            "lotes": self.lotes,
+            "descartadas": self.descartadas,
+            "transbordadas": self.transbordadas,
+            "desconexoes": self.desconexoes,
+            "latencia_media_ms": self.latencia_total / self.lotes * 1000 if self.lotes else 0.0,
+            "latencia_max_ms": self.latencia_max * 1000,
+        }
+
+# ==========================================================================
+# Envio em lotes (no estilo do algoritmo de Nagle): cada destino tem sua
+# fila de saída e uma thread que a esvazia. A thread espera até janela
+# segundos depois da chegada do primeiro quadro (ou até juntar limite_bytes)
+# e envia tudo o que estiver na fila em um único quadro. A thread de um
+# destino termina após tempo_ocioso segundos sem nada para enviar.
+# Um destino sem espaço (limite_fila quadros ou limite_creditos bytes
+# pendentes) é um consumidor lento, tratado conforme a política:
+# - "descartar_antigas" (padrão): os quadros mais antigos da fila são
+#   descartados;
+# - "esperar": quem envia espera até espera_max segundos por espaço e,
+#   depois disso, o quadro é descartado;
+# - "desconectar": se o destino não termina um envio há espera_max
+#   segundos, a fila é descartada, a conexão é fechada e o disjuntor do
+#   destino abre (nada é enviado a ele durante a espera do disjuntor);
+#   antes disso, só o quadro novo é descartado;
+# - "disco": os quadros vão para um arquivo (Transbordo) e voltam para a
+#   fila, na ordem, quando ela esvazia.
+# Só "esperar" segura quem envia; nas outras, um destino lento nunca atrasa
+# os envios para os demais. Cada destino também tem um disjuntor (Disjuntor)
+# que para de tentar conectar a quem falha seguidamente
+# ==========================================================================
+POLITICAS_LENTOS = ("esperar", "descartar_antigas", "desconectar", "disco")
+
+class EnviadorLotes:
+    def __init__(self, enviar, janela=0.002, limite_bytes=64 * 1024, limite_fila=1024, espera_max=1.0, tempo_ocioso=60,
+                 politica="descartar_antigas", limite_creditos=1024 * 1024, diretorio_transbordo=None,
+                 limite_transbordo=64 * 1024 * 1024, falhas_disjuntor=3, espera_disjuntor=0.5,
+                 espera_max_disjuntor=5.0, desconectar=None):
+        if politica not in POLITICAS_LENTOS:
+            raise ValueError(f"Política para consumidores lentos desconhecida: {politica}")
+        self.enviar = enviar  # função (ip, porta, quadro) que faz o envio de fato; False = falhou
+        self.janela = janela
+        self.limite_bytes = limite_bytes
+        self.limite_fila = limite_fila  # limite de quadros esperando em cada fila
+        self.espera_max = espera_max
+        self.tempo_ocioso = tempo_ocioso
+        self.politica = politica
+        self.limite_creditos = limite_creditos  # bytes pendentes (na fila ou em envio) por destino
+        self.diretorio_transbordo = diretorio_transbordo  # None = diretório temporário
+        self.limite_transbordo = limite_transbordo
+        self.falhas_disjuntor = falhas_disjuntor
+        self.espera_disjuntor = espera_disjuntor
+        self.espera_max_disjuntor = espera_max_disjuntor
+        self.desconectar = desconectar  # função (destino) que fecha a conexão com o destino (opcional)
+        self.filas = {}  # mapeia (ip, porta) -> FilaSaida
+        self.disjuntores = {}  # mapeia (ip, porta) -> Disjuntor
+        self.condicoes = {}  # mapeia (ip, porta) -> Condition da fila (todas usam self.lock)
+        self.ativos = set()  # destinos com uma thread esvaziando a fila
+        self.lock = Lock()
+        self.ocioso = Condition(self.lock)  # avisado ao fim de cada envio (ver aguardar)
+
+    def criar_fila(self, destino):
+        fila = self.filas[destino] = FilaSaida()
+        self.disjuntores[destino] = Disjuntor(self.falhas_disjuntor, self.espera_disjuntor, self.espera_max_disjuntor)
+        return fila
+
+    # ==========================================================================
+    # Decide, sem bloquear, o que fazer com um quadro para o destino: "fila" (entra
+    # na fila), "disco" (já foi guardado no transbordo), "esperar" (sem espaço, na
+    # política "esperar") ou "descartado". Também usado pelo AsyncPeer
+    # ==========================================================================
+    def admitir(self, destino, fila, quadro):
+        if not self.disjuntores[destino].permite(relogio.monotonic()):
+            fila.descartadas += 1
+            return "descartado"
+        # Com quadros no disco, os novos também vão para o disco, para manter a ordem
+        if fila.transbordo is not None and fila.transbordo.quadros:
+            return self.transbordar(destino, fila, quadro)
+        if fila.tem_espaco(quadro, self.limite_fila, self.limite_creditos):
+            return "fila"
+
+        if self.politica == "esperar":
+            return "esperar"
+        if self.politica == "descartar_antigas":
+            while not fila.tem_espaco(quadro, self.limite_fila, self.limite_creditos):
+                fila.descartar_primeiro()
+            return "fila"
+        if self.politica == "disco":
+            return self.transbordar(destino, fila, quadro)
+        if relogio.monotonic() - fila.ultimo_progresso >= self.espera_max:
+            self.desconectar_lento(destino, fila)
+        fila.descartadas += 1
+        return "descartado"
+
+    def transbordar(self, destino, fila, quadro):
+        if fila.transbordo is None:
+            if self.diretorio_transbordo is None:
+                self.diretorio_transbordo = tempfile.mkdtemp(prefix="transbordo-")
+            os.makedirs(self.diretorio_transbordo, exist_ok=True)
+            caminho = os.path.join(self.diretorio_transbordo, f"{destino[0]}-{destino[1]}.fila")
+            fila.transbordo = Transbordo(caminho, self.limite_transbordo)
+        if not fila.transbordo.guardar(quadro, relogio.monotonic()):
+            fila.descartadas += 1
+            return "descartado"
+        fila.transbordadas += 1
+        return "disco"
+
+    def desconectar_lento(self, destino, fila):
+        fila.descartar_todos()
+        fila.desconexoes += 1
+        self.disjuntores[destino].abrir(relogio.monotonic())
+        log.warning(f"[ALERTA] Destino {destino[0]}:{destino[1]} lento demais; desconectado.",
+                    extra={"evento": "consumidor_lento"})
+        if self.desconectar is not None:
+            self.desconectar(destino)
+
+    # Resultado de um envio: False abre o disjuntor depois de falhas seguidas, e a fila
+    # do destino (que não vai receber nada enquanto ele estiver aberto) é descartada
+    def registrar_resultado(self, destino, fila, enviado):
+        disjuntor = self.disjuntores[destino]
+        if enviado is False:
+            if disjuntor.falha(relogio.monotonic()):
+                fila.descartar_todos()
+                log.warning(f"[ALERTA] Envios para {destino[0]}:{destino[1]} falhando; disjuntor aberto.",
+                            extra={"evento": "disjuntor_aberto"})
+        else:
+            disjuntor.sucesso()
+
+    # ==========================================================================
+    # Coloca o quadro na fila do destino. Retorna False se ele foi descartado
+    # ==========================================================================
+    def enfileirar(self, destino, quadro):
+        with self.lock:
+            fila = self.filas.get(destino)
+            if fila is None:
+                fila = self.criar_fila(destino)
+                self.condicoes[destino] = Condition(self.lock)
+            condicao = self.condicoes[destino]
+
+            limite = relogio.monotonic() + self.espera_max
+            admissao = self.admitir(destino, fila, quadro)
+            while admissao == "esperar":
+                restante = limite - relogio.monotonic()
+                if restante <= 0:
+                    fila.descartadas += 1
+                    return False
+                condicao.wait(restante)
+                admissao = self.admitir(destino, fila, quadro)
+            if admissao == "descartado":
+                return False
+
+            if admissao == "fila":
+                fila.adicionar(quadro)
+            if destino in self.ativos:
+                condicao.notify_all()
+            else:
+                self.ativos.add(destino)
+                Thread(target=self.esvaziar, args=(destino, fila, condicao), daemon=True).start()
+        return True
+
+    def esvaziar(self, destino, fila, condicao):
+        while True:
+            with self.lock:
+                if not fila.recarregar(self.limite_bytes):
+                    condicao.wait(self.tempo_ocioso)
+                    if not fila.recarregar(self.limite_bytes):
+                        self.ativos.discard(destino)
+                        fila.fechar_transbordo()
+                        return
+
+                # Espera a janela de agrupamento, a não ser que o lote já esteja cheio
+                prazo = fila.quadros[0][1] + self.janela
+                while fila.bytes < self.limite_bytes:
+                    restante = prazo - relogio.monotonic()
+                    if restante <= 0:
+                        break
+                    condicao.wait(restante)
+                if not fila.quadros:
+                    continue  # a fila foi descartada durante a espera (desconectar, disjuntor)
+
+                lote, quantidade, primeiro = fila.retirar_lote(self.limite_bytes)
+                fila.em_envio = True
+                condicao.notify_all()  # libera quem esperava espaço na fila
+
+            enviado = False
+            try:
+                enviado = self.enviar(destino[0], destino[1], lote)
+            except Exception as e:
+                log.error(f"[ERRO CLIENTE] {e}")
+            with self.lock:
+                fila.registrar_envio(quantidade, primeiro)
+                fila.em_envio = False
+                self.registrar_resultado(destino, fila, enviado)
+                condicao.notify_all()  # os créditos do lote voltaram
+                self.ocioso.notify_all()
+
+    # Espera (até timeout segundos) todas as filas serem enviadas. Usado ao sair do chat
+    def aguardar(self, timeout=5.0):
+        limite = relogio.monotonic() + timeout
+        with self.lock:
+            while any(fila.quadros or fila.em_envio or (fila.transbordo is not None and fila.transbordo.quadros)
+                      for fila in self.filas.values()):
+                restante = limite - relogio.monotonic()
+                if restante <= 0:
+                    return False
+                self.ocioso.wait(restante)
+        return True
+
+    # ============================================================
+    # Tamanho da fila, latência de envio e estado do disjuntor, por destino
+    # ============================================================
+    def metricas(self):
+        agora = relogio.monotonic()
+        with self.lock:
+            metricas = {}
+            for (ip, porta), fila in self.filas.items():
+                metricas[f"{ip}:{porta}"] = fila.metricas()
+                metricas[f"{ip}:{porta}"]["disjuntor"] = self.disjuntores[(ip, porta)].estado(agora)
+            return metricas
+
+    # Apaga os arquivos de transbordo (ao sair do chat)
+    def fechar(self):
+        with self.lock:
+            for fila in self.filas.values():
+                fila.fechar_transbordo()
+
+# =======================================================================
+# Abre o socket de escuta de um peer (bind e listen). Com porta 0, o
+# sistema escolhe uma porta livre (socket.getsockname() informa qual)
+# =======================================================================
+def abrir_servidor(ip, porta, backlog=128):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind((ip, porta))
+        s.listen(backlog)
+    except OSError:
+        s.close()
+        raise
+    return s
+
+# =======================================================================
+# Transporte: como o peer ouve e abre conexões. O TransporteTCP usa os
+# sockets do sistema; outro transporte (ex.: a rede simulada de
+# simulador.py) pode ser passado ao peer com transporte=. Os métodos
+# síncronos servem a classe Peer (os objetos devolvidos seguem a
+# interface de socket usada por ela: accept, sendall, recv, close...) e
+# os assíncronos servem a classe AsyncPeer (StreamReader/StreamWriter)
+# =======================================================================
+class TransporteTCP:
+    def ouvir(self, ip, porta, backlog=128):
+        return abrir_servidor(ip, porta, backlog)
+
+    def conectar(self, endereco, timeout=5):
+        s = socket.create_connection(endereco, timeout=timeout)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return s
+
+    # Servidor asyncio que chama tratar(reader, writer) para cada conexão; sock é um
+    # socket de escuta já aberto (porta 0 ou aberto por quem criou o peer)
+    async def ouvir_async(self, tratar, ip, porta, backlog=128, sock=None):
+        import asyncio  # só carrega asyncio quando usado (AsyncPeer)
+        if sock is not None:
+            return await asyncio.start_server(tratar, sock=sock)
+        return await asyncio.start_server(tratar, ip, porta, backlog=backlog)
+
+    async def conectar_async(self, endereco):
+        import asyncio
+        return await asyncio.open_connection(*endereco)
+
 # =======================================================================
 # Classe usada para representar e gerenciar peers, incluindo comunicação,
 # coordenação, eleição e monitoramento por heartbeat
@@ -17,349 +1773,1212 @@ class Peer:
     # ============================================================
     # Construtor da classe Peer
     # ============================================================
-    def __init__(self, nome, ip, porta):
+    def __init__(self, nome, ip, porta, usar_pool=False, trabalhadores=4, backlog=128, membros_delta=True,
+                 intervalo_heartbeat=5.0, limiar_phi=8.0, timeout_eleicao=1.0, tentativas_eleicao=2,
+                 espera_coordenador=3.0, rodadas_eleicao=2, disseminacao="direta", fanout=3,
+                 janela_envio=0.002, limite_lote=64 * 1024, limite_fila_envio=1024, politica_lenta="descartar_antigas",
+                 limite_creditos=1024 * 1024, diretorio_transbordo=None, falhas_disjuntor=3,
+                 arquivo_metricas=None, intervalo_metricas=10.0, diretorio_historico=None, historico_join=100,
+                 processos_recepcao=0, formatos=FORMATOS_SUPORTADOS, limite_compressao=1024,
+                 socket_servidor=None, transporte=None):
+        # O socket de escuta é aberto uma única vez: por quem cria o peer (socket_servidor),
+        # aqui mesmo quando a porta é 0 (escolhida pelo sistema, que o peer precisa saber
+        # antes de se identificar) ou em inicia_servidor
+        if processos_recepcao and (porta == 0 or socket_servidor is not None):
+            raise ValueError("A recepção em vários processos precisa de uma porta fixa (cada processo abre o próprio socket).")
+        self.transporte = transporte if transporte is not None else TransporteTCP()  # ver TransporteTCP
+        if porta == 0 and socket_servidor is None:
+            socket_servidor = self.transporte.ouvir(ip, 0, backlog)
+        if socket_servidor is not None:
+            porta = socket_servidor.getsockname()[1]
         self.nome = nome  # nome de usuário do peer
         self.ip = ip  # endereço IP do peer (sempre 'localhost' neste programa)
         self.porta = porta  # porta do peer (cada peer deve ter uma porta diferente)
         self.id = None  # identificador único do peer dentro do chat atual (atribuído pelo coordenador)
-        self.coordenador = False  # verifica se o próprio peer (self) é coordenador
-        self.peers = []  # lista de (ip, porta)
-        self.mapa_ids = {}  # mapeia (ip, porta) -> id
-        self.mapa_nomes = {}  # mapeia (ip, porta) -> nome
-        self.proximo_id = 1  # usado apenas pelo coordenador para atribuir IDs únicos a novos peers
-        self.ultima_atividade = {}  # mapeia (ip, porta) -> momento (time.time()) da última atividade
-        self.server_socket = None  # socket de servidor do peer
-        self.coordenador_atual = None  # salva o coordenador atual de um chat
-        self.em_eleicao = False  # verifica se o peer está em eleição no momento
+        self.endereco = (ip, porta)
+        self.papel = Papel()  # coordenador atual, se é este peer e se há eleição (ver Papel)
+        self.membros = TabelaMembros()  # membros do chat (endereço, ID, nome e última atividade)
+        self.proximo_id = 0  # usado apenas pelo coordenador para atribuir IDs únicos (ver gerar_id)
+        self.server_socket = socket_servidor  # socket de servidor do peer
+        self.processos_recepcao = processos_recepcao  # processos que leem as conexões (ver recepcao.py); 0 = nenhum
+        self.recepcao = None
+        self.ativo = True  # passa a False em parar(); encerra o servidor e as rotinas do peer
+        self.pronto = Event()  # sinalizado quando o servidor já está ouvindo (ou falhou ao abrir)
+        self.conexoes_recebidas = set()  # sockets das conexões aceitas que estão abertas
+        if _ouvinte_log is None:
+            configurar_log()
+        self.log = LogPeer(log, {"peer": f"{nome}@{ip}:{porta}"})
+        self.metricas = Metricas()  # contadores e histogramas (ver exportar_metricas)
+        self.arquivo_metricas = arquivo_metricas  # se informado, as métricas são gravadas nele periodicamente
+        self.intervalo_metricas = intervalo_metricas
+        self.saudacao = codificar_quadro(TIPO_HELLO, f"{ip} {porta}")  # identifica o peer em cada conexão aberta
+        self.pool = PoolConexoes(saudacao=self.saudacao, metricas=self.metricas, transporte=self.transporte) if usar_pool else None  # conexões persistentes com os outros peers (opcional)
+        self.num_trabalhadores = trabalhadores  # trabalhadores que tratam as mensagens recebidas
+        self.backlog = backlog  # tamanho da fila de conexões pendentes do servidor (listen)
+        self.trabalhadores = None  # PoolTrabalhadores, criado ao iniciar o servidor
+        # Filas de saída por destino; os quadros enviados sem esperar resposta são agrupados.
+        # politica_lenta diz o que fazer com um destino que não dá conta (ver EnviadorLotes)
+        self.enviador = EnviadorLotes(self.cliente, janela_envio, limite_lote, limite_fila_envio,
+                                      politica=politica_lenta, limite_creditos=limite_creditos,
+                                      diretorio_transbordo=diretorio_transbordo,
+                                      falhas_disjuntor=falhas_disjuntor, desconectar=self.desconectar_destino)
+
+        # Versão da lista de membros: a época muda a cada novo coordenador e a sequência a
+        # cada entrada/saída. Com membros_delta, o coordenador envia só o que mudou (DELTA)
+        # e UPDATE/MAP_UPDATE ficam como alternativa quando um peer perde alguma alteração
+        self.membros_delta = membros_delta
+        self.epoca = 0
+        self.seq_membros = 0
+        self.deltas_pendentes = {}  # mapeia seq -> delta recebido fora de ordem
+        self.espera_delta = 1.0  # tempo (s) esperando um delta atrasado antes de pedir o estado completo
+        # No coordenador: tabela de membros de cada uma das últimas versões (inclusive a que
+        # ele tinha antes de assumir), para responder a SYNC_REQUEST só com a diferença
+        self.versoes_membros = OrderedDict()  # mapeia (epoca, seq) -> VersaoMembros
+        self.versoes_guardadas = 64
+
+        # Heartbeat e detecção de falhas. Qualquer mensagem recebida de um peer conta como
+        # sinal de vida, e não é enviado heartbeat a quem já recebeu outra mensagem há pouco
+        self.intervalo_heartbeat = intervalo_heartbeat
+        self.intervalo_verificacao = intervalo_heartbeat / 2.5  # de quanto em quanto tempo (s) o detector é consultado
+        self.detector = DetectorFalhas(intervalo_heartbeat, limiar_phi, relogio=lambda: relogio.time())
+        self.ultimo_envio = {}  # mapeia (ip, porta) -> momento (relogio.time()) do último envio bem-sucedido
+        self.ultimo_heartbeat = {}  # mapeia (ip, porta) -> momento do último HEARTBEAT recebido (métrica)
+
+        # Eleição (valentão) com tempo máximo: cada ELECTION é tentado até tentativas_eleicao
+        # vezes com timeout_eleicao por tentativa, o OK é esperado por timeout_eleicao e o
+        # COORDINATOR por espera_coordenador, em no máximo rodadas_eleicao rodadas
+        self.timeout_eleicao = timeout_eleicao
+        self.tentativas_eleicao = tentativas_eleicao
+        self.espera_coordenador = espera_coordenador
+        self.rodadas_eleicao = rodadas_eleicao
+        self.lock_eleicao = Lock()  # torna atômicas as trocas de papel (início e fim de eleição, novo coordenador)
+        self.ok_eleicao = Event()  # sinalizado quando chega um OK de um candidato
+        self.coordenador_eleito = Event()  # sinalizado quando chega um COORDINATOR
+        self.inicio_eleicao = None  # momento (relogio.time()) em que a eleição atual começou
+        self.duracao_eleicao = None  # duração (s) da última eleição concluída por este peer
+
+        # Disseminação das mensagens de chat: "direta" (o autor envia a todos), "arvore"
+        # (repasse pela árvore de membros com raiz no coordenador, com até fanout filhos
+        # por nó), "gossip" (cada peer repassa a fanout peers sorteados) ou "ordenada"
+        # (o coordenador numera as mensagens e todos as exibem na mesma ordem)
+        if disseminacao not in ("direta", "arvore", "gossip", "ordenada"):
+            raise ValueError(f"Modo de disseminação desconhecido: {disseminacao}")
+        self.disseminacao = disseminacao
+        self.fanout = fanout
+        self.arvore_calculada = (None, None, ())  # (versão da tabela, coordenador, vizinhos na árvore)
+        self.mensagens_vistas = MensagensVistas()
+        self.sessao = int(relogio.time() * 1000)  # diferencia os IDs de mensagem entre execuções
+        self.seq_chat = 0
+
+        # Ordem total (disseminacao="ordenada"): o coordenador numera as mensagens em lotes
+        # e cada peer exibe na ordem das seqs, guardando as que chegam adiantadas e pedindo
+        # de novo as que faltam. Todos guardam as últimas mensagens entregues, para que um
+        # novo coordenador possa continuar a numeração e atender retransmissões
+        self.lock_ordem = Lock()
+        self.proximo_entregar = 1  # seq da próxima mensagem a exibir
+        self.proximo_seq = 1  # no coordenador: seq da próxima mensagem a numerar
+        self.ordem_pendente = {}  # mapeia seq -> mensagem recebida antes das anteriores
+        self.ordem_recentes = OrderedDict()  # mapeia seq -> mensagem, para as últimas entregues
+        self.capacidade_recentes = 4096
+        self.pedidos_ordem = []  # no coordenador: mensagens esperando o próximo lote
+        self.ids_pedidos = set()
+        self.aguardando_ordem = OrderedDict()  # mapeia id -> [mensagem, eco, instante do pedido], para as próprias
+        self.espera_ordem = 1.0  # tempo (s) antes de pedir de novo uma mensagem que não chegou
+        self.lacuna_ordem_agendada = False
+        self.sincronizando_ordem = False  # no novo coordenador, até reunir o estado dos outros peers
+        self.maior_seq_sincronizacao = 0
+        self.menor_seq_sincronizacao = 0
+
+        # Formatos dos corpos de membros (ver codificar_membros) que este peer aceita. O
+        # coordenador guarda os que cada peer informou no JOIN (e no SYNC_REQUEST, para que
+        # um novo coordenador também saiba) e usa com ele os que os dois aceitam
+        self.formatos = tuple(formatos)
+        self.limite_compressao = limite_compressao
+        self.formatos_peers = {}  # mapeia (ip, porta) -> formatos combinados com aquele peer
+
+        # Histórico das mensagens de chat em disco (opcional). Quem entra na sala recebe do
+        # coordenador as últimas historico_join mensagens, ou tudo desde a última que já tinha
+        self.historico = HistoricoChat(diretorio_historico) if diretorio_historico else None
+        self.historico_join = historico_join
+        self.posicao_historico = None  # (log, seq) da última mensagem recebida do histórico do coordenador
+        if self.historico is not None:
+            self.posicao_historico = self.historico.ler_posicao()
+            # As mensagens já guardadas não são exibidas de novo quando chegarem pelo histórico
+            for _, registro in self.historico.ultimas(self.mensagens_vistas.capacidade):
+                self.mensagens_vistas.registrar(json.loads(registro)["id"])
+
+        # Tratador de cada tipo de mensagem recebida
+        self.tratadores = {
+            TIPO_TEXTO: self.tratar_texto,
+            TIPO_JOIN: self.tratar_join,
+            TIPO_UPDATE: self.tratar_update,
+            TIPO_HEARTBEAT: self.tratar_heartbeat,
+            TIPO_START_ELECTION: self.tratar_start_election,
+            TIPO_ELECTION: self.tratar_eleicao,
+            TIPO_OK: self.tratar_ok,
+            TIPO_COORDINATOR: self.tratar_novo_coordenador,
+            TIPO_REMOVE_COORDINATOR: self.tratar_remove_coordinator,
+            TIPO_MAP_UPDATE: self.tratar_map_update,
+            TIPO_EXIT: self.tratar_exit,
+            TIPO_DELTA: self.tratar_delta,
+            TIPO_SYNC_REQUEST: self.tratar_sync_request,
+            TIPO_CHAT: self.tratar_chat,
+            TIPO_STATS: self.tratar_stats,
+            TIPO_HISTORICO: self.tratar_historico,
+            TIPO_SEQ_PEDIDO: self.tratar_seq_pedido,
+            TIPO_ORDEM: self.tratar_ordem,
+            TIPO_RETRANSMITIR: self.tratar_retransmitir,
+            TIPO_SEQ_STATE: self.tratar_seq_state,
+            TIPO_ESTADO: self.tratar_estado,
+        }
+
+        self.metricas.registrar_medidor("threads", threading.active_count)
+        self.metricas.registrar_medidor("membros", lambda: len(self.membros))
+        self.metricas.registrar_medidor("filas_envio", self.metricas_envio)
+        self.metricas.registrar_medidor(
+            "filas_trabalho", lambda: self.trabalhadores.metricas() if self.trabalhadores is not None else None
+        )
+
+    # Leitura sem trava do papel atual (ver Papel); as trocas são feitas sob lock_eleicao
+    @property
+    def coordenador(self):
+        return self.papel.coordenador
+
+    @property
+    def coordenador_atual(self):
+        return self.papel.coordenador_atual
+
+    @property
+    def em_eleicao(self):
+        return self.papel.em_eleicao
 
     # ===========================================================================
     # Inicia o servidor, mantém ele ativo e escuta novas conexões de outros peers
     # ===========================================================================
     def inicia_servidor(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind((self.ip, self.porta))
-        self.server_socket.listen(5)
+        if self.processos_recepcao:
+            self.inicia_recepcao()
+            return
+        if self.server_socket is None:
+            try:
+                self.server_socket = self.transporte.ouvir(self.ip, self.porta, self.backlog)
+            except OSError as e:
+                self.log.error(f"[ERRO SERVIDOR] Não foi possível ouvir em {self.ip}:{self.porta}: {e}")
+                self.pronto.set()
+                return
+        self.trabalhadores = PoolTrabalhadores(self.num_trabalhadores)
 
-        print(f"[SERVIDOR] {self.nome} ouvindo em {self.ip}:{self.porta}")
+        self.log.info(f"[SERVIDOR] {self.nome} ouvindo em {self.ip}:{self.porta}")
+        self.pronto.set()
 
-        while True:
-            client_socket, _ = self.server_socket.accept()
+        while self.ativo:
             try:
-                data = client_socket.recv(2048)
-                msg = data.decode('utf-8')
-                self.tratar_mensagem(msg, client_socket)
-            except Exception as e:
-                print(f"[ERRO SERVIDOR] {e}")
-            finally:
-                client_socket.close()
-    
+                client_socket, _ = self.server_socket.accept()
+            except OSError:
+                break  # socket fechado por parar()
+            Thread(target=self.tratar_conexao, args=(client_socket,), daemon=True).start()
+
+    # Em vez do socket de escuta, processos_recepcao processos leem as conexões e entregam
+    # os quadros ao peer por memória compartilhada (ver recepcao.py)
+    def inicia_recepcao(self):
+        from recepcao import RecepcaoProcessos  # só carrega multiprocessing quando usado
+        self.trabalhadores = PoolTrabalhadores(self.num_trabalhadores)
+        self.recepcao = RecepcaoProcessos(self, self.processos_recepcao)
+        if not self.recepcao.iniciar():
+            self.log.error(f"[ERRO SERVIDOR] Não foi possível iniciar a recepção em {self.ip}:{self.porta}.")
+            self.recepcao.parar()
+            self.recepcao = None
+            self.trabalhadores = None
+        else:
+            self.log.info(f"[SERVIDOR] {self.nome} ouvindo em {self.ip}:{self.porta} ({self.processos_recepcao} processos)")
+        self.pronto.set()
+
+    # ==================================================================================
+    # Lê as mensagens de uma conexão aceita pelo servidor. Conexões que começam com o
+    # preâmbulo de quadros podem trazer várias mensagens (e ficar abertas, no caso do
+    # pool), que são entregues ao pool de trabalhadores conforme a prioridade do tipo;
+    # as demais seguem o formato antigo: uma única mensagem de texto. inicial são os
+    # bytes já lidos da conexão por outro processo (ver recepcao.py)
+    # ==================================================================================
+    def tratar_conexao(self, client_socket, inicial=b""):
+        self.conexoes_recebidas.add(client_socket)
+        try:
+            data = inicial
+            while len(data) < len(PREAMBULO_QUADROS) and PREAMBULO_QUADROS.startswith(data):
+                parte = client_socket.recv(65536)
+                if not parte:
+                    break
+                data += parte
+
+            if not data.startswith(PREAMBULO_QUADROS):
+                self.tratar_mensagem(data.decode('utf-8'), client_socket)
+                return
+
+            decodificador = DecodificadorQuadros()
+            conn = ConexaoQuadros(client_socket)
+            origem = None
+            self.metricas.incrementar("bytes_recebidos", len(data))
+            data = data[len(PREAMBULO_QUADROS):]
+            while True:
+                for tipo, corpo in expandir_lotes(decodificador.alimentar(data)):
+                    if tipo == TIPO_HELLO:
+                        origem = self.endereco_de(corpo)
+                    else:
+                        self.receber_quadro(tipo, corpo, conn, origem)
+                data = client_socket.recv(65536)
+                if not data or not self.ativo:
+                    break
+                self.metricas.incrementar("bytes_recebidos", len(data))
+        except Exception as e:
+            if self.ativo:
+                self.log.error(f"[ERRO SERVIDOR] {e}")
+        finally:
+            self.conexoes_recebidas.discard(client_socket)
+            client_socket.close()
+
+    # Entrega um quadro recebido ao pool de trabalhadores, conforme a prioridade do tipo
+    def receber_quadro(self, tipo, corpo, conn, origem=None):
+        if origem is not None:
+            self.registrar_atividade(origem)
+        prioridade = PRIORIDADE_POR_TIPO.get(tipo, PRIORIDADE_CHAT)
+        if not self.trabalhadores.submeter(prioridade, self.tratar_quadro, tipo, corpo, conn):
+            self.log.error(f"[ERRO SERVIDOR] Fila de {NOMES_PRIORIDADES[prioridade]} cheia; mensagem descartada.")
+
+    # Endereço (ip, porta) informado no HELLO (também usado por ServidorSalas)
+    @staticmethod
+    def endereco_de(corpo):
+        ip, porta = corpo.decode('utf-8').split()
+        return (ip, int(porta))
+
+    # Toda mensagem recebida de um peer (não só HEARTBEAT) é sinal de que ele está ativo
+    def registrar_atividade(self, endereco):
+        agora = relogio.time()
+        self.detector.registrar(endereco, agora)
+        membro = self.membros.obter(endereco)
+        if membro is not None:
+            membro.ultima_atividade = agora
+
     # =====================================================================================
-    # Trata todas as mensagens recebidas — tanto mensagens de controle (JOIN, UPDATE, etc.)
-    # quanto mensagens de chat enviadas pelos peers
+    # Trata mensagens de texto no formato antigo ("JOIN ip porta nome", etc.), convertendo
+    # a palavra reservada no tipo de mensagem correspondente
     # =====================================================================================
     def tratar_mensagem(self, msg, conn):
-        if msg.startswith("JOIN "):
-            _, ip, porta, nome = msg.split()
-            porta = int(porta)
-            novo_peer = (ip, porta)
-
-            if novo_peer not in self.peers:
-                self.peers.append(novo_peer)
-                
-                aviso = f"[SISTEMA] Novo peer adicionado: {nome} ({ip}:{porta})"
-                print(aviso)
-
-                # Envia a mensagem para todos os outros peers
-                for peer_ip, peer_porta in self.peers:
-                    if (peer_ip, peer_porta) != (self.ip, self.porta) and (peer_ip, peer_porta) != (ip, porta):
-                        Thread(target=self.cliente, args=(peer_ip, peer_porta, aviso), daemon=True).start()
-
-                # Atribui ID único
-                if novo_peer not in self.mapa_ids:
-                    novo_id = self.proximo_id
-                    self.mapa_ids[novo_peer] = novo_id
-                    self.proximo_id += 1
+        tipo, corpo = tipo_da_mensagem(msg)
+        self.tratar_quadro(tipo, corpo.encode('utf-8'), conn)
+
+    # =====================================================================================
+    # Trata todas as mensagens recebidas — tanto mensagens de controle (JOIN, UPDATE, etc.)
+    # quanto mensagens de chat enviadas pelos peers — de acordo com o tipo do quadro
+    # =====================================================================================
+    def tratar_quadro(self, tipo, corpo, conn):
+        tratador = self.tratadores.get(tipo)
+        if tratador is None:
+            self.log.error(f"[ERRO] Tipo de mensagem desconhecido: {tipo}")
+            return
+        nome = NOMES_TIPOS[tipo]
+        self.metricas.incrementar("recebidas." + nome)
+        inicio = time.perf_counter()
+        try:
+            tratador(corpo if tipo in TIPOS_BINARIOS else corpo.decode('utf-8'), conn)
+        finally:
+            self.metricas.observar("tratamento." + nome, (time.perf_counter() - inicio) * 1000)
+
+    def tratar_join(self, corpo, conn):
+        ip, porta, nome, *extras = corpo.split()
+        porta = int(porta)
+        novo_peer = (ip, porta)
+        posicao = [extra for extra in extras if not extra.startswith("formatos=")]
+        for extra in extras:
+            if extra.startswith("formatos="):
+                self.combinar_formatos(novo_peer, extra[len("formatos="):])
+
+        # A inclusão e a nova versão são uma única escrita na tabela, para que JOINs
+        # simultâneos não repitam um ID nem um número de versão. Os quadros para os outros
+        # peers também são montados aqui, mas só entram nas filas de saída depois de soltar
+        # a trava, já que enfileirar pode esperar por um destino lento (política "esperar").
+        # Deltas que chegarem fora de ordem esperam os anteriores (deltas_pendentes). O
+        # trabalho de rede que a atribuição do ID possa exigir também fica fora da trava
+        # (preparar_ids); sem um ID para dar, quem entra recebe o erro na resposta
+        envios = []
+        try:
+            self.preparar_ids()
+            with self.membros.trava:
+                membro = self.membros.obter(novo_peer)
+                if membro is None:
+                    aviso = f"[SISTEMA] Novo peer adicionado: {nome} ({ip}:{porta})"
+                    self.log.info(aviso)
+
+                    # A mensagem vai para todos os outros peers
+                    envios += self.quadros_difusao(codificar_quadro(TIPO_TEXTO, aviso))
+
+                    # Atribui ID único (quem já esteve no chat recebe o mesmo ID de antes)
+                    novo_id = self.membros.ids_anteriores.get(novo_peer)
+                    if novo_id is None or self.membros.obter_por_id(novo_id) is not None:
+                        novo_id = self.gerar_id()
+
+                    membro = self.membros.adicionar(ip, porta, novo_id, nome)
+                    self.log.info(f"[SISTEMA] Atribuído ID {novo_id} a {nome} ({ip}:{porta})")
+
+                if self.membros_delta:
+                    self.seq_membros += 1
+                    self.guardar_versao()
+
+                # O novo peer recebe o estado completo na resposta (e, no modo ordenado, a partir
+                # de qual seq passa a exibir as mensagens)
+                resposta = {"id": membro.id, **self.dados_mapas()}
+
+                if self.membros_delta:
+                    # Os demais recebem só a alteração
+                    envios += self.quadros_membros(TIPO_DELTA, self.dados_delta(adicionados=[membro]), novo_peer)
                 else:
-                    novo_id = self.mapa_ids[novo_peer]
-
-                # Salva nome
-                self.mapa_nomes[novo_peer] = nome
-
-                print(f"[SISTEMA] Atribuído ID {novo_id} a {nome} ({ip}:{porta})")
-
-            resposta = {"id": self.mapa_ids[novo_peer], "peers": self.peers}
-            conn.send(json.dumps(resposta).encode('utf-8'))
-
-            # Notifica todos sobre o novo peer e envia mapas
-            self.notificar_peers(novo_peer)
-            self.enviar_mapas_para_peers()
-
-        elif msg.startswith("UPDATE "):
-            _, json_lista = msg.split(" ", 1)
-            nova_lista = [tuple(p) for p in json.loads(json_lista)]
-
-            antigos = set(self.peers)
-            novos = set(nova_lista)
-            removidos = antigos - novos
-            self.peers = nova_lista
-
-            if removidos:
-                for ip, porta in removidos:
-                    nome_removido = self.mapa_nomes.get((ip, porta), "Desconhecido")
-                    print(f"[SISTEMA] Peer removido: {nome_removido} ({ip}:{porta})")
-                    self.mapa_nomes.pop((ip, porta), None)
-
-        elif msg.startswith("HEARTBEAT "):
-            _, ip, porta = msg.split()
-            porta = int(porta)
-            self.ultima_atividade[(ip, porta)] = time.time()
-        
-        elif msg.startswith("START_ELECTION"):
-            Thread(target=self.iniciar_eleicao, daemon=True).start()
-
-        elif msg.startswith("ELECTION "):
-            self.tratar_eleicao(msg)
-
-        elif msg.startswith("COORDINATOR "):
-            self.tratar_novo_coordenador(msg)
-
-        elif msg.startswith("REMOVE_COORDINATOR "):
-            _, ip, porta = msg.split()
-            porta = int(porta)
-            coord = (ip, porta)
-            if coord in self.peers:
-                self.peers.remove(coord)
-                nome_coord = self.mapa_nomes.get(coord, "Coordenador desconhecido")
-                print(f"[SISTEMA] Coordenador {nome_coord} ({ip}:{porta}) removido da lista por inatividade.")
-
-        elif msg.startswith("MAP_UPDATE "):
-            _, json_dados = msg.split(" ", 1)
-            try:
-                dados = json.loads(json_dados)
-                self.mapa_ids = {tuple(eval(k)): v for k, v in dados.get("ids", {}).items()}
-                self.mapa_nomes = {tuple(eval(k)): v for k, v in dados.get("nomes", {}).items()}
-            except Exception as e:
-                print(f"[ERRO] Falha ao processar MAP_UPDATE: {e}")
+                    # Todos recebem a lista de peers e os mapas
+                    envios += self.quadros_membros(TIPO_UPDATE, self.dados_enderecos())
+                    envios += self.quadros_membros(TIPO_MAP_UPDATE, self.dados_mapas())
+        except RuntimeError as e:
+            self.log.error(f"[ERRO] Entrada de {nome} ({ip}:{porta}) recusada: {e}")
+            conn.send(json.dumps({"erro": str(e)}).encode('utf-8'))
+            return
+        self.enviar_quadros(envios)
+
+        # Começa a vigiar o novo peer mesmo que ele ainda não tenha enviado heartbeat
+        self.registrar_atividade(novo_peer)
+
+        if self.disseminacao == "ordenada":
+            resposta["seq_ordem"] = self.proximo_entregar - 1
+        conn.send(json.dumps(resposta).encode('utf-8'))
+
+        self.enviar_historico(novo_peer, posicao[0] if posicao else None)
+
+    def tratar_update(self, corpo, conn):
+        dados = self.decodificar_membros(corpo)
+        # No formato antigo (texto), o corpo é só a lista de endereços
+        nova_lista = [tuple(p) for p in (dados["enderecos"] if isinstance(dados, dict) else dados)]
+        for removido in self.membros.manter_apenas(nova_lista):
+            self.log.info(f"[SISTEMA] Peer removido: {removido.nome or 'Desconhecido'} ({removido.ip}:{removido.porta})")
+
+    def tratar_heartbeat(self, corpo, conn):
+        # Em conexões com HELLO a atividade já foi registrada ao receber o quadro;
+        # registrar de novo só renova o instante da última mensagem
+        ip, porta, *ordem = corpo.split()
+        endereco = (ip, int(porta))
+        self.registrar_atividade(endereco)
+        if ordem and not self.coordenador:
+            self.verificar_fim_ordem(int(ordem[0]))
+
+        agora = relogio.time()
+        anterior = self.ultimo_heartbeat.get(endereco)
+        self.ultimo_heartbeat[endereco] = agora
+        if anterior is not None:
+            self.metricas.observar("intervalo_heartbeat", (agora - anterior) * 1000)
+
+    def tratar_start_election(self, corpo, conn):
+        self.executar_em_segundo_plano(self.iniciar_eleicao)
+
+    def tratar_remove_coordinator(self, corpo, conn):
+        ip, porta = corpo.split()
+        porta = int(porta)
+        coord = self.membros.remover((ip, porta))
+        self.detector.esquecer((ip, porta))
+        if coord is not None:
+            nome_coord = coord.nome or "Coordenador desconhecido"
+            self.log.info(f"[SISTEMA] Coordenador {nome_coord} ({ip}:{porta}) removido da lista por inatividade.")
+
+    def tratar_map_update(self, corpo, conn):
+        try:
+            self.aplicar_mapas(self.decodificar_membros(corpo))
+        except Exception as e:
+            self.log.error(f"[ERRO] Falha ao processar MAP_UPDATE: {e}")
+
+    def aplicar_mapas(self, dados):
+        with self.membros.trava:
+            self.membros.substituir(dados.get("membros", []))
+            if "versao" in dados:
+                # Estado completo: passa a valer a versão do coordenador
+                self.epoca, self.seq_membros = dados["versao"]
+                self.deltas_pendentes = {s: d for s, d in self.deltas_pendentes.items() if s > self.seq_membros}
+                self.aplicar_deltas_pendentes()
+
+    # ==================================================================================
+    # DELTA - aplica uma alteração incremental da lista de membros. Alterações fora de
+    # ordem esperam a anterior chegar; se ela não chegar (ou a época for outra), o peer
+    # pede o estado completo ao coordenador
+    # ==================================================================================
+    def tratar_delta(self, corpo, conn):
+        delta = self.decodificar_membros(corpo)
+        epoca, seq = delta["versao"]
+        with self.membros.trava:
+            if epoca != self.epoca:
+                self.sincronizar_membros()
+                return
+            if seq <= self.seq_membros:
+                return  # já aplicado
+            self.deltas_pendentes[seq] = delta
+            self.aplicar_deltas_pendentes()
+            if self.deltas_pendentes:
+                self.agendar_apos(self.espera_delta, self.verificar_lacuna_delta, self.epoca, self.seq_membros)
+
+    # Cada alteração é publicada como uma única versão da tabela
+    def aplicar_deltas_pendentes(self):
+        with self.membros.trava:
+            while self.seq_membros + 1 in self.deltas_pendentes:
+                delta = self.deltas_pendentes.pop(self.seq_membros + 1)
+                _, removidos = self.membros.aplicar(delta.get("adicionados", []), delta.get("removidos", []))
+                for removido in removidos:
+                    self.log.info(f"[SISTEMA] Peer removido: {removido.nome or 'Desconhecido'} ({removido.ip}:{removido.porta})")
+                self.seq_membros += 1
+
+    def verificar_lacuna_delta(self, epoca, seq):
+        # Nenhum progresso desde que a lacuna foi detectada: pede o estado completo
+        if self.deltas_pendentes and (self.epoca, self.seq_membros) == (epoca, seq):
+            self.log.info("[SISTEMA] Alteração de membros perdida; sincronizando com o coordenador...")
+            self.sincronizar_membros()
+
+    # ====================================================================================
+    # SINCRONIZAÇÃO DOS MEMBROS - o peer envia ao coordenador a versão e o resumo da sua
+    # tabela (SYNC_REQUEST) e recebe, em uma única resposta (ESTADO), só o que mudou desde
+    # aquela versão, ou a tabela completa comprimida quando o coordenador não conhece a
+    # versão. Usado depois de cada eleição e quando um DELTA se perde. Se, depois de
+    # aplicar a diferença, o resumo não bater com o do coordenador, pede a tabela completa
+    # ====================================================================================
+    def sincronizar_membros(self, completo=False):
+        if self.coordenador or not self.coordenador_atual:
+            return
+        ip, porta = self.coordenador_atual
+        resumo = "-" if completo else self.membros.resumo()
+        corpo = f"{self.ip} {self.porta} {self.epoca} {self.seq_membros} {resumo} {','.join(self.formatos) or '-'}"
+        self.enviar_sem_bloquear(ip, porta, codificar_quadro(TIPO_SYNC_REQUEST, corpo))
+
+    # Guarda a tabela da versão atual (no coordenador, a cada alteração dos membros)
+    # (as versões da tabela são imutáveis, então basta guardar a referência)
+    def guardar_versao(self):
+        if not self.membros_delta:
+            return
+        with self.membros.trava:
+            self.versoes_membros[(self.epoca, self.seq_membros)] = self.membros.atual
+            self.versoes_membros.move_to_end((self.epoca, self.seq_membros))
+            while len(self.versoes_membros) > self.versoes_guardadas:
+                self.versoes_membros.popitem(last=False)
+
+    def tratar_sync_request(self, corpo, conn):
+        if not self.coordenador:
+            return
+        ip, porta, *versao = corpo.split()
+        if len(versao) == 4:
+            self.combinar_formatos((ip, int(porta)), versao.pop())
+        # A versão (epoca, seq) e a tabela são lidas juntas
+        with self.membros.trava:
+            resposta = {"versao": [self.epoca, self.seq_membros], "resumo": self.membros.resumo()}
+            atual = self.membros.atual
+        anterior = None
+        if len(versao) == 3:
+            epoca, seq, resumo = versao
+            if resumo == resposta["resumo"]:
+                resposta["modo"] = "igual"
+            elif resumo != "-":  # "-": o peer pediu a tabela completa
+                anterior = self.versoes_membros.get((int(epoca), int(seq)))
+
+        if "modo" not in resposta:
+            atuais = [membro.linha() for membro in atual.membros]
+            if anterior is not None:
+                # Registros iguais são o mesmo objeto nas duas versões
+                adicionados = [membro.linha() for membro in atual.membros
+                               if anterior.por_endereco.get(membro.endereco) is not membro]
+                removidos = [list(endereco) for endereco in anterior.enderecos if endereco not in atual.por_endereco]
+            if anterior is not None and len(adicionados) + len(removidos) < len(atuais):
+                resposta.update(modo="diferenca", adicionados=adicionados, removidos=removidos)
+            else:
+                resposta.update(modo="completo", membros=atuais)
+        self.metricas.incrementar("sincronizacoes." + resposta["modo"])
+        corpo = self.codificar_membros(resposta, self.formatos_peers.get((ip, int(porta)), ()))
+        self.enviar_sem_bloquear(ip, int(porta), codificar_quadro(TIPO_ESTADO, corpo))
+
+    def tratar_estado(self, corpo, conn):
+        dados = self.decodificar_membros(corpo)
+        with self.membros.trava:
+            if dados["modo"] == "completo":
+                self.membros.substituir(dados["membros"])
+            elif dados["modo"] == "diferenca":
+                _, removidos = self.membros.aplicar(dados["adicionados"], dados["removidos"])
+                for removido in removidos:
+                    self.detector.esquecer(removido.endereco)
+                    self.log.info(f"[SISTEMA] Peer removido: {removido.nome or 'Desconhecido'} ({removido.ip}:{removido.porta})")
+            if self.membros.resumo() != dados["resumo"]:
+                self.sincronizar_membros(completo=True)
+                return
+            self.epoca, self.seq_membros = dados["versao"]
+            self.deltas_pendentes = {s: d for s, d in self.deltas_pendentes.items() if s > self.seq_membros}
+            self.aplicar_deltas_pendentes()
 
-        elif msg.startswith("EXIT "):
-            _, ip, porta, nome = msg.split()
-            porta = int(porta)
-            peer_removido = (ip, porta)
+    def tratar_exit(self, corpo, conn):
+        ip, porta, nome = corpo.split()
+        porta = int(porta)
+        peer_removido = (ip, porta)
 
-            # Coordenador não deve anunciar a própria saída
-            if peer_removido == (self.ip, self.porta):
-                return
+        # Coordenador não deve anunciar a própria saída
+        if peer_removido == (self.ip, self.porta):
+            return
 
-            if peer_removido in self.peers:
-                self.peers.remove(peer_removido)
-                print(f"[SISTEMA] Peer saiu: {nome} ({ip}:{porta})")
+        self.detector.esquecer(peer_removido)
+        envios = []
+        with self.membros.trava:
+            if self.membros.remover(peer_removido) is not None:
+                self.log.info(f"[SISTEMA] Peer saiu: {nome} ({ip}:{porta})")
                 if self.coordenador:
-                    self.notificar_peers(peer_removido)
+                    envios = self.registrar_saida(peer_removido)
+        self.enviar_quadros(envios)
+
+    # No coordenador, sob a trava da tabela: nova versão sem o peer. Retorna os quadros
+    # para os demais, enfileirados por quem chamou depois de soltar a trava (ver tratar_join)
+    def registrar_saida(self, peer_removido):
+        self.formatos_peers.pop(peer_removido, None)
+        with self.membros.trava:
+            if self.membros_delta:
+                self.seq_membros += 1
+                self.guardar_versao()
+                return self.quadros_membros(TIPO_DELTA, self.dados_delta(removidos=[peer_removido]))
+            return self.quadros_membros(TIPO_UPDATE, self.dados_enderecos())
+
+    def tratar_texto(self, corpo, conn):
+        if corpo.strip():  # só mostra se não for vazio
+            self.log.info(f"\n> {corpo}", extra={"evento": "chat"})
+
+    def tratar_stats(self, corpo, conn):
+        conn.send(json.dumps(self.exportar_metricas()).encode('utf-8'))
 
+    # ============================================================
+    # Métricas do peer em um dicionário pronto para virar JSON
+    # ============================================================
+    def exportar_metricas(self):
+        return {
+            "peer": {
+                "nome": self.nome,
+                "endereco": f"{self.ip}:{self.porta}",
+                "id": self.id,
+                "coordenador": self.coordenador,
+            },
+            "instante": relogio.time(),
+            **self.metricas.instantaneo(),
+        }
+
+    # Grava as métricas em arquivo_metricas a cada intervalo_metricas segundos. O arquivo é
+    # escrito ao lado e depois renomeado, para quem lê nunca ver um JSON pela metade
+    def despejar_metricas(self):
+        while self.ativo:
+            time.sleep(self.intervalo_metricas)
+            self.gravar_metricas()
+
+    def gravar_metricas(self):
+        temporario = self.arquivo_metricas + ".tmp"
+        with open(temporario, "w", encoding="utf-8") as arquivo:
+            json.dump(self.exportar_metricas(), arquivo, ensure_ascii=False, indent=2)
+        os.replace(temporario, self.arquivo_metricas)
+
+    # Mostra a mensagem uma única vez e, nos modos árvore e gossip, repassa adiante
+    def tratar_chat(self, corpo, conn):
+        dados = json.loads(corpo)
+        if not self.mensagens_vistas.registrar(dados["id"]):
+            return
+        self.registrar_no_historico(dados)
+        self.tratar_texto(dados["texto"], conn)
+        if self.disseminacao != "direta":
+            self.repassar_chat(dados, tuple(dados["de"]))
+
+    def registrar_no_historico(self, dados):
+        if self.historico is not None:
+            self.historico.acrescentar(json.dumps({"id": dados["id"], "texto": dados["texto"]}).encode('utf-8'))
+
+    # ======================================================================================
+    # Envia ao peer que entrou as mensagens anteriores do histórico: tudo depois da posição
+    # informada no JOIN ("log:seq"), se ela for deste log, ou as últimas historico_join
+    # mensagens. Os registros já estão em JSON e vão em poucos quadros grandes (até
+    # limite_lote bytes cada), pela fila de saída, depois da resposta ao JOIN
+    # ======================================================================================
+    def enviar_historico(self, destino, posicao=None):
+        if self.historico is None or self.historico.ultimo() == 0:
+            return
+        log, _, seq = (posicao or "").partition(":")
+        if log == self.historico.identificador and seq.isdigit():
+            registros = self.historico.ler(int(seq) + 1)
         else:
-            if msg.strip():  # só mostra se não for vazio
-                print(f"\n> {msg}")
+            registros = self.historico.ultimas(self.historico_join)
+
+        prefixo = f'{{"log": "{self.historico.identificador}", "ate": '.encode('utf-8')
+        inicio = 0
+        while inicio < len(registros):
+            fim, tamanho = inicio, 0
+            while fim < len(registros) and (fim == inicio or tamanho + len(registros[fim][1]) <= self.enviador.limite_bytes):
+                tamanho += len(registros[fim][1]) + 1
+                fim += 1
+            corpo = prefixo + str(registros[fim - 1][0]).encode('utf-8') + b', "mensagens": ['
+            corpo += b",".join(registro for _, registro in registros[inicio:fim]) + b"]}"
+            self.enviar_sem_bloquear(destino[0], destino[1], codificar_quadro(TIPO_HISTORICO, corpo))
+            inicio = fim
+
+    # Mostra as mensagens anteriores ainda não vistas e as guarda no próprio histórico
+    def tratar_historico(self, corpo, conn):
+        dados = json.loads(corpo)
+        novas = [m for m in dados["mensagens"] if self.mensagens_vistas.registrar(m["id"])]
+        if novas:
+            self.log.info(f"[SISTEMA] {len(novas)} mensagens anteriores recebidas.")
+        for mensagem in novas:
+            self.registrar_no_historico(mensagem)
+            self.log.info(f"\n> {mensagem['texto']}", extra={"evento": "historico"})
+        self.posicao_historico = (dados["log"], dados["ate"])
+        if self.historico is not None:
+            self.historico.gravar_posicao(dados["log"], dados["ate"])
 
     # ========================================================================================
-    # Envia mensagens para outros peers (tanto mensagens do chat quanto mensagens de controle)
+    # Envia mensagens para outros peers (tanto mensagens do chat quanto mensagens de controle).
+    # A mensagem pode ser um quadro já codificado (bytes) ou texto no formato antigo.
+    # Sem wait_response, retorna se o envio deu certo (usado pelo disjuntor do EnviadorLotes)
     # ========================================================================================
     def cliente(self, ip, porta, mensagem, wait_response=False):
+        if isinstance(mensagem, str):
+            mensagem = codificar_quadro(*tipo_da_mensagem(mensagem))
+
+        # Com o pool ativo, mensagens sem resposta usam a conexão persistente do peer
+        if self.pool is not None and not wait_response:
+            if self.pool.enviar(ip, porta, mensagem):
+                self.ultimo_envio[(ip, porta)] = relogio.time()
+                return True
+            return False
+
         s = None
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(5)
-            s.connect((ip, porta))
-            s.send(mensagem.encode('utf-8'))
+            inicio = relogio.monotonic()
+            try:
+                s = self.transporte.conectar((ip, porta), 5)
+            except OSError:
+                self.metricas.incrementar("conexao.falhas")
+                raise
+            self.metricas.observar("conexao", (relogio.monotonic() - inicio) * 1000)
+            s.sendall(PREAMBULO_QUADROS + self.saudacao + self.envelope(mensagem))
+            self.metricas.contar_envio(mensagem)
+            self.ultimo_envio[(ip, porta)] = relogio.time()
 
             if wait_response:
-                resp = s.recv(4096).decode('utf-8')
-                return resp
+                # Lê até receber o quadro de resposta completo (pode chegar em várias partes)
+                decodificador = DecodificadorQuadros()
+                while True:
+                    data = s.recv(65536)
+                    if not data:
+                        return None
+                    for tipo, corpo in decodificador.alimentar(data):
+                        if tipo == TIPO_RESPOSTA:
+                            return corpo.decode('utf-8')
+            return True
         except Exception:
-            return None
+            return None if wait_response else False
         finally:
             if s:
                 s.close()
 
+    # ================================================================================
+    # Envia um quadro sem esperar o envio (ele entra na fila de saída do destino). Só
+    # bloqueia quando a fila do destino está cheia. Também é o ponto de troca do
+    # mecanismo de envio por outros motores de execução (ex.: AsyncPeer)
+    # ================================================================================
+    def enviar_sem_bloquear(self, ip, porta, quadro):
+        self.enviador.enfileirar((ip, porta), quadro)
+
+    # Quadro como ele vai pela rede; PeerSala acrescenta o envelope com o nome da sala
+    def envelope(self, quadro):
+        return quadro
+
+    def metricas_envio(self):
+        return self.enviador.metricas()
+
+    # Fecha a conexão persistente com o destino (consumidor lento na política "desconectar")
+    def desconectar_destino(self, destino):
+        if self.pool is not None:
+            self.pool.desconectar(destino)
+
+    def fechar_envio(self):
+        self.enviador.fechar()
+
+    def executar_em_segundo_plano(self, funcao, *args):
+        Thread(target=funcao, args=args, daemon=True).start()
+
+    def agendar_apos(self, atraso, funcao, *args):
+        temporizador = Timer(atraso, funcao, args=args)
+        temporizador.daemon = True
+        temporizador.start()
+
+    # Envia o mesmo quadro a todos os membros, exceto o próprio peer (e, opcionalmente, outro)
+    def difundir(self, quadro, excluir=None):
+        self.enviar_quadros(self.quadros_difusao(quadro, excluir))
+
+    # Pares (destino, quadro) de uma difusão, para quem monta os envios sob a trava da
+    # tabela de membros e só os enfileira depois (ver tratar_join)
+    def quadros_difusao(self, quadro, excluir=None):
+        return [
+            (endereco, quadro)
+            for endereco in self.membros.enderecos()
+            if endereco != self.endereco and endereco != excluir
+        ]
+
+    def enviar_quadros(self, envios):
+        for (ip, porta), quadro in envios:
+            self.enviar_sem_bloquear(ip, porta, quadro)
+
     # ===============================================================================
     # Notifica todos os peers, enviando a lista de peers atualizada (mensagem UPDATE)
     # ===============================================================================
     def notificar_peers(self, outro_peer):
-        lista_serializada = json.dumps(self.peers)
-        msg = f"UPDATE {lista_serializada}"
-        for ip, porta in self.peers:
-            if (ip, porta) != (self.ip, self.porta):
-                Thread(target=self.cliente, args=(ip, porta, msg), daemon=True).start()
+        self.difundir_membros(TIPO_UPDATE, self.dados_enderecos())
+
+    def dados_enderecos(self):
+        return {"enderecos": [list(e) for e in self.membros.enderecos()]}
 
     # ==========================================================
     # Envia mapas de IDs e nomes para todos os peers
     # ==========================================================
     def enviar_mapas_para_peers(self):
         try:
-            dados = {
-                "ids": {str(k): v for k, v in self.mapa_ids.items()},
-                "nomes": {str(k): v for k, v in self.mapa_nomes.items()},
-            }
-            msg = f"MAP_UPDATE {json.dumps(dados)}"
-            for ip, porta in self.peers:
-                if (ip, porta) != (self.ip, self.porta):
-                    Thread(target=self.cliente, args=(ip, porta, msg), daemon=True).start()
-            print("[SISTEMA] Mapas de IDs e nomes enviados aos peers.")
+            self.difundir_membros(TIPO_MAP_UPDATE, self.dados_mapas())
+            self.log.info("[SISTEMA] Mapas de IDs e nomes enviados aos peers.")
         except Exception as e:
-            print(f"[ERRO] Falha ao enviar mapas: {e}")
+            self.log.error(f"[ERRO] Falha ao enviar mapas: {e}")
+
+    # Tabela de membros em formato compacto: linhas [ip, porta, id, nome] e a versão
+    def dados_mapas(self):
+        return {
+            "membros": self.membros.linhas(),
+            "versao": [self.epoca, self.seq_membros],
+        }
+
+    # ===============================================================================
+    # Corpo da mensagem DELTA: só a alteração na lista de membros, com a versão
+    # (época, sequência) já incrementada pelo coordenador
+    # ===============================================================================
+    def dados_delta(self, adicionados=(), removidos=()):
+        return {
+            "versao": [self.epoca, self.seq_membros],
+            "adicionados": [membro.linha() for membro in adicionados],
+            "removidos": [list(peer) for peer in removidos],
+        }
+
+    def difundir_membros(self, tipo, dados, excluir=None):
+        self.enviar_quadros(self.quadros_membros(tipo, dados, excluir))
+
+    # Um corpo de membros para cada destino, codificado uma única vez para cada combinação
+    # de formatos (normalmente uma só: a de todos os peers da versão atual)
+    def quadros_membros(self, tipo, dados, excluir=None):
+        quadros = {}
+        envios = []
+        for endereco in self.membros.enderecos():
+            if endereco == self.endereco or endereco == excluir:
+                continue
+            formatos = self.formatos_peers.get(endereco, ())
+            if formatos not in quadros:
+                quadros[formatos] = codificar_quadro(tipo, self.codificar_membros(dados, formatos))
+            envios.append((endereco, quadros[formatos]))
+        return envios
+
+    # Formatos informados por um peer ("compacto,zlib" ou "-"), dos quais valem os que
+    # este peer também aceita
+    def combinar_formatos(self, endereco, texto):
+        oferecidos = texto.split(",")
+        self.formatos_peers[endereco] = tuple(f for f in self.formatos if f in oferecidos)
+
+    def codificar_membros(self, dados, formatos):
+        inicio = time.perf_counter()
+        corpo = codificar_membros(dados, formatos, self.limite_compressao)
+        self.metricas.observar("codificacao_membros", (time.perf_counter() - inicio) * 1000)
+        return corpo
+
+    def decodificar_membros(self, corpo):
+        inicio = time.perf_counter()
+        dados = decodificar_membros(corpo)
+        self.metricas.observar("decodificacao_membros", (time.perf_counter() - inicio) * 1000)
+        return dados
 
     # ===========================================================================
-    # ELEIÇÃO (BULLY) - Funções auxiliares para eleição usando algoritmo valentão
+    # ELEIÇÃO (BULLY) - Funções auxiliares para eleição usando algoritmo valentão.
+    # O peer envia ELECTION a todos os candidatos com ID maior ao mesmo tempo e
+    # espera um OK. Sem OK, assume a coordenação; com OK, espera o COORDINATOR e,
+    # se ele não vier, repete a rodada. Esgotadas as rodadas, assume a coordenação,
+    # então uma eleição nunca passa de tempo_max_eleicao() segundos
     # ===========================================================================
     def iniciar_eleicao(self):
-        if self.em_eleicao or self.id is None:
+        if not self.comecar_eleicao():
             return
-
-        self.em_eleicao = True
-        print("[ELEIÇÃO] Coordenador inativo. Iniciando eleição...")
-
-        candidatos = [
-            (ip, porta)
-            for (ip, porta) in self.peers
-            if self.mapa_ids.get((ip, porta), -1) > self.id
+        try:
+            for _ in range(self.rodadas_eleicao):
+                contatados = self.contatar_candidatos()
+                if not contatados or not self.ok_eleicao.wait(self.timeout_eleicao):
+                    break
+                # Um candidato maior respondeu: ele é quem deve anunciar o resultado
+                if self.coordenador_eleito.wait(self.espera_coordenador):
+                    return
+                self.log.info("[ELEIÇÃO] Nenhum coordenador anunciado. Repetindo a eleição...")
+                self.ok_eleicao.clear()
+            if not self.coordenador_eleito.is_set():
+                self.assumir_coordenacao()
+        finally:
+            self.terminar_eleicao()
+
+    # Marca o início de uma eleição; retorna False se já houver uma em andamento
+    def comecar_eleicao(self):
+        with self.lock_eleicao:
+            if self.em_eleicao or self.id is None:
+                return False
+            self.papel = self.papel.com(em_eleicao=True)
+        self.metricas.incrementar("eleicoes.iniciadas")
+        self.inicio_eleicao = relogio.time()
+        self.ok_eleicao.clear()
+        self.coordenador_eleito.clear()
+        self.log.info("[ELEIÇÃO] Coordenador inativo. Iniciando eleição...", extra={"evento": "eleicao_iniciada"})
+        return True
+
+    def terminar_eleicao(self):
+        self.duracao_eleicao = relogio.time() - self.inicio_eleicao
+        with self.lock_eleicao:
+            self.papel = self.papel.com(em_eleicao=False)
+        self.log.info(f"[ELEIÇÃO] Eleição concluída em {self.duracao_eleicao * 1000:.0f} ms.")
+
+    # Limite superior (s) da duração de uma eleição com os parâmetros atuais
+    def tempo_max_eleicao(self):
+        por_rodada = self.tentativas_eleicao * self.timeout_eleicao + self.timeout_eleicao + self.espera_coordenador
+        return self.rodadas_eleicao * por_rodada
+
+    def candidatos_eleicao(self):
+        return [
+            membro.endereco
+            for membro in self.membros
+            if membro.id is not None and membro.id > self.id
         ]
-        recebeu_resposta = False
 
-        for ip, porta in candidatos:
+    def quadro_eleicao(self):
+        return codificar_quadro(TIPO_ELECTION, f"{self.id} {self.ip} {self.porta}")
+
+    # Envia ELECTION a todos os candidatos ao mesmo tempo e espera os envios terminarem.
+    # Retorna quantos candidatos foram contatados
+    def contatar_candidatos(self):
+        candidatos = self.candidatos_eleicao()
+        quadro = self.quadro_eleicao()
+        resultados = [False] * len(candidatos)
+
+        def contatar(i, ip, porta):
+            resultados[i] = self.enviar_com_tentativas(ip, porta, quadro)
+
+        threads = [Thread(target=contatar, args=(i, ip, porta), daemon=True)
+                   for i, (ip, porta) in enumerate(candidatos)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return sum(resultados)
+
+    # Envia um quadro em uma conexão própria, com timeout_eleicao por tentativa
+    def enviar_com_tentativas(self, ip, porta, quadro):
+        for _ in range(self.tentativas_eleicao):
             try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.connect((ip, porta))
-                s.send(f"ELECTION {self.id}".encode('utf-8'))
-                s.close()
-                recebeu_resposta = True
-            except:
-                pass
+                s = self.transporte.conectar((ip, porta), self.timeout_eleicao)
+                try:
+                    s.sendall(PREAMBULO_QUADROS + self.saudacao + self.envelope(quadro))
+                finally:
+                    s.close()
+                self.metricas.contar_envio(quadro)
+                self.ultimo_envio[(ip, porta)] = relogio.time()
+                return True
+            except OSError:
+                self.metricas.incrementar("conexao.falhas")
+        return False
 
-        if not recebeu_resposta:
-            self.coordenador = True
-            self.coordenador_atual = (self.ip, self.porta)
-            self.anunciar_coordenador()
+    # Retorna False (sem assumir) se um COORDINATOR chegou durante a eleição: a
+    # verificação e a troca de papel são uma única transição, sob lock_eleicao
+    def assumir_coordenacao(self):
+        with self.lock_eleicao:
+            if self.coordenador_eleito.is_set():
+                return False
+            self.papel = self.papel.com(coordenador_atual=self.endereco, coordenador=True)
+        self.metricas.incrementar("eleicoes.vencidas")
+        # A tabela da versão que os outros peers ainda têm fica guardada, para que eles
+        # recebam só a diferença; a nova época já sai com os IDs recalculados, antes do
+        # anúncio, para que todos sincronizem com o estado final
+        with self.membros.trava:
+            self.guardar_versao()
+            self.nova_epoca()
             self.recalcular_ids()
-            Thread(target=self.enviar_heartbeat_coordenador, daemon=True).start()
+            self.guardar_versao()
+        self.anunciar_coordenador()
+        if self.disseminacao == "ordenada":
+            self.sincronizar_ordem()
+
+        # Passa a vigiar todos os membros a partir de agora
+        for endereco in self.membros.enderecos():
+            if endereco != self.endereco:
+                self.registrar_atividade(endereco)
+        return True
+
+    # Cada coordenador numera as alterações de membros em uma nova época. O instante
+    # (em ms) em que assumiu é usado como época, para que dois coordenadores
+    # sucessivos nunca usem a mesma
+    def nova_epoca(self):
+        self.epoca = int(relogio.time() * 1000)
+        self.seq_membros = 0
+        self.deltas_pendentes = {}
 
     def recalcular_ids(self):
-        print("[SISTEMA] Recalculando IDs após eleição...")
-        novos_ids = {}
-        maior_id = -1
-        for peer in self.peers:
-            if peer in self.mapa_ids:
-                pid = self.mapa_ids[peer]
-            else:
-                pid = len(novos_ids)
-            novos_ids[peer] = pid
-            if pid > maior_id:
-                maior_id = pid
-        if (self.ip, self.porta) not in novos_ids:
-            novos_ids[(self.ip, self.porta)] = 0
-        self.mapa_ids = novos_ids
-        self.proximo_id = maior_id + 1
-        print(f"[SISTEMA] IDs recalculados.")
-
-    def tratar_eleicao(self, msg):
-        _, id_origem = msg.split()
-        id_origem = int(id_origem)
-        if self.id > id_origem:
-            Thread(target=self.iniciar_eleicao, daemon=True).start()
+        self.log.info("[SISTEMA] Recalculando IDs após eleição...")
+        with self.membros.trava:
+            if self.endereco not in self.membros:
+                self.membros.adicionar(self.ip, self.porta, self.id, self.nome)
+            # Peers sem ID conhecido recebem IDs novos, acima de todos os existentes
+            # (a tabela é indexada por ID, então um ID nunca pode ser reaproveitado),
+            # todos publicados em uma única versão da tabela
+            self.proximo_id = max(self.proximo_id, self.membros.maior_id() + 1)
+            sem_id = [(m.ip, m.porta, self.gerar_id(), None) for m in self.membros if m.id is None]
+            self.membros.aplicar(sem_id)
+        self.log.info(f"[SISTEMA] IDs recalculados.")
+
+    # Um peer com ID maior responde OK a quem pediu a eleição e disputa ele mesmo; se
+    # já for o coordenador, apenas se anuncia de novo para quem pediu
+    def tratar_eleicao(self, corpo, conn=None):
+        partes = corpo.split()
+        id_origem = int(partes[0])
+        if self.id is None or self.id <= id_origem:
+            return
+        if len(partes) >= 3:
+            ip, porta = partes[1], int(partes[2])
+            self.enviar_sem_bloquear(ip, porta, codificar_quadro(TIPO_OK, str(self.id)))
+            if self.coordenador:
+                self.enviar_sem_bloquear(ip, porta, self.quadro_coordenador())
+                return
+        self.executar_em_segundo_plano(self.iniciar_eleicao)
+
+    def tratar_ok(self, corpo, conn=None):
+        self.ok_eleicao.set()
+
+    def quadro_coordenador(self):
+        return codificar_quadro(TIPO_COORDINATOR, f"{self.ip} {self.porta} {self.nome}")
 
     def anunciar_coordenador(self):
-        msg = f"COORDINATOR {self.ip} {self.porta} {self.nome}"
-        for ip, porta in self.peers:
-            if (ip, porta) != (self.ip, self.porta):
-                Thread(target=self.cliente, args=(ip, porta, msg), daemon=True).start()
-        print(f"[ELEIÇÃO] Você ({self.ip}:{self.porta}) é o novo coordenador!")
-
-    def tratar_novo_coordenador(self, msg):
-        _, ip, porta, nome = msg.split()
-        self.coordenador = False
-        self.coordenador_atual = (ip, int(porta))
-        self.em_eleicao = False
-        print(f"[ELEIÇÃO] Novo coordenador eleito: {nome} ({ip}:{porta})")
+        self.difundir(self.quadro_coordenador())
+        self.log.info(f"[ELEIÇÃO] Você ({self.ip}:{self.porta}) é o novo coordenador!", extra={"evento": "eleicao_vencida"})
+
+    def tratar_novo_coordenador(self, corpo, conn=None):
+        ip, porta, nome = corpo.split()
+        with self.lock_eleicao:
+            anterior = self.coordenador_atual
+            self.papel = self.papel.com(coordenador_atual=(ip, int(porta)), coordenador=False)
+            self.coordenador_eleito.set()
+        self.log.info(f"[ELEIÇÃO] Novo coordenador eleito: {nome} ({ip}:{porta})")
+        # Um novo anúncio do mesmo coordenador não precisa de outra sincronização
+        if self.coordenador_atual != anterior:
+            self.sincronizar_membros()
+        if self.disseminacao == "ordenada":
+            self.reenviar_pedidos_ordem(todos=True)
 
     # ===============================================================================
     # HEARTBEAT - envia heartbeat aos outros peers, para indicar que ainda está ativo
     # ===============================================================================
-    def enviar_heartbeat_coordenador(self):
-        while self.coordenador:
-            for ip, porta in list(self.peers):
-                if (ip, porta) != (self.ip, self.porta):
-                    self.cliente(ip, porta, f"HEARTBEAT {self.ip} {self.porta}")
-            time.sleep(5)
-
-    def enviar_heartbeat_peer(self):
-        while not self.coordenador:
-            if self.coordenador_atual:
-                ip, porta = self.coordenador_atual
-                self.cliente(ip, porta, f"HEARTBEAT {self.ip} {self.porta}")
-            time.sleep(5)
-
-    # =========================================================================
-    # Monitora heartbeat do coordenador, para confirmar se ele ainda está ativo
-    # =========================================================================
+    def enviar_heartbeats(self):
+        while self.ativo:
+            self.rodada_heartbeat()
+            time.sleep(self.intervalo_heartbeat)
+
+    # Uma rodada: o coordenador avisa todos os membros e os demais peers avisam só o
+    # coordenador. Destinos que receberam outra mensagem há menos de meio intervalo são
+    # pulados, já que aquela mensagem também serviu de sinal de vida
+    def rodada_heartbeat(self):
+        destinos = self.destinos_heartbeat()
+        if not destinos:
+            return
+
+        # No modo ordenado, o heartbeat do coordenador leva a última seq, para que a perda
+        # da última mensagem também seja percebida
+        if self.coordenador and self.disseminacao == "ordenada":
+            heartbeat = codificar_quadro(TIPO_HEARTBEAT, f"{self.ip} {self.porta} {self.proximo_entregar - 1}")
+        else:
+            heartbeat = codificar_quadro(TIPO_HEARTBEAT, f"{self.ip} {self.porta}")
+        limite = relogio.time() - self.intervalo_heartbeat / 2
+        for ip, porta in destinos:
+            if self.ultimo_envio.get((ip, porta), 0) <= limite:
+                self.enviar_sem_bloquear(ip, porta, heartbeat)
+
+    def destinos_heartbeat(self):
+        if self.coordenador:
+            return [e for e in self.membros.enderecos() if e != self.endereco]
+        if self.coordenador_atual:
+            return [self.coordenador_atual]
+        return []
+
+    # ===========================================================================
+    # Monitora os outros peers com o detector de falhas: o coordenador vigia os
+    # membros e os demais peers vigiam o coordenador
+    # ===========================================================================
     def monitorar_coordenador(self):
-        while True:
-            if self.coordenador_atual:
-                ultimo = self.ultima_atividade.get(self.coordenador_atual)
-                if ultimo and time.time() - ultimo > 10:
-                    print("[ALERTA] Coordenador inativo detectado!")
-                    if self.coordenador_atual in self.peers:
-                        provisorio = self.coordenador_atual
-                        self.peers.remove(self.coordenador_atual)
-
-                    # Avisa a todos os outros peers para removerem o coordenador
-                    for peer_ip, peer_porta in list(self.peers):
-                        if (peer_ip, peer_porta) != (self.ip, self.porta):
-                            try:
-                                msg = f"REMOVE_COORDINATOR {provisorio[0]} {provisorio[1]}"
-                                Thread(target=self.cliente, args=(peer_ip, peer_porta, msg), daemon=True).start()
-                            except Exception:
-                                pass
-
-                    # Inicia a eleição localmente
-                    Thread(target=self.iniciar_eleicao, daemon=True).start()
-                    # Para evitar múltiplos disparos
-                    time.sleep(5)
-            time.sleep(2)
+        while self.ativo:
+            if self.verificar():
+                # Para evitar múltiplos disparos
+                time.sleep(self.intervalo_heartbeat)
+            time.sleep(self.intervalo_verificacao)
+
+    def verificar(self):
+        if self.disseminacao == "ordenada":
+            self.reenviar_pedidos_ordem()
+        if self.coordenador:
+            return self.verificar_membros()
+        return self.verificar_coordenador()
+
+    # ===================================================================================
+    # Verifica uma vez se o coordenador está inativo; se estiver, remove-o, avisa os
+    # outros peers e inicia a eleição. Retorna True quando a inatividade foi detectada
+    # ===================================================================================
+    def verificar_coordenador(self):
+        # Um único papel lido: o coordenador suspeito é o mesmo que foi verificado, e
+        # durante uma eleição a queda já foi tratada
+        papel = self.papel
+        provisorio = papel.coordenador_atual
+        if papel.em_eleicao or not provisorio or not self.detector.suspeito(provisorio):
+            return False
+
+        self.log.warning("[ALERTA] Coordenador inativo detectado!", extra={"evento": "coordenador_inativo"})
+        self.membros.remover(provisorio)
+        self.detector.esquecer(provisorio)
+
+        # Avisa a todos os outros peers para removerem o coordenador
+        self.difundir(codificar_quadro(TIPO_REMOVE_COORDINATOR, f"{provisorio[0]} {provisorio[1]}"))
+
+        # Inicia a eleição localmente
+        self.executar_em_segundo_plano(self.iniciar_eleicao)
+        return True
+
+    # ==============================================================================
+    # No coordenador: remove os membros suspeitos e publica a saída para os demais.
+    # Retorna True quando algum membro foi removido
+    # ==============================================================================
+    def verificar_membros(self):
+        removidos = [m for m in self.membros
+                     if m.endereco != self.endereco and self.detector.suspeito(m.endereco)]
+        for membro in removidos:
+            self.detector.esquecer(membro.endereco)
+            with self.membros.trava:
+                # Um EXIT pode ter removido o membro enquanto isso
+                if self.membros.remover(membro.endereco) is None:
+                    continue
+                self.log.warning(f"[ALERTA] Peer inativo removido: {membro.nome} ({membro.ip}:{membro.porta})",
+                                 extra={"evento": "peer_inativo"})
+                envios = self.registrar_saida(membro.endereco)
+            self.enviar_quadros(envios)
+        return bool(removidos)
 
     # ===================================================================
     # Inicia rede para um peer, permitindo que inicie ou entre em um chat
     # ===================================================================
-    def iniciar_rede(self):
-        if not self.peers:
-            self.coordenador = True
-            self.id = 0
-            self.coordenador_atual = (self.ip, self.porta)
-            self.mapa_ids[(self.ip, self.porta)] = self.id
-            self.mapa_nomes[(self.ip, self.porta)] = self.nome
-            self.peers.append((self.ip, self.porta))
-            print(f"[SISTEMA] {self.nome} é o coordenador da rede (ID 0).")
-            Thread(target=self.enviar_heartbeat_coordenador, daemon=True).start()
+    def iniciar_rede(self, coordenador=None):
+        if coordenador is None:
+            self.criar_rede()
         else:
-            coord_ip, coord_port = self.peers[0]
-            msg = f"JOIN {self.ip} {self.porta} {self.nome}"
-            resposta = self.cliente(coord_ip, coord_port, msg, wait_response=True)
+            coord_ip, coord_port = coordenador
+            resposta = self.cliente(coord_ip, coord_port, self.quadro_join(), wait_response=True)
             if resposta:
-                try:
-                    dados = json.loads(resposta)
-                    self.id = dados.get("id")
-                    self.peers = [tuple(p) for p in dados.get("peers", [])]
-                    self.coordenador_atual = (coord_ip, coord_port)
-                    print(f"[SISTEMA] ID atribuído: {self.id}.")
-                except Exception as e:
-                    print(f"[ERRO] Resposta inválida do coordenador: {e}")
-            Thread(target=self.enviar_heartbeat_peer, daemon=True).start()
-            Thread(target=self.monitorar_coordenador, daemon=True).start()
+                self.aplicar_resposta_join(coord_ip, coord_port, resposta)
+        self.iniciar_rotinas()
+
+    # Entra na rede do coordenador (um único JOIN: a resposta já traz o ID e a tabela de
+    # membros) e, se ninguém responder, cria uma rede própria
+    def entrar_ou_criar_rede(self, coordenador=None):
+        self.iniciar_rede(coordenador)
+        if self.coordenador_atual is None:
+            self.log.info(f"[SISTEMA] Nenhum coordenador encontrado em {coordenador[0]}:{coordenador[1]}. Criando rede própria para {self.nome}...")
+            self.criar_rede()
+
+    # Heartbeat, monitoramento e gravação das métricas (em PeerSala, feitos pelo servidor
+    # de salas para todas as salas de uma vez)
+    def iniciar_rotinas(self):
+        Thread(target=self.enviar_heartbeats, daemon=True).start()
+        Thread(target=self.monitorar_coordenador, daemon=True).start()
+        if self.arquivo_metricas:
+            Thread(target=self.despejar_metricas, daemon=True).start()
+
+    # ====================================================================================
+    # Uso sem terminal (testes, benchmark.py, vários peers no mesmo processo): inicia o
+    # servidor, espera ele ficar pronto e entra na rede do coordenador informado (ou cria
+    # uma rede nova). Retorna True se o peer ficou com um coordenador
+    # ====================================================================================
+    def iniciar_sem_terminal(self, coordenador=None, timeout=5):
+        Thread(target=self.inicia_servidor, daemon=True).start()
+        if not self.pronto.wait(timeout) or self.trabalhadores is None:
+            return False
+        self.iniciar_rede(coordenador)
+        return self.coordenador_atual is not None
+
+    # Para o peer sem encerrar o processo e sem avisar ninguém, como em uma queda: fecha o
+    # servidor e as conexões e encerra o heartbeat e o monitoramento
+    def parar(self):
+        self.ativo = False
+        if self.server_socket is not None:
+            self.server_socket.close()
+        if self.recepcao is not None:
+            self.recepcao.parar()
+        for conexao in list(self.conexoes_recebidas):
+            try:
+                conexao.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.pool is not None:
+            self.pool.fechar()
+        self.fechar_envio()
+        if self.historico is not None:
+            self.historico.fechar()
+
+    def criar_rede(self):
+        self.id = self.gerar_id()
+        with self.lock_eleicao:
+            self.papel = self.papel.com(coordenador_atual=self.endereco, coordenador=True)
+        with self.membros.trava:
+            self.nova_epoca()
+            self.membros.adicionar(self.ip, self.porta, self.id, self.nome)
+            self.guardar_versao()
+        self.log.info(f"[SISTEMA] {self.nome} é o coordenador da rede (ID {self.id}).")
+
+    # Chamado por tratar_join antes da trava da tabela de membros, para o trabalho que
+    # gerar_id não pode fazer sob ela (no modo hierárquico, conseguir um bloco de IDs
+    # da raiz). Levanta RuntimeError se não houver como atribuir um ID
+    def preparar_ids(self):
+        pass
+
+    # Próximo ID livre, atribuído pelo coordenador (no modo hierárquico, vem dos blocos
+    # de IDs reservados pela raiz; ver hierarquia.py)
+    def gerar_id(self):
+        novo_id = self.proximo_id
+        self.proximo_id += 1
+        return novo_id
+
+    def quadro_join(self):
+        corpo = f"{self.ip} {self.porta} {self.nome}"
+        if self.posicao_historico is not None:
+            log, seq = self.posicao_historico
+            corpo += f" {log}:{seq}"
+        return codificar_quadro(TIPO_JOIN, f"{corpo} formatos={','.join(self.formatos) or '-'}")
+
+    def aplicar_resposta_join(self, coord_ip, coord_port, resposta):
+        try:
+            dados = json.loads(resposta)
+            if "erro" in dados:
+                self.log.error(f"[ERRO] O coordenador recusou a entrada: {dados['erro']}")
+                return
+            self.id = dados.get("id")
+            with self.lock_eleicao:
+                self.papel = self.papel.com(coordenador_atual=(coord_ip, coord_port))
+            self.aplicar_mapas(dados)
+            if "seq_ordem" in dados:
+                self.iniciar_ordem(dados["seq_ordem"])
+            self.registrar_atividade(self.coordenador_atual)
+            self.log.info(f"[SISTEMA] ID atribuído: {self.id}.")
+        except Exception as e:
+            self.log.error(f"[ERRO] Resposta inválida do coordenador: {e}")
 
     # ============================================================
-    # Inicia a conexão de um peer com um chat
+    # Inicia a conexão de um peer com um chat. O servidor começa a
+    # ouvir enquanto o usuário responde às perguntas
     # ============================================================
     def iniciar(self):
-        global EXITING
         Thread(target=self.inicia_servidor, daemon=True).start()
-        time.sleep(1)
+        coordenador = None
 
         opcao = input("Deseja informar um coordenador existente? (s/n): ").strip().lower()
         while opcao.lower() != "s" and opcao.lower() != "n":
@@ -368,51 +2987,34 @@ class Peer:
 
         if opcao == "s":
             while True:
-                try:
-                    porta_str = input("Porta do coordenador: ").strip()
-
-                    # Verifica se a entrada é válida
-                    if '.' in porta_str or not porta_str.isdigit():
-                        print("[ERRO] A porta deve ser um número inteiro entre 0 e 65535.")
-                        continue
-
-                    porta = int(porta_str)
-                    if not (0 <= porta <= 65535):
-                        print("[ERRO] A porta deve estar entre 0 e 65535.")
-                        continue
-
-                    # Verifica se há alguém ouvindo nessa porta
-                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    s.settimeout(1)
-                    resultado = s.connect_ex(('localhost', porta))
-                    s.close()
-
-                    if resultado == 0:
-                        # Conexão bem-sucedida -> coordenador existente
-                        print(f"[SISTEMA] Coordenador encontrado em localhost:{porta}.")
-                        time.sleep(1)
-                        self.peers.append(('localhost', porta))
-                    else:
-                        # Ninguém ouvindo -> cria rede própria
-                        print(f"[SISTEMA] Nenhum coordenador encontrado na porta {porta}. Criando rede própria para {self.nome}...")
-                    break
-
-                except ValueError:
-                    print("[ERRO] Entrada inválida. A porta deve ser um número inteiro.")
-                except Exception as e:
-                    print(f"[ERRO] {e}")
+                porta_str = input("Porta do coordenador: ").strip()
+
+                # Verifica se a entrada é válida
+                if '.' in porta_str or not porta_str.isdigit() or not (0 < int(porta_str) <= 65535):
+                    print("[ERRO] A porta deve ser um número inteiro entre 1 e 65535.")
+                    continue
+                # O próprio JOIN mostra se há um coordenador nessa porta (sem resposta, a rede é criada)
+                coordenador = ('localhost', int(porta_str))
+                break
         else:
             print(f"[SISTEMA] Criando rede própria para {self.nome}...")
-            time.sleep(1)
 
-        self.iniciar_rede()
+        if not self.pronto.wait(5) or self.trabalhadores is None:
+            print(f"[ERRO] Não foi possível iniciar o servidor em {self.ip}:{self.porta}.")
+            sys.exit(1)
+        self.entrar_ou_criar_rede(coordenador)
 
-        time.sleep(1)
         if self.coordenador:
-            print("\n[SISTEMA] Chat iniciado!\nDigite 'LIST' para ver peers (nome, ID, IP e porta) ou 'EXIT' para sair.\n")
+            print("\n[SISTEMA] Chat iniciado!\nDigite 'LIST' para ver peers (nome, ID, IP e porta), 'STATS' para ver as métricas ou 'EXIT' para sair.\n")
         else:
-            print("\n[SISTEMA] Boas vindas ao chat!\nDigite 'LIST' para ver peers (nome, ID, IP e porta) ou 'EXIT' para sair.\n")
+            print("\n[SISTEMA] Boas vindas ao chat!\nDigite 'LIST' para ver peers (nome, ID, IP e porta), 'STATS' para ver as métricas ou 'EXIT' para sair.\n")
+        self.ler_terminal()
 
+    # ============================================================
+    # Lê as mensagens e os comandos do chat da entrada padrão
+    # ============================================================
+    def ler_terminal(self):
+        global EXITING
         # Palavras reservadas que não devem ser enviadas
         comandos_reservados = {
             "JOIN", "UPDATE", "ELECTION", "COORDINATOR", "HEARTBEAT",
@@ -426,16 +3028,20 @@ class Peer:
                     EXITING = True
                     break
                 elif entrada == "LIST":
-                    for peer in self.peers:
-                        nome = self.mapa_nomes.get(peer, "Desconhecido")
-                        id = self.mapa_ids.get(peer, None)
-                        print(f"{nome} [{id}] -> {peer}")
+                    for membro in self.membros:
+                        print(f"{membro.nome or 'Desconhecido'} [{membro.id}] -> {membro.endereco}")
+                elif entrada == "STATS":
+                    print(json.dumps(self.exportar_metricas(), indent=2, ensure_ascii=False))
                 elif entrada.strip():
                     primeira_palavra = entrada.strip().split()[0].upper()
                     if primeira_palavra in comandos_reservados:
                         print(f"[ERRO] '{primeira_palavra}' é uma palavra reservada do sistema. Use outro texto.")
                         continue
                     self.enviar_mensagem(entrada)
+            except EOFError:
+                # Entrada padrão fechada (ex.: redirecionada de um arquivo): sai como no EXIT
+                EXITING = True
+                break
             except KeyboardInterrupt:
                 self.encerrar()
 
@@ -443,96 +3049,393 @@ class Peer:
     # Envia mensagens, permitidas pelo sistema, para o chat
     # ============================================================
     def enviar_mensagem(self, mensagem):
-        for ip, porta in self.peers:
-            if (ip, porta) != (self.ip,self.porta):
-                Thread(target=self.cliente,
-                    args=(ip, porta, f"{self.nome} [{self.id}]: {mensagem}"),
-                    daemon=True).start()
-            else:
-                Thread(target=self.cliente,
-                    args=(ip, porta, f"Você [{self.id}]: {mensagem}"),
-                    daemon=True).start()
+        self.seq_chat += 1
+        dados = {
+            "id": f"{self.ip}:{self.porta}:{self.sessao}:{self.seq_chat}",
+            "texto": f"{self.nome} [{self.id}]: {mensagem}",
+        }
+        if self.disseminacao == "ordenada":
+            # Só é exibida quando chegar numerada, na mesma posição em que os outros a veem
+            with self.lock_ordem:
+                self.aguardando_ordem[dados["id"]] = [dados, f"Você [{self.id}]: {mensagem}", relogio.time()]
+            self.pedir_ordem(dados)
+            return
+        self.mensagens_vistas.registrar(dados["id"])
+        self.registrar_no_historico(dados)
+
+        # O próprio autor vê a mensagem na hora, sem passar pela rede
+        self.tratar_texto(f"Você [{self.id}]: {mensagem}", None)
+        self.repassar_chat(dados)
+
+    # Envia a mensagem aos próximos peers de acordo com o modo de disseminação
+    # (origem é o peer de quem ela foi recebida, que não precisa recebê-la de volta)
+    def repassar_chat(self, dados, origem=None):
+        if self.disseminacao == "arvore":
+            destinos = self.vizinhos_arvore()
+        elif self.disseminacao == "gossip":
+            # Cada peer repassa uma única vez; com ln(n) + 2 cópias por peer, a chance de
+            # algum peer ficar sem a mensagem cai para poucos por mil
+            outros = [e for e in self.membros.enderecos() if e != self.endereco and e != origem]
+            fanout = max(self.fanout, math.ceil(math.log(len(self.membros) + 1)) + 2)
+            destinos = random.sample(outros, min(fanout, len(outros)))
+        else:
+            destinos = self.membros.enderecos()
+
+        quadro = codificar_quadro(TIPO_CHAT, json.dumps({**dados, "de": [self.ip, self.porta]}))
+        for endereco in destinos:
+            if endereco != self.endereco and endereco != origem:
+                self.enviar_sem_bloquear(endereco[0], endereco[1], quadro)
+
+    # ===================================================================================
+    # Árvore de disseminação: os membros ordenados por ID (coordenador primeiro) formam
+    # uma árvore com fanout filhos por nó, como em um heap. A mensagem sai do autor para
+    # o pai e os filhos dele e cada peer repassa aos vizinhos de onde ela não veio, então
+    # cada peer envia no máximo fanout + 1 cópias, qualquer que seja o tamanho da sala.
+    # Os vizinhos só mudam com a versão da tabela (ou com o coordenador), então são
+    # calculados uma vez por versão
+    # ===================================================================================
+    def vizinhos_arvore(self):
+        versao, coordenador = self.membros.atual, self.coordenador_atual
+        calculado = self.arvore_calculada
+        if calculado[0] is versao and calculado[1] == coordenador:
+            return calculado[2]
+        ordem = sorted(
+            versao.membros,
+            key=lambda m: (m.endereco != coordenador, m.id is None, m.id or 0, m.endereco),
+        )
+        enderecos = [m.endereco for m in ordem]
+        vizinhos = ()
+        if self.endereco in versao.por_endereco:
+            i = enderecos.index(self.endereco)
+            vizinhos = enderecos[self.fanout * i + 1:self.fanout * i + 1 + self.fanout]
+            if i > 0:
+                vizinhos.append(enderecos[(i - 1) // self.fanout])
+            vizinhos = tuple(vizinhos)
+        self.arvore_calculada = (versao, coordenador, vizinhos)
+        return vizinhos
+
+    # =====================================================================================
+    # ORDEM TOTAL - o autor envia a mensagem ao coordenador (SEQ_PEDIDO); o coordenador
+    # junta os pedidos que chegam em uma janela curta, numera o lote inteiro de uma vez e
+    # difunde um único quadro ORDEM. Os autores não esperam a numeração para enviar a
+    # próxima mensagem, então vários lotes podem estar a caminho ao mesmo tempo
+    # =====================================================================================
+    def pedir_ordem(self, dados):
+        if self.coordenador:
+            self.receber_pedido_ordem(dados)
+        elif self.coordenador_atual:
+            ip, porta = self.coordenador_atual
+            quadro = codificar_quadro(TIPO_SEQ_PEDIDO, json.dumps({**dados, "de": [self.ip, self.porta]}))
+            self.enviar_sem_bloquear(ip, porta, quadro)
+
+    def tratar_seq_pedido(self, corpo, conn):
+        if self.coordenador:
+            self.receber_pedido_ordem(json.loads(corpo))
+
+    # Pedidos repetidos (o autor pede de novo quando a mensagem demora) são ignorados
+    def receber_pedido_ordem(self, dados):
+        with self.lock_ordem:
+            if dados["id"] in self.ids_pedidos or dados["id"] in self.mensagens_vistas:
+                return
+            self.pedidos_ordem.append({"id": dados["id"], "texto": dados["texto"]})
+            self.ids_pedidos.add(dados["id"])
+            primeiro = len(self.pedidos_ordem) == 1
+        if primeiro:
+            self.agendar_apos(self.enviador.janela, self.sequenciar_pedidos)
+
+    def sequenciar_pedidos(self):
+        with self.lock_ordem:
+            if not self.coordenador:
+                self.pedidos_ordem = []  # deixou de ser o coordenador; os autores pedem ao novo
+                self.ids_pedidos.clear()
+                return
+            if self.sincronizando_ordem or not self.pedidos_ordem:
+                return
+            lote = [[self.proximo_seq + i, dados] for i, dados in enumerate(self.pedidos_ordem)]
+            self.proximo_seq += len(lote)
+            self.pedidos_ordem = []
+            self.ids_pedidos.clear()
+        self.entregar_ordenadas(lote)
+        self.difundir(codificar_quadro(TIPO_ORDEM, json.dumps(lote)))
+
+    def tratar_ordem(self, corpo, conn):
+        self.entregar_ordenadas(json.loads(corpo))
+
+    # ==================================================================================
+    # Exibe as mensagens na ordem das seqs. As que chegam adiantadas ficam guardadas; se
+    # a que falta não chegar em espera_ordem segundos, é pedida ao coordenador. Uma seq
+    # com mensagem None foi perdida (ninguém mais a tem) e só é pulada
+    # ==================================================================================
+    def entregar_ordenadas(self, lote):
+        with self.lock_ordem:
+            for seq, dados in lote:
+                if seq >= self.proximo_entregar and self.ordem_pendente.get(seq) is None:
+                    self.ordem_pendente[seq] = dados
+            while self.proximo_entregar in self.ordem_pendente:
+                dados = self.ordem_pendente.pop(self.proximo_entregar)
+                self.ordem_recentes[self.proximo_entregar] = dados
+                if len(self.ordem_recentes) > self.capacidade_recentes:
+                    self.ordem_recentes.popitem(last=False)
+                self.proximo_entregar += 1
+                if dados is None or not self.mensagens_vistas.registrar(dados["id"]):
+                    continue
+                self.registrar_no_historico(dados)
+                proprio = self.aguardando_ordem.pop(dados["id"], None)
+                self.tratar_texto(proprio[1] if proprio else dados["texto"], None)
+
+            agendar = bool(self.ordem_pendente) and not self.lacuna_ordem_agendada
+            if agendar:
+                self.lacuna_ordem_agendada = True
+                esperado = self.proximo_entregar
+        if agendar:
+            self.agendar_apos(self.espera_ordem, self.verificar_lacuna_ordem, esperado)
+
+    # Enquanto houver lacuna, pede as mensagens que faltam sempre que a entrega não andou
+    def verificar_lacuna_ordem(self, esperado):
+        with self.lock_ordem:
+            self.lacuna_ordem_agendada = bool(self.ordem_pendente)
+            if not self.ordem_pendente:
+                return
+            parado = self.proximo_entregar == esperado
+            esperado, fim = self.proximo_entregar, min(self.ordem_pendente) - 1
+        if parado:
+            self.pedir_retransmissao(esperado, fim)
+        self.agendar_apos(self.espera_ordem, self.verificar_lacuna_ordem, esperado)
+
+    # Chamado com a última seq anunciada no heartbeat do coordenador
+    def verificar_fim_ordem(self, ultima):
+        with self.lock_ordem:
+            faltando = ultima >= self.proximo_entregar and not self.ordem_pendente
+            inicio = self.proximo_entregar
+        if faltando:
+            self.pedir_retransmissao(inicio, ultima)
+
+    def pedir_retransmissao(self, inicio, fim):
+        if self.coordenador or not self.coordenador_atual:
+            return
+        ip, porta = self.coordenador_atual
+        self.metricas.incrementar("ordem.retransmissoes")
+        self.enviar_sem_bloquear(ip, porta, codificar_quadro(TIPO_RETRANSMITIR, f"{self.ip} {self.porta} {inicio} {fim}"))
+
+    # Reenvia as mensagens pedidas que ainda estão guardadas; o coordenador marca como
+    # perdidas as que já saíram da janela de retransmissão
+    def tratar_retransmitir(self, corpo, conn):
+        ip, porta, inicio, fim = corpo.split()
+        inicio, fim = int(inicio), min(int(fim), int(inicio) + self.capacidade_recentes)
+        with self.lock_ordem:
+            lote = []
+            for seq in range(inicio, fim + 1):
+                if seq in self.ordem_recentes:
+                    lote.append([seq, self.ordem_recentes[seq]])
+                elif self.coordenador and seq < self.proximo_entregar:
+                    lote.append([seq, None])
+        if lote:
+            self.enviar_sem_bloquear(ip, int(porta), codificar_quadro(TIPO_ORDEM, json.dumps(lote)))
+
+    # Pede de novo a numeração das próprias mensagens que ainda não voltaram (todas, quando
+    # o coordenador mudou)
+    def reenviar_pedidos_ordem(self, todos=False):
+        limite = relogio.time() - self.espera_ordem
+        with self.lock_ordem:
+            atrasadas = [item for item in self.aguardando_ordem.values() if todos or item[2] <= limite]
+            for item in atrasadas:
+                item[2] = relogio.time()
+        for dados, _, _ in atrasadas:
+            self.pedir_ordem(dados)
+
+    # Quem entra na sala passa a exibir as mensagens numeradas depois de seq
+    def iniciar_ordem(self, seq):
+        with self.lock_ordem:
+            if seq >= self.proximo_entregar:
+                self.proximo_entregar = seq + 1
+                self.ordem_pendente = {s: d for s, d in self.ordem_pendente.items() if s > seq}
+        self.entregar_ordenadas([])
+
+    # ======================================================================================
+    # Continuidade da numeração após a eleição: o novo coordenador pede a todos a última
+    # seq entregue e as mensagens que ele não tem (SEQ_STATE), completa a própria ordem e,
+    # depois de timeout_eleicao, continua numerando a partir da maior seq conhecida. As
+    # seqs que ninguém tem são marcadas como perdidas e o que faltava a algum peer é
+    # difundido de novo. Os pedidos que chegam nesse meio tempo esperam o fim da troca
+    # ======================================================================================
+    def sincronizar_ordem(self):
+        with self.lock_ordem:
+            self.sincronizando_ordem = True
+            ultima = self.proximo_entregar - 1
+            self.maior_seq_sincronizacao = max([ultima, *self.ordem_pendente])
+            self.menor_seq_sincronizacao = ultima
+        self.difundir(codificar_quadro(TIPO_SEQ_STATE, json.dumps({"desde": ultima, "de": [self.ip, self.porta]})))
+        self.agendar_apos(self.timeout_eleicao, self.concluir_sincronizacao_ordem)
+
+    def tratar_seq_state(self, corpo, conn):
+        dados = json.loads(corpo)
+        if "desde" in dados:
+            with self.lock_ordem:
+                ultima = self.proximo_entregar - 1
+                mensagens = [[seq, m] for seq, m in self.ordem_recentes.items() if seq > dados["desde"]]
+                mensagens += [[seq, m] for seq, m in self.ordem_pendente.items() if seq > dados["desde"]]
+            ip, porta = dados["de"]
+            resposta = codificar_quadro(TIPO_SEQ_STATE, json.dumps({"ultima": ultima, "mensagens": mensagens}))
+            self.enviar_sem_bloquear(ip, porta, resposta)
+            return
+
+        with self.lock_ordem:
+            if not self.sincronizando_ordem:
+                return  # chegou depois do fim da troca
+            seqs = [seq for seq, _ in dados["mensagens"]]
+            self.maior_seq_sincronizacao = max([self.maior_seq_sincronizacao, dados["ultima"], *seqs])
+            self.menor_seq_sincronizacao = min(self.menor_seq_sincronizacao, dados["ultima"])
+        self.entregar_ordenadas(dados["mensagens"])
+
+    def concluir_sincronizacao_ordem(self):
+        with self.lock_ordem:
+            perdidas = [[seq, None] for seq in range(self.proximo_entregar, self.maior_seq_sincronizacao + 1)]
+        self.entregar_ordenadas(perdidas)
+        with self.lock_ordem:
+            self.proximo_seq = self.proximo_entregar
+            reenviar = [[seq, m] for seq, m in self.ordem_recentes.items() if seq > self.menor_seq_sincronizacao]
+            self.sincronizando_ordem = False
+        self.log.info(f"[SISTEMA] Numeração das mensagens continua a partir de {self.proximo_seq}.")
+        if reenviar:
+            self.difundir(codificar_quadro(TIPO_ORDEM, json.dumps(reenviar)))
+        self.sequenciar_pedidos()
 
     # ========================================================================
     # Encerra conexão do peer com a rede, saindo do chat e encerrando programa
     # ========================================================================
     def encerrar(self, via_exit=False):
-        print(f"\n[SISTEMA] {self.nome} encerrando...")
-        msg = f"EXIT {self.ip} {self.porta} {self.nome}"
+        self.log.info(f"\n[SISTEMA] {self.nome} encerrando...")
+        msg = codificar_quadro(TIPO_EXIT, f"{self.ip} {self.porta} {self.nome}")
 
         # Coordenador não anuncia sua própria saída
         if self.coordenador:
             if not via_exit:
-                print("[SISTEMA] Coordenador encerrando — saída será detectada por falha de heartbeat.")
+                self.log.info("[SISTEMA] Coordenador encerrando — saída será detectada por falha de heartbeat.")
                 sys.exit(0)
             else:
-                print("[SISTEMA] Coordenador saindo voluntariamente — escolhendo sucessor...")
+                self.log.info("[SISTEMA] Coordenador saindo voluntariamente — escolhendo sucessor...")
 
-                # Remove-se das estruturas locais (não será mais candidato)
-                if (self.ip, self.porta) in self.peers:
-                    try:
-                        self.peers.remove((self.ip, self.porta))
-                    except ValueError:
-                        pass
-                self.mapa_ids.pop((self.ip, self.porta), None)
-                self.mapa_nomes.pop((self.ip, self.porta), None)
+                # Remove-se da tabela de membros (não será mais candidato)
+                self.membros.remover(self.endereco)
 
                 # Notifica todos os peers com a lista atualizada e o mapa atualizado
                 # (assim todos sabem que o coordenador saiu e não o considerarão candidato)
-                self.notificar_peers(None)            # envia UPDATE com nova self.peers
-                self.enviar_mapas_para_peers()        # envia MAP_UPDATE com mapa sem o antigo coordenador
+                self.notificar_peers(None)            # envia UPDATE com a nova lista de membros
+                self.enviar_mapas_para_peers()        # envia MAP_UPDATE com a tabela sem o antigo coordenador
 
                 # Pede explicitamente que os outros iniciem eleição
-                for ip, porta in list(self.peers):
-                    if (ip, porta) != (self.ip, self.porta):
-                        try:
-                            Thread(target=self.cliente, args=(ip, porta, "START_ELECTION"), daemon=True).start()
-                        except:
-                            pass
+                self.difundir(codificar_quadro(TIPO_START_ELECTION))
 
                 # Marca que não é mais coordenador e sai
-                self.coordenador = False
-                self.em_eleicao = False
+                with self.lock_eleicao:
+                    self.papel = self.papel.com(coordenador=False, em_eleicao=False)
 
-                # Dá um pequeno tempo para pedidos serem enviados
-                time.sleep(0.5)
+                # Espera os pedidos saírem das filas de saída
+                self.enviador.aguardar()
 
                 # Não continua participando da eleição localmente (já saiu)
                 # e retorna para encerrar normalmente (não envia EXIT pois já fez UPDATE)
-                print("[SISTEMA] Transferência solicitada — finalizando processo do coordenador.")
+                self.log.info("[SISTEMA] Transferência solicitada — finalizando processo do coordenador.")
                 return
 
-        for ip, porta in list(self.peers):
-            if (ip, porta) != (self.ip, self.porta):
-                try:
-                    self.cliente(ip, porta, msg)
-                except:
-                    pass
-        print("[SISTEMA] Mensagem de saída enviada.")
+        # Pela fila de saída, depois das mensagens de chat que ainda não foram enviadas
+        self.difundir(msg)
+        self.enviador.aguardar()
+        self.log.info("[SISTEMA] Mensagem de saída enviada.")
+        if self.pool is not None:
+            self.pool.fechar()
         if not via_exit:
             sys.exit(0)
 
 # ============================================================
-# Verifica disponibilidade e validação da porta
+# Validação da porta. A disponibilidade é verificada pelo
+# próprio bind do servidor (abrir_servidor), feito uma única vez
 # ============================================================
-def porta_disponivel(porta):
-    """Verifica se a porta é válida e está livre para uso."""
-    # Verifica tipo e faixa numérica
+def porta_valida(porta):
+    """Verifica se a porta é um número válido (0 = escolhida pelo sistema)."""
     if not isinstance(porta, int):
         print("[ERRO] A porta deve ser um número inteiro.")
         return False
     if not (0 <= porta <= 65535):
         print("[ERRO] A porta deve estar entre 0 e 65535.")
         return False
+    return True
 
-    # Tenta fazer o bind (se der erro, já está em uso)
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        try:
-            s.bind(("localhost", porta))
-            return True
-        except OSError:
-            print(f"[ERRO] A porta {porta} já está sendo usada por outro processo.")
-            return False
+# ============================================================
+# O histórico em disco é opcional: --historico <diretório> ou,
+# em qualquer modo, a variável de ambiente CHAT_HISTORICO (o
+# histórico fica em <CHAT_HISTORICO>/<porta>)
+# ============================================================
+def diretorio_historico_padrao(porta):
+    base = os.environ.get("CHAT_HISTORICO")
+    return os.path.join(base, str(porta)) if base else None
+
+# ============================================================
+# Opções do modo sem perguntas, da linha de comando e (com
+# --config) de um arquivo JSON. As da linha de comando têm
+# prioridade; "peer" no arquivo são parâmetros da classe Peer
+# ============================================================
+def ler_opcoes(argv):
+    parser = argparse.ArgumentParser(description="Peer do chat. Sem argumentos, pergunta o nome e as portas no terminal.")
+    parser.add_argument("--config", help="arquivo JSON com as mesmas opções (nome, porta, coordenador...) e, em \"peer\", parâmetros da classe Peer")
+    parser.add_argument("--nome")
+    parser.add_argument("--ip", help="endereço do peer (padrão localhost)")
+    parser.add_argument("--porta", type=int, help="porta local; 0 = escolhida pelo sistema")
+    parser.add_argument("--coordenador", help="porta (ou ip:porta) de um coordenador; sem resposta, cria uma rede própria")
+    parser.add_argument("--historico", help="diretório do histórico em disco (padrão: <CHAT_HISTORICO>/<porta> ou nenhum)")
+    parser.add_argument("--sem-terminal", action="store_true", default=None,
+                        help="não lê mensagens da entrada padrão; sai (avisando os outros) com SIGINT ou SIGTERM")
+    args = parser.parse_args(argv)
+
+    opcoes = {"ip": "localhost", "coordenador": None, "sem_terminal": False, "peer": {}}
+    if args.config:
+        with open(args.config, encoding="utf-8") as arquivo:
+            opcoes.update(json.load(arquivo))
+    opcoes.update({chave: valor for chave, valor in vars(args).items() if valor is not None and chave != "config"})
+    if not opcoes.get("nome") or opcoes.get("porta") is None:
+        parser.error("informe --nome e --porta (ou use --config)")
+    if not porta_valida(opcoes["porta"]):
+        sys.exit(1)
+    coordenador = opcoes["coordenador"]
+    if coordenador is not None:
+        ip, _, porta = str(coordenador).rpartition(":")
+        opcoes["coordenador"] = (ip or opcoes["ip"], int(porta))
+    return opcoes
+
+# ============================================================
+# Modo sem perguntas: abre o servidor (um único bind), entra na
+# rede com um único JOIN e avisa na saída padrão que está pronto
+# ("[PRONTO] <ip> <porta>", útil com a porta 0)
+# ============================================================
+def executar_sem_perguntas(argv):
+    global EXITING
+    opcoes = ler_opcoes(argv)
+    try:
+        servidor = abrir_servidor(opcoes["ip"], opcoes["porta"], opcoes["peer"].get("backlog", 128))
+    except OSError as e:
+        print(f"[ERRO] Não foi possível ouvir em {opcoes['ip']}:{opcoes['porta']}: {e}")
+        sys.exit(1)
+    porta = servidor.getsockname()[1]
+    historico = opcoes.get("historico") or diretorio_historico_padrao(porta)
+    p = Peer(opcoes["nome"], opcoes["ip"], porta, diretorio_historico=historico, socket_servidor=servidor, **opcoes["peer"])
+
+    Thread(target=p.inicia_servidor, daemon=True).start()
+    if not p.pronto.wait(5) or p.trabalhadores is None:
+        sys.exit(1)
+    p.entrar_ou_criar_rede(opcoes["coordenador"])
+    print(f"[PRONTO] {p.ip} {p.porta}", flush=True)
+
+    if opcoes["sem_terminal"]:
+        saida = Event()
+        signal.signal(signal.SIGINT, lambda *args: saida.set())
+        signal.signal(signal.SIGTERM, lambda *args: saida.set())
+        saida.wait()
+        p.encerrar(via_exit=True)
+        return
+
+    EXITING = False
+    p.ler_terminal()
+    p.encerrar(via_exit=True)
 
 # ============================================================
 # Função main
@@ -540,6 +3443,9 @@ def porta_disponivel(porta):
 def main():
     global EXITING
     EXITING = False
+    if len(sys.argv) > 1:
+        executar_sem_perguntas(sys.argv[1:])
+        return
     while True:
         try:
             entrada = input("Digite seu nome e porta local (<nome> <porta>): ")
@@ -551,16 +3457,23 @@ def main():
                 continue
 
             porta = int(porta_str)
+            if not porta_valida(porta):
+                continue
 
-            # Verifica validade e disponibilidade
-            if porta_disponivel(porta):
-                break
+            # O bind do servidor do peer (se der erro, a porta já está em uso)
+            try:
+                servidor = abrir_servidor("localhost", porta)
+            except OSError:
+                print(f"[ERRO] A porta {porta} já está sendo usada por outro processo.")
+                continue
+            break
         except ValueError:
             print("[ERRO] Entrada inválida. Use o formato: <nome> <porta>")
         except Exception as e:
             print(f"[ERRO] {e}")
 
-    p = Peer(nome, "localhost", porta)
+    porta = servidor.getsockname()[1]  # com a porta 0, a escolhida pelo sistema
+    p = Peer(nome, "localhost", porta, diretorio_historico=diretorio_historico_padrao(porta), socket_servidor=servidor)
 
     def sair_falha(*args):
         p.encerrar(via_exit=False)
@@ -0,0 +1,465 @@
+import asyncio
+import json
+import sys
+
+from peer import (
+    Peer,
+    PREAMBULO_QUADROS,
+    DecodificadorQuadros,
+    codificar_quadro,
+    diretorio_historico_padrao,
+    expandir_lotes,
+    relogio,
+    tipo_da_mensagem,
+    TIPO_EXIT,
+    TIPO_START_ELECTION,
+    TIPO_RESPOSTA,
+    TIPO_HELLO,
+)
+
+# =======================================================================
+# Envolve o StreamWriter de uma conexão recebida, para que as respostas
+# dos tratadores (conn.send(...)) sejam escritas como quadros TIPO_RESPOSTA
+# (ou como texto puro, em conexões no formato antigo)
+# =======================================================================
+class ConexaoAsync:
+    def __init__(self, writer, quadros=True):
+        self.writer = writer
+        self.quadros = quadros
+
+    def send(self, dados):
+        if self.quadros:
+            dados = codificar_quadro(TIPO_RESPOSTA, dados)
+        self.writer.write(dados)
+        return len(dados)
+
+# =======================================================================
+# Peer baseado em asyncio: usa o mesmo protocolo, os mesmos tratadores de
+# mensagens e a mesma semântica de eleição e heartbeat da classe Peer, mas
+# o servidor, os envios, o heartbeat e o monitoramento são corrotinas em
+# um único event loop, sem criar uma thread por mensagem
+# =======================================================================
+class AsyncPeer(Peer):
+    # ============================================================
+    # Construtor da classe AsyncPeer
+    # ============================================================
+    def __init__(self, nome, ip, porta, timeout=5, tempo_ocioso=60, **opcoes):
+        # opcoes: demais parâmetros de Peer (intervalo_heartbeat, disseminacao, etc.)
+        if opcoes.get("politica_lenta") == "esperar":
+            raise ValueError('AsyncPeer não aceita a política "esperar": o event loop não pode esperar um destino.')
+        super().__init__(nome, ip, porta, **opcoes)
+        self.timeout = timeout  # timeout de conexão (segundos)
+        self.tempo_ocioso = tempo_ocioso  # conexões sem uso por mais tempo que isso são fechadas
+        self.loop = None  # event loop onde o peer executa
+        self.servidor = None  # servidor asyncio (asyncio.start_server)
+        self.conexoes = {}  # mapeia (ip, porta) -> StreamWriter da conexão persistente
+        self.ultimo_uso = {}  # mapeia (ip, porta) -> momento (loop.time()) do último envio
+        self.locks_conexao = {}  # evita abrir duas conexões para o mesmo peer ao mesmo tempo
+        self.tarefas = set()  # mantém referência às tarefas em execução
+        self.rotinas = []  # tarefas de longa duração (heartbeat, monitoramento, despejo)
+        self.ok_eleicao = asyncio.Event()  # os tratadores rodam no próprio loop
+        self.coordenador_eleito = asyncio.Event()
+
+    # ============================================================
+    # Agenda uma corrotina no loop do peer (pode ser chamado de
+    # qualquer thread, inclusive de dentro do próprio loop)
+    # ============================================================
+    def agendar(self, corrotina):
+        self.loop.call_soon_threadsafe(self._criar_tarefa, corrotina)
+
+    def _criar_tarefa(self, corrotina):
+        tarefa = self.loop.create_task(corrotina)
+        self.tarefas.add(tarefa)
+        tarefa.add_done_callback(self.tarefas.discard)
+
+    # Pontos de troca definidos pela classe Peer: em vez de criar threads,
+    # os envios e as tarefas em segundo plano viram tarefas no loop
+    def enviar_sem_bloquear(self, ip, porta, quadro):
+        self.loop.call_soon_threadsafe(self.enfileirar, (ip, porta), quadro)
+
+    def executar_em_segundo_plano(self, funcao, *args):
+        self.loop.call_soon_threadsafe(funcao, *args)
+
+    def agendar_apos(self, atraso, funcao, *args):
+        self.loop.call_soon_threadsafe(self.loop.call_later, atraso, funcao, *args)
+
+    # ======================================================================================
+    # Versão síncrona do envio, mantida para quem usa a interface da classe Peer a partir
+    # de outra thread. Com wait_response, bloqueia a thread chamadora até a resposta chegar
+    # (não deve ser chamada de dentro do loop)
+    # ======================================================================================
+    def cliente(self, ip, porta, mensagem, wait_response=False):
+        if isinstance(mensagem, str):
+            mensagem = codificar_quadro(*tipo_da_mensagem(mensagem))
+        if not wait_response:
+            self.enviar_sem_bloquear(ip, porta, mensagem)
+            return None
+        futuro = asyncio.run_coroutine_threadsafe(self.enviar_com_resposta(ip, porta, mensagem), self.loop)
+        return futuro.result()
+
+    # ===========================================================================
+    # Inicia o servidor asyncio e escuta novas conexões de outros peers
+    # ===========================================================================
+    async def inicia_servidor_async(self):
+        self.loop = asyncio.get_running_loop()
+        # server_socket: já aberto no construtor (porta 0) ou por quem criou o peer
+        self.servidor = await self.transporte.ouvir_async(self.tratar_conexao_async, self.ip, self.porta,
+                                                          self.backlog, sock=self.server_socket)
+        self.log.info(f"[SERVIDOR] {self.nome} ouvindo em {self.ip}:{self.porta}")
+
+    # ==================================================================================
+    # Lê as mensagens de uma conexão recebida (mesmo formato de Peer.tratar_conexao)
+    # ==================================================================================
+    async def tratar_conexao_async(self, reader, writer):
+        try:
+            data = b""
+            while len(data) < len(PREAMBULO_QUADROS) and PREAMBULO_QUADROS.startswith(data):
+                parte = await reader.read(65536)
+                if not parte:
+                    break
+                data += parte
+
+            if not data.startswith(PREAMBULO_QUADROS):
+                self.tratar_mensagem(data.decode('utf-8'), ConexaoAsync(writer, quadros=False))
+                return
+
+            decodificador = DecodificadorQuadros()
+            conn = ConexaoAsync(writer)
+            origem = None
+            self.metricas.incrementar("bytes_recebidos", len(data))
+            data = data[len(PREAMBULO_QUADROS):]
+            while True:
+                for tipo, corpo in expandir_lotes(decodificador.alimentar(data)):
+                    if tipo == TIPO_HELLO:
+                        origem = self.endereco_de(corpo)
+                        continue
+                    if origem is not None:
+                        self.registrar_atividade(origem)
+                    try:
+                        self.tratar_quadro(tipo, corpo, conn)
+                    except Exception as e:
+                        self.log.error(f"[ERRO SERVIDOR] {e}")
+                data = await reader.read(65536)
+                if not data:
+                    break
+                self.metricas.incrementar("bytes_recebidos", len(data))
+        except asyncio.CancelledError:
+            # O loop está sendo encerrado
+            pass
+        except Exception as e:
+            self.log.error(f"[ERRO SERVIDOR] {e}")
+        finally:
+            writer.close()
+
+    # ============================================================
+    # Envia um quadro pela conexão persistente do peer, abrindo
+    # (ou reabrindo) a conexão quando necessário
+    # ============================================================
+    async def enviar(self, ip, porta, quadro):
+        destino = (ip, porta)
+        # Uma nova tentativa é feita caso a conexão reaproveitada tenha caído
+        for _ in range(2):
+            writer = await self.obter_conexao(destino)
+            if writer is None:
+                return False
+            try:
+                writer.write(quadro)
+                await writer.drain()
+                self.metricas.contar_envio(quadro)
+                self.ultimo_uso[destino] = self.loop.time()
+                self.ultimo_envio[destino] = relogio.time()
+                return True
+            except (ConnectionError, OSError):
+                self.descartar_conexao(destino, writer)
+        return False
+
+    async def obter_conexao(self, destino):
+        writer = self.conexoes.get(destino)
+        if writer is not None and not writer.is_closing():
+            return writer
+
+        lock = self.locks_conexao.setdefault(destino, asyncio.Lock())
+        async with lock:
+            writer = self.conexoes.get(destino)
+            if writer is not None and not writer.is_closing():
+                return writer
+            inicio = self.loop.time()
+            try:
+                reader, writer = await asyncio.wait_for(self.transporte.conectar_async(destino), self.timeout)
+            except (OSError, asyncio.TimeoutError):
+                self.metricas.incrementar("conexao.falhas")
+                return None
+            self.metricas.observar("conexao", (self.loop.time() - inicio) * 1000)
+            writer.write(PREAMBULO_QUADROS + self.saudacao)
+            self.conexoes[destino] = writer
+            self._criar_tarefa(self.vigiar_conexao(destino, reader, writer))
+            return writer
+
+    # O outro lado só escreve em uma conexão persistente para fechá-la: quando a
+    # leitura termina, a conexão é descartada e o próximo envio abre outra
+    async def vigiar_conexao(self, destino, reader, writer):
+        try:
+            while await reader.read(65536):
+                pass
+        except (ConnectionError, OSError):
+            pass
+        self.descartar_conexao(destino, writer)
+
+    def descartar_conexao(self, destino, writer):
+        if self.conexoes.get(destino) is writer:
+            del self.conexoes[destino]
+        writer.close()
+
+    # ============================================================
+    # Envia um quadro em uma conexão própria e espera a resposta
+    # (usado no JOIN)
+    # ============================================================
+    async def enviar_com_resposta(self, ip, porta, quadro):
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(self.transporte.conectar_async((ip, porta)), self.timeout)
+            writer.write(PREAMBULO_QUADROS + self.saudacao + quadro)
+            await writer.drain()
+            self.metricas.contar_envio(quadro)
+            decodificador = DecodificadorQuadros()
+            while True:
+                data = await asyncio.wait_for(reader.read(65536), self.timeout)
+                if not data:
+                    return None
+                for tipo, corpo in decodificador.alimentar(data):
+                    if tipo == TIPO_RESPOSTA:
+                        return corpo.decode('utf-8')
+        except (OSError, asyncio.TimeoutError):
+            return None
+        finally:
+            if writer is not None:
+                writer.close()
+
+    # ==================================================================================
+    # Mesmo agrupamento de EnviadorLotes (janela, limite de bytes, de fila e de créditos,
+    # política para consumidores lentos, disjuntor e as mesmas métricas), com uma tarefa
+    # por destino esvaziando a fila. Como o loop não pode bloquear, a política "esperar"
+    # não é aceita (ver __init__); writer.drain() segura a tarefa do destino (e os
+    # créditos dele) quando o outro lado lê devagar
+    # ==================================================================================
+    def enfileirar(self, destino, quadro):
+        enviador = self.enviador
+        fila = enviador.filas.get(destino)
+        if fila is None:
+            fila = enviador.criar_fila(destino)
+        admissao = enviador.admitir(destino, fila, quadro)
+        if admissao == "descartado":
+            return
+        if admissao == "fila":
+            fila.adicionar(quadro)
+        if destino not in enviador.ativos:
+            enviador.ativos.add(destino)
+            self._criar_tarefa(self.esvaziar_fila(destino, fila))
+
+    async def esvaziar_fila(self, destino, fila):
+        enviador = self.enviador
+        try:
+            while fila.recarregar(enviador.limite_bytes):
+                restante = fila.quadros[0][1] + enviador.janela - relogio.monotonic()
+                if fila.bytes < enviador.limite_bytes and restante > 0:
+                    await asyncio.sleep(restante)
+                    if not fila.quadros:
+                        continue  # a fila foi descartada durante a espera (desconectar, disjuntor)
+                lote, quantidade, primeiro = fila.retirar_lote(enviador.limite_bytes)
+                enviado = await self.enviar(destino[0], destino[1], lote)
+                fila.registrar_envio(quantidade, primeiro)
+                enviador.registrar_resultado(destino, fila, enviado)
+        finally:
+            enviador.ativos.discard(destino)
+            fila.fechar_transbordo()
+
+    def desconectar_destino(self, destino):
+        writer = self.conexoes.get(destino)
+        if writer is not None:
+            self.descartar_conexao(destino, writer)
+
+    # ============================================================
+    # Fecha periodicamente as conexões que ficaram ociosas
+    # ============================================================
+    async def despejar_ociosas(self):
+        while True:
+            await asyncio.sleep(max(1, self.tempo_ocioso / 4))
+            agora = self.loop.time()
+            for destino, writer in list(self.conexoes.items()):
+                if agora - self.ultimo_uso.get(destino, agora) > self.tempo_ocioso:
+                    self.descartar_conexao(destino, writer)
+
+    # ===========================================================================
+    # ELEIÇÃO (BULLY) - mesma lógica (e mesmo tempo máximo) de Peer.iniciar_eleicao,
+    # com os envios e as esperas feitos como corrotinas
+    # ===========================================================================
+    def iniciar_eleicao(self):
+        self.agendar(self.eleicao_async())
+
+    async def eleicao_async(self):
+        if not self.comecar_eleicao():
+            return
+        try:
+            for _ in range(self.rodadas_eleicao):
+                quadro = self.quadro_eleicao()
+                resultados = await asyncio.gather(*(
+                    self.enviar_com_tentativas_async(ip, porta, quadro)
+                    for ip, porta in self.candidatos_eleicao()
+                ))
+                if not any(resultados) or not await self.esperar_evento(self.ok_eleicao, self.timeout_eleicao):
+                    break
+                if await self.esperar_evento(self.coordenador_eleito, self.espera_coordenador):
+                    return
+                self.log.info("[ELEIÇÃO] Nenhum coordenador anunciado. Repetindo a eleição...")
+                self.ok_eleicao.clear()
+            if not self.coordenador_eleito.is_set():
+                self.assumir_coordenacao()
+        finally:
+            self.terminar_eleicao()
+
+    async def enviar_com_tentativas_async(self, ip, porta, quadro):
+        for _ in range(self.tentativas_eleicao):
+            try:
+                if await asyncio.wait_for(self.enviar(ip, porta, quadro), self.timeout_eleicao):
+                    return True
+            except asyncio.TimeoutError:
+                pass
+        return False
+
+    async def esperar_evento(self, evento, timeout):
+        try:
+            await asyncio.wait_for(evento.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    # ===============================================================================
+    # HEARTBEAT - mesma rodada de Peer.rodada_heartbeat; os envios viram tarefas no
+    # loop e acontecem ao mesmo tempo
+    # ===============================================================================
+    async def heartbeat_async(self):
+        while True:
+            self.rodada_heartbeat()
+            await asyncio.sleep(self.intervalo_heartbeat)
+
+    async def monitorar_coordenador_async(self):
+        while True:
+            if self.verificar():
+                # Para evitar múltiplos disparos
+                await asyncio.sleep(self.intervalo_heartbeat)
+            await asyncio.sleep(self.intervalo_verificacao)
+
+    # ===================================================================
+    # Inicia o peer: servidor, entrada (ou criação) da rede, heartbeat
+    # e monitoramento do coordenador
+    # ===================================================================
+    async def iniciar_async(self, coordenador=None):
+        await self.inicia_servidor_async()
+
+        resposta = None
+        if coordenador is not None:
+            resposta = await self.enviar_com_resposta(coordenador[0], coordenador[1], self.quadro_join())
+        if resposta:
+            self.aplicar_resposta_join(coordenador[0], coordenador[1], resposta)
+        else:
+            if coordenador is not None:
+                self.log.info(f"[SISTEMA] Nenhum coordenador encontrado em {coordenador[0]}:{coordenador[1]}. Criando rede própria para {self.nome}...")
+            self.criar_rede()
+
+        rotinas = [self.heartbeat_async(), self.monitorar_coordenador_async(), self.despejar_ociosas()]
+        if self.arquivo_metricas:
+            rotinas.append(self.despejar_metricas_async())
+        for rotina in rotinas:
+            self.rotinas.append(self.loop.create_task(rotina))
+
+    async def despejar_metricas_async(self):
+        while True:
+            await asyncio.sleep(self.intervalo_metricas)
+            self.gravar_metricas()
+
+    # Queda sem aviso (ver Peer.parar): além do servidor, para as rotinas, os envios e as
+    # conexões persistentes. Chamado de dentro do event loop
+    def parar(self):
+        super().parar()
+        for tarefa in self.rotinas + list(self.tarefas):
+            tarefa.cancel()
+        if self.servidor is not None:
+            self.servidor.close()
+        for writer in list(self.conexoes.values()):
+            writer.close()
+        self.conexoes.clear()
+
+    # ========================================================================
+    # Sai do chat: o coordenador pede que os outros peers iniciem a eleição;
+    # os demais peers anunciam a saída com EXIT. Depois fecha as conexões
+    # ========================================================================
+    async def encerrar_async(self):
+        self.log.info(f"\n[SISTEMA] {self.nome} encerrando...")
+        outros = [endereco for endereco in self.membros.enderecos() if endereco != self.endereco]
+        if self.coordenador:
+            self.membros.remover(self.endereco)
+            self.notificar_peers(None)
+            self.enviar_mapas_para_peers()
+            quadro = codificar_quadro(TIPO_START_ELECTION)
+            with self.lock_eleicao:
+                self.papel = self.papel.com(coordenador=False)
+        else:
+            quadro = codificar_quadro(TIPO_EXIT, f"{self.ip} {self.porta} {self.nome}")
+        # Pela fila de saída, para chegar depois do UPDATE e do MAP_UPDATE já enfileirados
+        for destino in outros:
+            self.enfileirar(destino, quadro)
+
+        # Para as rotinas e espera os envios pendentes (e as filas de saída) antes de fechar as conexões
+        for rotina in self.rotinas:
+            rotina.cancel()
+        await asyncio.sleep(0)
+        pendentes = [t for t in self.tarefas if t is not asyncio.current_task()]
+        if pendentes:
+            await asyncio.wait(pendentes, timeout=self.timeout)
+        for writer in list(self.conexoes.values()):
+            writer.close()
+        self.conexoes.clear()
+        if self.servidor is not None:
+            self.servidor.close()
+        if self.historico is not None:
+            self.historico.fechar()
+        self.log.info("[SISTEMA] Mensagem de saída enviada.")
+
+# ============================================================
+# Executa um AsyncPeer lendo as mensagens do chat da entrada padrão
+# Uso: python peer_async.py <nome> <porta> [porta_do_coordenador]
+# ============================================================
+async def executar(nome, porta, porta_coordenador=None):
+    p = AsyncPeer(nome, "localhost", porta, diretorio_historico=diretorio_historico_padrao(porta))
+    coordenador = ("localhost", porta_coordenador) if porta_coordenador is not None else None
+    await p.iniciar_async(coordenador)
+    print("\n[SISTEMA] Digite 'LIST' para ver peers (nome, ID, IP e porta), 'STATS' para ver as métricas ou 'EXIT' para sair.\n")
+
+    loop = asyncio.get_running_loop()
+    while True:
+        entrada = await loop.run_in_executor(None, sys.stdin.readline)
+        if not entrada or entrada.strip() == "EXIT":
+            break
+        entrada = entrada.rstrip("\n")
+        if entrada == "LIST":
+            for membro in p.membros:
+                print(f"{membro.nome or 'Desconhecido'} [{membro.id}] -> {membro.endereco}")
+        elif entrada == "STATS":
+            print(json.dumps(p.exportar_metricas(), indent=2, ensure_ascii=False))
+        elif entrada.strip():
+            p.enviar_mensagem(entrada)
+    await p.encerrar_async()
+
+def main():
+    if len(sys.argv) not in (3, 4) or not all(a.isdigit() for a in sys.argv[2:]):
+        print("Uso: python peer_async.py <nome> <porta> [porta_do_coordenador]")
+        sys.exit(1)
+    nome, porta = sys.argv[1], int(sys.argv[2])
+    porta_coordenador = int(sys.argv[3]) if len(sys.argv) == 4 else None
+    try:
+        asyncio.run(executar(nome, porta, porta_coordenador))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+import multiprocessing
+import selectors
+import socket
+import struct
+import time
+from collections import deque
+from multiprocessing import shared_memory
+from threading import Thread
+
+from peer import (
+    PREAMBULO_QUADROS,
+    PRIORIDADE_CHAT,
+    PRIORIDADE_CONTROLE,
+    PRIORIDADE_POR_TIPO,
+    DecodificadorQuadros,
+    codificar_quadro,
+    expandir_lotes,
+    log,
+    TIPO_HELLO,
+    TIPO_JOIN,
+    TIPO_STATS,
+)
+
+# Quadros que o tratador responde pela própria conexão (conn.send): a conexão é entregue
+# ao processo do peer, que é quem tem o estado para responder
+TIPOS_COM_RESPOSTA = {TIPO_JOIN, TIPO_STATS}
+
+CABECALHO_ANEL = struct.Struct("!QQ")  # total de bytes escritos (cabeça) e lidos (cauda) desde a criação
+CABECALHO_REGISTRO_ANEL = struct.Struct("!IBB")  # tamanho do corpo, tipo e tamanho da origem ("ip porta")
+PULO = 0xFFFFFFFF  # no lugar do tamanho: o resto do anel está vazio e o próximo registro está no início
+TAMANHO_ENTREGA = struct.Struct("!I")  # tamanho dos bytes já lidos de uma conexão entregue ao peer
+
+# =========================================================================================
+# Anel em memória compartilhada com um único produtor (um processo de recepção) e um único
+# consumidor (uma thread do processo do peer). Cada lado só escreve a própria posição no
+# cabeçalho, então não há lock: o produtor grava o registro e só depois avança a cabeça;
+# o consumidor lê até a cabeça e depois avança a cauda, liberando o espaço
+# =========================================================================================
+class AnelCompartilhado:
+    def __init__(self, nome=None, capacidade=4 * 1024 * 1024):
+        if nome is None:
+            self.memoria = shared_memory.SharedMemory(create=True, size=CABECALHO_ANEL.size + capacidade)
+            CABECALHO_ANEL.pack_into(self.memoria.buf, 0, 0, 0)
+        else:
+            self.memoria = shared_memory.SharedMemory(name=nome)  # só quem cria o anel o apaga (fechar)
+        self.nome = self.memoria.name
+        self.criador = nome is None
+        self.capacidade = capacidade
+        self.cabeca, self.cauda = CABECALHO_ANEL.unpack_from(self.memoria.buf, 0)
+
+    # O registro cabe no anel (vazio)? Os maiores que meio anel não são gravados
+    def cabe(self, origem, corpo):
+        return CABECALHO_REGISTRO_ANEL.size + len(origem) + len(corpo) <= self.capacidade // 2
+
+    # Produtor: grava um registro sem esperar. Retorna False se o anel não tem espaço
+    # agora (o consumidor ainda não liberou) ou se o registro não cabe no anel
+    def escrever(self, tipo, origem, corpo):
+        buf = self.memoria.buf
+        tamanho = CABECALHO_REGISTRO_ANEL.size + len(origem) + len(corpo)
+        if not self.cabe(origem, corpo):
+            return False
+        inicio = self.cabeca % self.capacidade
+        pulo = self.capacidade - inicio if self.capacidade - inicio < tamanho else 0
+        cauda = struct.unpack_from("!Q", buf, 8)[0]
+        if self.cabeca + pulo + tamanho - cauda > self.capacidade:
+            return False
+        if pulo:
+            if pulo >= CABECALHO_REGISTRO_ANEL.size:
+                struct.pack_into("!I", buf, CABECALHO_ANEL.size + inicio, PULO)
+            self.cabeca += pulo
+            inicio = 0
+        posicao = CABECALHO_ANEL.size + inicio
+        CABECALHO_REGISTRO_ANEL.pack_into(buf, posicao, len(corpo), tipo, len(origem))
+        posicao += CABECALHO_REGISTRO_ANEL.size
+        buf[posicao:posicao + len(origem)] = origem
+        buf[posicao + len(origem):posicao + len(origem) + len(corpo)] = corpo
+        self.cabeca += tamanho
+        struct.pack_into("!Q", buf, 0, self.cabeca)
+        return True
+
+    # Consumidor: lê todos os registros disponíveis, como (tipo, origem, corpo)
+    def ler(self):
+        buf = self.memoria.buf
+        cabeca = struct.unpack_from("!Q", buf, 0)[0]
+        registros = []
+        while self.cauda < cabeca:
+            inicio = self.cauda % self.capacidade
+            restante = self.capacidade - inicio
+            if restante < CABECALHO_REGISTRO_ANEL.size:
+                self.cauda += restante
+                continue
+            posicao = CABECALHO_ANEL.size + inicio
+            tamanho, tipo, tamanho_origem = CABECALHO_REGISTRO_ANEL.unpack_from(buf, posicao)
+            if tamanho == PULO:
+                self.cauda += restante
+                continue
+            posicao += CABECALHO_REGISTRO_ANEL.size
+            origem = bytes(buf[posicao:posicao + tamanho_origem])
+            corpo = bytes(buf[posicao + tamanho_origem:posicao + tamanho_origem + tamanho])
+            registros.append((tipo, origem, corpo))
+            self.cauda += CABECALHO_REGISTRO_ANEL.size + tamanho_origem + tamanho
+        struct.pack_into("!Q", buf, 8, self.cauda)
+        return registros
+
+    def ocupacao(self):
+        cabeca, cauda = CABECALHO_ANEL.unpack_from(self.memoria.buf, 0)
+        return cabeca - cauda
+
+    def fechar(self):
+        self.memoria.close()
+        if self.criador:
+            self.memoria.unlink()
+
+# ==========================================================================================
+# Recepção em vários processos. Cada processo abre o seu socket de escuta na porta do peer
+# (SO_REUSEPORT: o sistema distribui as conexões entre eles), lê as conexões, separa os
+# quadros (abrindo os lotes) e os grava em dois anéis: um só para os quadros de controle
+# (heartbeat e eleição), que assim nunca esperam atrás do chat, e outro para os demais.
+# No processo do peer, uma thread por anel lê os quadros e os entrega aos trabalhadores;
+# o tratamento continua no processo do peer, que é o único dono do estado (membros,
+# eleição, histórico). Conexões que pedem resposta (JOIN, STATS), do formato antigo ou
+# com quadros maiores que o anel são entregues inteiras ao peer, com o descritor do socket
+# ==========================================================================================
+class RecepcaoProcessos:
+    def __init__(self, peer, processos, capacidade=4 * 1024 * 1024):
+        self.peer = peer
+        self.num_processos = processos
+        self.capacidade = capacidade
+        self.processos = []
+        self.aneis = []
+        self.canais = []
+        self.ativo = None
+
+    def iniciar(self, timeout=10):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            log.error("[ERRO SERVIDOR] Este sistema não tem SO_REUSEPORT.")
+            return False
+        contexto = multiprocessing.get_context("spawn")
+        self.ativo = contexto.Event()
+        self.ativo.set()
+        prontos = []
+        for _ in range(self.num_processos):
+            aneis = [AnelCompartilhado(capacidade=self.capacidade) for _ in range(2)]  # controle e demais
+            semaforos = [contexto.Semaphore(0) for _ in aneis]
+            canal, canal_processo = socket.socketpair()
+            pronto = contexto.Event()
+            processo = contexto.Process(
+                target=processo_recepcao, daemon=True,
+                args=(self.peer.ip, self.peer.porta, self.peer.backlog, [a.nome for a in aneis], self.capacidade,
+                      semaforos, canal_processo, pronto, self.ativo),
+            )
+            processo.start()
+            canal_processo.close()
+            self.processos.append(processo)
+            self.aneis.extend(aneis)
+            self.canais.append(canal)
+            prontos.append(pronto)
+            for anel, semaforo in zip(aneis, semaforos):
+                Thread(target=self.consumir, args=(anel, semaforo), daemon=True).start()
+            Thread(target=self.receber_conexoes, args=(canal,), daemon=True).start()
+
+        limite = time.monotonic() + timeout
+        while not all(p.is_set() for p in prontos):
+            if time.monotonic() >= limite or not all(p.is_alive() for p in self.processos):
+                return False
+            time.sleep(0.01)
+        self.peer.metricas.registrar_medidor("aneis_recepcao", lambda: [a.ocupacao() for a in self.aneis])
+        return True
+
+    def consumir(self, anel, semaforo):
+        peer = self.peer
+        while self.ativo.is_set():
+            if not semaforo.acquire(timeout=0.5):
+                continue
+            registros = anel.ler()
+            for tipo, origem, corpo in registros:
+                peer.receber_quadro(tipo, corpo, None, peer.endereco_de(origem) if origem else None)
+            peer.metricas.incrementar("bytes_recebidos", sum(len(corpo) for _, _, corpo in registros))
+
+    # Conexões entregues por um processo de recepção: o descritor do socket e os bytes
+    # que ele já tinha lido, tratados por Peer.tratar_conexao como uma conexão aceita aqui
+    def receber_conexoes(self, canal):
+        while self.ativo.is_set():
+            try:
+                mensagem, descritores, _, _ = socket.recv_fds(canal, TAMANHO_ENTREGA.size, 1)
+                if not mensagem or not descritores:
+                    return
+                dados = receber_exato(canal, TAMANHO_ENTREGA.unpack(mensagem)[0])
+            except OSError:
+                return
+            conexao = socket.socket(fileno=descritores[0])
+            conexao.setblocking(True)
+            self.peer.metricas.incrementar("recepcao.conexoes_entregues")
+            Thread(target=self.peer.tratar_conexao, args=(conexao, dados), daemon=True).start()
+
+    def parar(self):
+        if self.ativo is not None:
+            self.ativo.clear()
+        for processo in self.processos:
+            processo.join(1)
+            if processo.is_alive():
+                processo.terminate()
+        for canal in self.canais:
+            canal.close()
+        time.sleep(0.6)  # as threads que leem os anéis saem em até meio segundo
+        for anel in self.aneis:
+            anel.fechar()
+
+def receber_exato(sock, tamanho):
+    dados = bytearray()
+    while len(dados) < tamanho:
+        parte = sock.recv(tamanho - len(dados))
+        if not parte:
+            raise OSError("canal fechado")
+        dados += parte
+    return bytes(dados)
+
+# ======================================================================================
+# Processo de recepção: um único thread, com selectors, atende todas as conexões que o
+# sistema entregar a este processo. anel[0] recebe os quadros de controle e anel[1] os
+# demais; cada anel tem um semáforo, liberado uma vez por leitura que gravou nele
+# ======================================================================================
+def processo_recepcao(ip, porta, backlog, nomes_aneis, capacidade, semaforos, canal, pronto, ativo):
+    aneis = [AnelCompartilhado(nome, capacidade) for nome in nomes_aneis]
+    servidor = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        servidor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        servidor.bind((ip, porta))
+        servidor.listen(backlog)
+    except OSError as e:
+        log.error(f"[ERRO SERVIDOR] Não foi possível ouvir em {ip}:{porta}: {e}")
+        return
+    servidor.setblocking(False)
+    seletor = selectors.DefaultSelector()
+    seletor.register(servidor, selectors.EVENT_READ)
+    pronto.set()
+
+    # Estado de cada conexão: [bytes lidos antes do preâmbulo, decodificador, origem,
+    # quadros ainda não gravados]
+    pausadas = {}  # conexões que não são lidas enquanto o anel do próximo quadro está cheio
+
+    def entregar(sock, dados):
+        seletor.unregister(sock)
+        socket.send_fds(canal, [TAMANHO_ENTREGA.pack(len(dados))], [sock.fileno()])
+        canal.sendall(dados)
+        sock.close()
+
+    def fechar(sock):
+        seletor.unregister(sock)
+        sock.close()
+
+    def anel_do_tipo(tipo):
+        return 0 if PRIORIDADE_POR_TIPO.get(tipo, PRIORIDADE_CHAT) == PRIORIDADE_CONTROLE else 1
+
+    # Grava os quadros pendentes da conexão, em ordem, e retorna os anéis gravados. Se o
+    # anel de um quadro está cheio, a conexão sai do seletor (o TCP segura quem envia) e
+    # volta quando o consumidor liberar espaço; as demais conexões continuam sendo lidas
+    def gravar(sock, estado):
+        gravados = set()
+        pendentes = estado[3]
+        while pendentes:
+            tipo, corpo = pendentes[0]
+            if tipo == TIPO_HELLO:
+                estado[2] = corpo
+                pendentes.popleft()
+                continue
+            indice = anel_do_tipo(tipo)
+            if tipo not in TIPOS_COM_RESPOSTA and aneis[indice].cabe(estado[2], corpo):
+                if not aneis[indice].escrever(tipo, estado[2], corpo):
+                    seletor.unregister(sock)
+                    pausadas[sock] = estado
+                    break
+                gravados.add(indice)
+                pendentes.popleft()
+                continue
+            # O peer continua a conexão deste quadro em diante
+            resto = PREAMBULO_QUADROS + (codificar_quadro(TIPO_HELLO, estado[2]) if estado[2] else b"")
+            resto += b"".join(codificar_quadro(t, c) for t, c in pendentes) + bytes(estado[1].buffer)
+            entregar(sock, resto)
+            break
+        return gravados
+
+    while ativo.is_set():
+        gravados = set()
+        for sock, estado in list(pausadas.items()):
+            # Só volta a ler a conexão quando o anel esvaziou até a metade, para não
+            # alternar a cada registro liberado
+            anel = aneis[anel_do_tipo(estado[3][0][0])]
+            if anel.ocupacao() > anel.capacidade // 2:
+                continue
+            del pausadas[sock]
+            seletor.register(sock, selectors.EVENT_READ, estado)
+            gravados |= gravar(sock, estado)
+
+        for chave, _ in seletor.select(0.005 if pausadas else 0.5):
+            if chave.fileobj is servidor:
+                try:
+                    conexao, _ = servidor.accept()
+                except OSError:
+                    continue
+                conexao.setblocking(False)
+                seletor.register(conexao, selectors.EVENT_READ, [b"", None, b"", deque()])
+                continue
+
+            sock, estado = chave.fileobj, chave.data
+            try:
+                data = sock.recv(65536)
+            except BlockingIOError:
+                continue
+            except OSError:
+                data = b""
+            if not data:
+                fechar(sock)
+                continue
+            if estado[1] is None:
+                estado[0] += data
+                if len(estado[0]) < len(PREAMBULO_QUADROS) and PREAMBULO_QUADROS.startswith(estado[0]):
+                    continue
+                if not estado[0].startswith(PREAMBULO_QUADROS):
+                    entregar(sock, estado[0])  # formato antigo (texto)
+                    continue
+                estado[1] = DecodificadorQuadros()
+                data = estado[0][len(PREAMBULO_QUADROS):]
+
+            try:
+                estado[3].extend(expandir_lotes(estado[1].alimentar(data)))
+            except ValueError:
+                fechar(sock)  # quadro acima do tamanho máximo
+                continue
+            gravados |= gravar(sock, estado)
+        for indice in gravados:
+            semaforos[indice].release()
+
+    for sock in pausadas:
+        sock.close()
+    seletor.close()
+    servidor.close()
+    for anel in aneis:
+        anel.fechar()
@@ -0,0 +1,436 @@
+import heapq
+import json
+import socket
+import sys
+import time
+from threading import Thread, Lock, Condition, Event
+
+from peer import (
+    Peer,
+    PREAMBULO_QUADROS,
+    PRIORIDADE_CHAT,
+    PRIORIDADE_CONTROLE,
+    PRIORIDADE_POR_TIPO,
+    NOMES_PRIORIDADES,
+    DecodificadorQuadros,
+    ConexaoQuadros,
+    EnviadorLotes,
+    LogPeer,
+    Metricas,
+    PoolConexoes,
+    PoolTrabalhadores,
+    TransporteTCP,
+    abrir_sala,
+    codificar_quadro,
+    configurar_log,
+    envelopar_sala,
+    expandir_lotes,
+    log,
+    porta_valida,
+    relogio,
+    TIPO_HEARTBEAT,
+    TIPO_HELLO,
+    TIPO_SALA,
+    TIPO_STATS,
+)
+
+# =======================================================================
+# Executa as tarefas com atraso (agendar_apos) de todas as salas em uma
+# única thread, em vez de um Timer (uma thread) por tarefa. As tarefas
+# devem ser rápidas; as que bloqueiam (eleição) continuam em threads
+# =======================================================================
+class Agendador:
+    def __init__(self):
+        self.tarefas = []  # heap de (instante, ordem, funcao, args)
+        self.ordem = 0  # desempata tarefas com o mesmo instante
+        self.condicao = Condition()
+        self.ativo = True
+        Thread(target=self.executar, daemon=True).start()
+
+    def agendar(self, atraso, funcao, *args):
+        with self.condicao:
+            self.ordem += 1
+            heapq.heappush(self.tarefas, (time.monotonic() + atraso, self.ordem, funcao, args))
+            self.condicao.notify()
+
+    def executar(self):
+        while True:
+            with self.condicao:
+                while self.ativo and (not self.tarefas or self.tarefas[0][0] > time.monotonic()):
+                    self.condicao.wait(self.tarefas[0][0] - time.monotonic() if self.tarefas else None)
+                if not self.ativo:
+                    return
+                _, _, funcao, args = heapq.heappop(self.tarefas)
+            try:
+                funcao(*args)
+            except Exception as e:
+                log.error(f"[ERRO] Tarefa agendada falhou: {e}")
+
+    def parar(self):
+        with self.condicao:
+            self.ativo = False
+            self.condicao.notify()
+
+# =======================================================================
+# Uma sala (chat) dentro de um ServidorSalas. Tem os próprios membros,
+# coordenador, eleição e detector de falhas (toda a lógica da classe
+# Peer), mas usa a porta, os trabalhadores, as filas de saída e o
+# agendador do servidor. Os quadros enviados levam o nome da sala
+# =======================================================================
+class PeerSala(Peer):
+    def __init__(self, servidor, sala, nome, **opcoes):
+        opcoes.setdefault("transporte", servidor.transporte)
+        super().__init__(nome, servidor.ip, servidor.porta, **opcoes)
+        self.servidor = servidor
+        self.sala = sala
+        self.log = LogPeer(log, {"peer": f"{nome}@{servidor.ip}:{servidor.porta}/{sala}"})
+        self.trabalhadores = servidor.trabalhadores
+        self.enviador = servidor.enviador
+        self.ultimo_envio = servidor.ultimo_envio  # um envio para o host serve de sinal de vida em todas as salas
+        self.pool = None  # as conexões são do servidor
+        self.proximo_heartbeat = 0.0  # momentos (relogio.time()) das próximas rotinas desta sala
+        self.proxima_verificacao = 0.0
+
+    # Pontos de troca definidos pela classe Peer. A sala padrão ("") não usa envelope,
+    # para conversar com peers comuns (classe Peer)
+    def envelope(self, quadro):
+        return envelopar_sala(self.sala, quadro) if self.sala else quadro
+
+    def enviar_sem_bloquear(self, ip, porta, quadro):
+        self.enviador.enfileirar((ip, porta), self.envelope(quadro))
+
+    # As filas de saída são do servidor e continuam depois que a sala para
+    def fechar_envio(self):
+        pass
+
+    def agendar_apos(self, atraso, funcao, *args):
+        self.servidor.agendador.agendar(atraso, funcao, *args)
+
+    def iniciar_rotinas(self):
+        pass  # heartbeat e monitoramento são feitos por ServidorSalas.rotinas
+
+    def tratar_texto(self, corpo, conn):
+        if corpo.strip():
+            prefixo = f"[{self.sala}] " if self.sala else ""
+            self.log.info(f"\n{prefixo}> {corpo}", extra={"evento": "chat"})
+
+# ==========================================================================================
+# Servidor de salas: um único socket de escuta, um pool de trabalhadores, uma fila de saída
+# por destino (as mensagens de todas as salas para o mesmo host vão juntas nos lotes) e uma
+# thread de rotinas para todas as salas. O heartbeat é por host: um único HEARTBEAT (sem
+# sala) para cada host remoto, que serve de sinal de vida em todas as salas em que ele está
+# ==========================================================================================
+class ServidorSalas:
+    def __init__(self, ip, porta, usar_pool=False, trabalhadores=4, backlog=128, intervalo_heartbeat=5.0,
+                 janela_envio=0.002, limite_lote=64 * 1024, limite_fila_envio=1024, politica_lenta="descartar_antigas",
+                 limite_creditos=1024 * 1024, diretorio_transbordo=None, falhas_disjuntor=3, transporte=None):
+        # Com a porta 0, o socket de escuta é aberto aqui, para que o endereço anunciado
+        # (HELLO e JOIN das salas) já seja o da porta escolhida pelo sistema
+        self.transporte = transporte if transporte is not None else TransporteTCP()  # também usado pelas salas
+        self.server_socket = self.transporte.ouvir(ip, 0, backlog) if porta == 0 else None
+        if self.server_socket is not None:
+            porta = self.server_socket.getsockname()[1]
+        self.ip = ip
+        self.porta = porta
+        self.endereco = (ip, porta)
+        self.salas = {}  # mapeia nome da sala -> PeerSala
+        self.lock_salas = Lock()
+        if not log.handlers:
+            configurar_log()
+        self.log = LogPeer(log, {"peer": f"salas@{ip}:{porta}"})
+        self.metricas = Metricas()
+        self.saudacao = codificar_quadro(TIPO_HELLO, f"{ip} {porta}")
+        self.pool = PoolConexoes(saudacao=self.saudacao, metricas=self.metricas, transporte=self.transporte) if usar_pool else None
+        self.enviador = EnviadorLotes(self.cliente, janela_envio, limite_lote, limite_fila_envio,
+                                      politica=politica_lenta, limite_creditos=limite_creditos,
+                                      diretorio_transbordo=diretorio_transbordo,
+                                      falhas_disjuntor=falhas_disjuntor, desconectar=self.desconectar_destino)
+        self.ultimo_envio = {}  # mapeia (ip, porta) -> momento do último envio, para todas as salas
+        self.agendador = Agendador()
+        self.intervalo_heartbeat = intervalo_heartbeat  # padrão das salas criadas
+        self.num_trabalhadores = trabalhadores
+        self.backlog = backlog
+        self.trabalhadores = None
+        self.ativo = True
+        self.pronto = Event()
+        self.conexoes_recebidas = set()
+        # Tratadores dos quadros sem envelope que são do próprio servidor, não de uma sala
+        self.tratadores = {TIPO_HEARTBEAT: self.tratar_heartbeat, TIPO_STATS: self.tratar_stats}
+        self.metricas.registrar_medidor("salas", lambda: len(self.salas))
+
+    # Inicia o servidor e as rotinas; retorna False se não foi possível ouvir na porta
+    def iniciar(self, timeout=5):
+        self.trabalhadores = PoolTrabalhadores(self.num_trabalhadores)
+        Thread(target=self.inicia_servidor, daemon=True).start()
+        if not self.pronto.wait(timeout) or self.server_socket is None:
+            return False
+        Thread(target=self.rotinas, daemon=True).start()
+        return True
+
+    def inicia_servidor(self):
+        if self.server_socket is None:
+            try:
+                self.server_socket = self.transporte.ouvir(self.ip, self.porta, self.backlog)
+            except OSError as e:
+                self.log.error(f"[ERRO SERVIDOR] Não foi possível ouvir em {self.ip}:{self.porta}: {e}")
+                self.pronto.set()
+                return
+        self.log.info(f"[SERVIDOR] Servidor de salas ouvindo em {self.ip}:{self.porta}")
+        self.pronto.set()
+
+        while self.ativo:
+            try:
+                client_socket, _ = self.server_socket.accept()
+            except OSError:
+                break  # socket fechado por parar()
+            Thread(target=self.tratar_conexao, args=(client_socket,), daemon=True).start()
+
+    # ============================================================
+    # Entra em uma sala (ou cria a sala, se nenhum coordenador for
+    # informado ou se ele não responder) e retorna o PeerSala (ou
+    # a subclasse informada em classe) dela
+    # ============================================================
+    def entrar(self, sala, nome, coordenador=None, classe=PeerSala, **opcoes):
+        if not sala.isprintable() or " " in sala or len(sala.encode('utf-8')) > 255:
+            raise ValueError(f"Nome de sala inválido: {sala!r}")
+        opcoes.setdefault("intervalo_heartbeat", self.intervalo_heartbeat)
+        opcoes.pop("usar_pool", None)
+        peer = classe(self, sala, nome, **opcoes)
+        with self.lock_salas:
+            if sala in self.salas:
+                raise ValueError(f"Já existe a sala {sala} neste servidor.")
+            self.salas[sala] = peer  # antes do JOIN, para receber o que chegar logo depois da resposta
+
+        peer.iniciar_rede(coordenador)
+        if peer.coordenador_atual is None:
+            peer.log.info(f"[SISTEMA] Nenhum coordenador encontrado para a sala {sala}. Criando a sala...")
+            peer.criar_rede()
+        return peer
+
+    def sair(self, sala):
+        with self.lock_salas:
+            peer = self.salas.pop(sala, None)
+        if peer is not None:
+            peer.encerrar(via_exit=True)
+            peer.parar()
+
+    # ==================================================================================
+    # Lê os quadros de uma conexão recebida e entrega cada um à sala indicada no
+    # envelope. Quadros sem envelope são do próprio servidor (ver tratadores) ou de
+    # peers comuns (classe Peer), que conversam com a sala "" (sala padrão)
+    # ==================================================================================
+    def tratar_conexao(self, client_socket):
+        self.conexoes_recebidas.add(client_socket)
+        try:
+            data = b""
+            while len(data) < len(PREAMBULO_QUADROS) and PREAMBULO_QUADROS.startswith(data):
+                parte = client_socket.recv(65536)
+                if not parte:
+                    break
+                data += parte
+            if not data.startswith(PREAMBULO_QUADROS):
+                return  # o servidor de salas não aceita o formato antigo (texto)
+
+            decodificador = DecodificadorQuadros()
+            conn = ConexaoQuadros(client_socket)
+            origem = None
+            self.metricas.incrementar("bytes_recebidos", len(data))
+            data = data[len(PREAMBULO_QUADROS):]
+            while True:
+                for tipo, corpo in expandir_lotes(decodificador.alimentar(data)):
+                    if tipo == TIPO_HELLO:
+                        origem = Peer.endereco_de(corpo)
+                    else:
+                        self.receber(tipo, corpo, conn, origem)
+                data = client_socket.recv(65536)
+                if not data or not self.ativo:
+                    break
+                self.metricas.incrementar("bytes_recebidos", len(data))
+        except Exception as e:
+            if self.ativo:
+                self.log.error(f"[ERRO SERVIDOR] {e}")
+        finally:
+            self.conexoes_recebidas.discard(client_socket)
+            client_socket.close()
+
+    def receber(self, tipo, corpo, conn, origem):
+        if tipo == TIPO_SALA:
+            nome, tipo, corpo = abrir_sala(corpo)
+            sala = self.salas.get(nome)
+        elif tipo in self.tratadores:
+            self.submeter(PRIORIDADE_POR_TIPO.get(tipo, PRIORIDADE_CONTROLE), self.tratadores[tipo], corpo, conn)
+            return
+        else:
+            sala = self.salas.get("")
+        if sala is None:
+            self.metricas.incrementar("descartadas.sem_sala")
+            return
+        if origem is not None:
+            sala.registrar_atividade(origem)
+        self.submeter(PRIORIDADE_POR_TIPO.get(tipo, PRIORIDADE_CHAT), sala.tratar_quadro, tipo, corpo, conn)
+
+    def submeter(self, prioridade, funcao, *args):
+        if not self.trabalhadores.submeter(prioridade, funcao, *args):
+            self.log.error(f"[ERRO SERVIDOR] Fila de {NOMES_PRIORIDADES[prioridade]} cheia; mensagem descartada.")
+
+    # O heartbeat de um host vale para todas as salas em que ele é membro ou coordenador
+    def tratar_heartbeat(self, corpo, conn):
+        ip, porta = corpo.decode('utf-8').split()[:2]
+        endereco = (ip, int(porta))
+        for sala in list(self.salas.values()):
+            if endereco in sala.membros or endereco == sala.coordenador_atual:
+                sala.tratar_quadro(TIPO_HEARTBEAT, corpo, None)
+
+    def tratar_stats(self, corpo, conn):
+        conn.send(json.dumps(self.exportar_metricas()).encode('utf-8'))
+
+    def exportar_metricas(self):
+        return {
+            "servidor": {"endereco": f"{self.ip}:{self.porta}", "instante": relogio.time(), **self.metricas.instantaneo()},
+            "salas": {nome: sala.exportar_metricas() for nome, sala in list(self.salas.items())},
+        }
+
+    # Envia um quadro (já com o envelope da sala, ou um lote deles) a outro host.
+    # Retorna se o envio deu certo (usado pelo disjuntor do EnviadorLotes)
+    def cliente(self, ip, porta, quadro):
+        if self.pool is not None:
+            if self.pool.enviar(ip, porta, quadro):
+                self.ultimo_envio[(ip, porta)] = relogio.time()
+                return True
+            return False
+        try:
+            inicio = relogio.monotonic()
+            s = self.transporte.conectar((ip, porta), 5)
+            try:
+                self.metricas.observar("conexao", (relogio.monotonic() - inicio) * 1000)
+                s.sendall(PREAMBULO_QUADROS + self.saudacao + quadro)
+            finally:
+                s.close()
+            self.metricas.contar_envio(quadro)
+            self.ultimo_envio[(ip, porta)] = relogio.time()
+            return True
+        except OSError:
+            self.metricas.incrementar("conexao.falhas")
+            return False
+
+    def desconectar_destino(self, destino):
+        if self.pool is not None:
+            self.pool.desconectar(destino)
+
+    # ======================================================================================
+    # Rotinas de todas as salas em uma única thread: cada sala é verificada (detector de
+    # falhas) e faz o heartbeat no próprio intervalo. Os destinos de heartbeat de todas as
+    # salas são juntados e cada host recebe um único HEARTBEAT, pulado se ele recebeu
+    # outra mensagem há menos de meio intervalo. No modo ordenado, o coordenador da sala
+    # envia o heartbeat da própria sala, que leva a última seq
+    # ======================================================================================
+    def rotinas(self):
+        while self.ativo:
+            agora = relogio.time()
+            destinos = {}  # mapeia (ip, porta) -> menor intervalo de heartbeat entre as salas
+            proxima = agora + 0.5
+            for sala in list(self.salas.values()):
+                try:
+                    if agora >= sala.proxima_verificacao:
+                        sala.proxima_verificacao = agora + sala.intervalo_verificacao
+                        sala.verificar()
+                    if agora >= sala.proximo_heartbeat:
+                        sala.proximo_heartbeat = agora + sala.intervalo_heartbeat
+                        if sala.coordenador and sala.disseminacao == "ordenada":
+                            sala.rodada_heartbeat()
+                        else:
+                            for destino in sala.destinos_heartbeat():
+                                destinos[destino] = min(destinos.get(destino, sala.intervalo_heartbeat), sala.intervalo_heartbeat)
+                except Exception as e:
+                    sala.log.error(f"[ERRO] Rotina da sala falhou: {e}")
+                proxima = min(proxima, sala.proxima_verificacao, sala.proximo_heartbeat)
+
+            heartbeat = codificar_quadro(TIPO_HEARTBEAT, f"{self.ip} {self.porta}")
+            for destino, intervalo in destinos.items():
+                if self.ultimo_envio.get(destino, 0) <= agora - intervalo / 2:
+                    self.enviador.enfileirar(destino, heartbeat)
+            time.sleep(max(proxima - relogio.time(), 0.01))
+
+    # Para o servidor e todas as salas sem avisar ninguém, como em uma queda
+    def parar(self):
+        self.ativo = False
+        for sala in list(self.salas.values()):
+            sala.parar()
+        if self.server_socket is not None:
+            self.server_socket.close()
+        for conexao in list(self.conexoes_recebidas):
+            try:
+                conexao.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.pool is not None:
+            self.pool.fechar()
+        self.enviador.fechar()
+        self.agendador.parar()
+
+    # Sai de todas as salas (avisando os outros peers) e para o servidor
+    def encerrar(self):
+        for sala in list(self.salas):
+            self.sair(sala)
+        self.parar()
+
+# ============================================================
+# Uso interativo: um processo, uma porta e várias salas
+# Uso: python salas.py <nome> <porta>
+# ============================================================
+AJUDA = (
+    "[SISTEMA] Comandos: '/entrar <sala> [porta_do_coordenador]', '/sair <sala>', '/sala <sala>' "
+    "(escolhe a sala das próximas mensagens), 'SALAS', 'LIST' e 'EXIT'."
+)
+
+def main():
+    if len(sys.argv) != 3 or not sys.argv[2].isdigit():
+        print("Uso: python salas.py <nome> <porta>")
+        sys.exit(1)
+    nome, porta = sys.argv[1], int(sys.argv[2])
+    if not porta_valida(porta):
+        sys.exit(1)
+    servidor = ServidorSalas("localhost", porta)
+    if not servidor.iniciar():
+        sys.exit(1)
+    print(AJUDA)
+
+    atual = None
+    while True:
+        try:
+            entrada = input().strip()
+        except (EOFError, KeyboardInterrupt):
+            break
+        partes = entrada.split()
+        if not partes:
+            continue
+        try:
+            if entrada == "EXIT":
+                break
+            elif partes[0] == "/entrar" and len(partes) in (2, 3):
+                coordenador = ("localhost", int(partes[2])) if len(partes) == 3 else None
+                servidor.entrar(partes[1], nome, coordenador)
+                atual = partes[1]
+            elif partes[0] == "/sair" and len(partes) == 2:
+                servidor.sair(partes[1])
+                if atual == partes[1]:
+                    atual = None
+            elif partes[0] == "/sala" and len(partes) == 2 and partes[1] in servidor.salas:
+                atual = partes[1]
+            elif entrada == "SALAS":
+                for sala, peer in servidor.salas.items():
+                    marcador = "*" if sala == atual else " "
+                    print(f"{marcador} {sala}: {len(peer.membros)} membros, coordenador {peer.coordenador_atual}")
+            elif entrada == "LIST" and atual is not None:
+                for membro in servidor.salas[atual].membros:
+                    print(f"{membro.nome or 'Desconhecido'} [{membro.id}] -> {membro.endereco}")
+            elif entrada.startswith("/") or atual is None:
+                print(AJUDA)
+            else:
+                servidor.salas[atual].enviar_mensagem(entrada)
+        except ValueError as e:
+            print(f"[ERRO] {e}")
+    servidor.encerrar()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,501 @@
+import argparse
+import asyncio
+import json
+import math
+import random
+import selectors
+import time
+from collections import deque
+from collections.abc import Mapping
+from types import SimpleNamespace
+
+from peer import configurar_log, relogio
+from peer_async import AsyncPeer
+
+# =======================================================================
+# Seletor de um loop que roda em tempo virtual: não há sockets de verdade
+# para esperar, então esperar timeout segundos é só avançar o relógio
+# até o próximo evento agendado. Sem nada agendado, a simulação parou
+# =======================================================================
+class SeletorVirtual(selectors.BaseSelector):
+    def __init__(self, inicio):
+        self.agora = inicio  # instante virtual (segundos)
+        self.chaves = {}  # mapeia descritor -> SelectorKey (só o par de sockets interno do loop)
+
+    def register(self, fileobj, events, data=None):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        chave = self.chaves[fd] = selectors.SelectorKey(fileobj, fd, events, data)
+        return chave
+
+    def unregister(self, fileobj):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        return self.chaves.pop(fd)
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise RuntimeError("Simulação parada: nenhum evento agendado.")
+        self.agora += timeout
+        return []
+
+    def get_map(self):
+        return MapaChaves(self.chaves)
+
+class MapaChaves(Mapping):
+    def __init__(self, chaves):
+        self.chaves = chaves
+
+    def __getitem__(self, fileobj):
+        return self.chaves[fileobj if isinstance(fileobj, int) else fileobj.fileno()]
+
+    def __iter__(self):
+        return iter(self.chaves)
+
+    def __len__(self):
+        return len(self.chaves)
+
+# =======================================================================
+# Event loop em tempo virtual: loop.time() é o relógio da simulação, e o
+# loop pula direto para o próximo evento em vez de dormir. Tudo roda em
+# uma única thread, então ninguém precisa ser acordado por outra thread
+# =======================================================================
+class LoopVirtual(asyncio.SelectorEventLoop):
+    def __init__(self, inicio=1_700_000_000.0):
+        super().__init__(SeletorVirtual(inicio))
+        # Perto de 1,7e9 s, um float só distingue instantes a ~0,24 µs; eventos mais próximos
+        # que isso do instante atual já contam como vencidos (senão o loop não sai do lugar)
+        self._clock_resolution = 1e-6
+
+    def time(self):
+        return self._selector.agora
+
+    def _write_to_self(self):
+        pass
+
+# =======================================================================
+# Distribuições de latência (em segundos). Cada uma devolve uma função
+# que sorteia um atraso com o gerador de números aleatórios da rede
+# =======================================================================
+def fixa(atraso):
+    return lambda aleatorio: atraso
+
+def uniforme(minimo, maximo):
+    return lambda aleatorio: aleatorio.uniform(minimo, maximo)
+
+def normal(media, desvio):
+    return lambda aleatorio: max(0.0, aleatorio.gauss(media, desvio))
+
+# Mediana e dispersão (sigma do logaritmo): a maior parte perto da mediana, com cauda longa
+def lognormal(mediana, sigma):
+    return lambda aleatorio: aleatorio.lognormvariate(math.log(mediana), sigma)
+
+DISTRIBUICOES = {
+    "fixa": lambda media, jitter: fixa(media),
+    "uniforme": lambda media, jitter: uniforme(max(0.0, media - jitter), media + jitter),
+    "normal": lambda media, jitter: normal(media, jitter),
+    "lognormal": lambda media, jitter: lognormal(media, jitter / media if media else 0.0),
+}
+
+# =======================================================================
+# Lado que escreve de uma conexão simulada (mesma interface usada pelo
+# AsyncPeer em um StreamWriter). Os dados chegam ao StreamReader do outro
+# lado na ordem em que foram escritos, depois da latência do enlace
+# =======================================================================
+class EscritorSimulado:
+    def __init__(self, rede, origem, destino, leitor_remoto):
+        self.rede = rede
+        self.origem = origem
+        self.destino = destino
+        self.leitor_remoto = leitor_remoto  # StreamReader do outro lado
+        self.ultima_chegada = 0.0  # nada chega antes do que foi escrito antes (ordem do TCP)
+        self.em_transito = deque()  # segmentos (None = FIN) na ordem em que foram escritos
+        self.fechado = False
+        self.quebrado = False  # a conexão caiu (partição ou queda de um dos lados)
+
+    def write(self, dados):
+        if dados and not self.fechado and not self.quebrado:
+            self.rede.transmitir(self, bytes(dados))
+
+    async def drain(self):
+        if self.quebrado:
+            raise ConnectionResetError("Conexão perdida (simulação).")
+        espera = self.rede.fila_envio(self.origem)
+        if espera > 0:
+            await asyncio.sleep(espera)
+
+    def close(self):
+        if not self.fechado:
+            self.fechado = True
+            if not self.quebrado:
+                self.rede.transmitir(self, None)  # FIN: o outro lado lê o fim da conexão
+
+    def is_closing(self):
+        return self.fechado or self.quebrado
+
+    async def wait_closed(self):
+        pass
+
+# =======================================================================
+# Transporte de um peer na rede simulada (ver TransporteTCP em peer.py).
+# Só a interface assíncrona: o tempo virtual precisa de um único event
+# loop, então a simulação usa o AsyncPeer
+# =======================================================================
+class TransporteSimulado:
+    def __init__(self, rede, endereco):
+        self.rede = rede
+        self.endereco = endereco
+
+    def ouvir(self, ip, porta, backlog=128):
+        raise OSError("A rede simulada só atende o AsyncPeer (ouvir_async).")
+
+    def conectar(self, endereco, timeout=5):
+        raise OSError("A rede simulada só atende o AsyncPeer (conectar_async).")
+
+    async def ouvir_async(self, tratar, ip, porta, backlog=128, sock=None):
+        return self.rede.ouvir((ip, porta), tratar)
+
+    async def conectar_async(self, endereco):
+        return await self.rede.conectar(self.endereco, endereco)
+
+class ServidorSimulado:
+    def __init__(self, rede, endereco):
+        self.rede = rede
+        self.endereco = endereco
+
+    def close(self):
+        self.rede.ouvintes.pop(self.endereco, None)
+
+    async def wait_closed(self):
+        pass
+
+# =======================================================================
+# Rede simulada: conexões em memória entre os peers, com latência (valor
+# fixo ou distribuição), perda, banda e partições. Como o protocolo usa
+# TCP, um segmento perdido não some: ele chega depois de uma ou mais
+# retransmissões (rto segundos, dobrando a cada perda seguida). Com banda
+# (bytes/s), cada host envia um segmento por vez, e drain() segura quem
+# envia quando há mais de buffer bytes esperando. Cada write() é um
+# segmento. Com uma partição, os segmentos entre grupos diferentes são
+# perdidos, as conexões entre eles caem e as novas não completam
+# =======================================================================
+class RedeSimulada:
+    def __init__(self, loop, latencia=0.001, perda=0.0, banda=None, buffer=256 * 1024, rto=0.2,
+                 timeout_conexao=5.0, semente=0):
+        self.loop = loop
+        self.latencia = latencia  # segundos ou função(aleatorio) -> segundos (ver fixa, normal...)
+        self.perda = perda  # chance de um segmento ser perdido (e retransmitido)
+        self.banda = banda  # bytes/s de cada host; None = sem limite
+        self.buffer = buffer
+        self.rto = rto
+        self.timeout_conexao = timeout_conexao  # tempo até desistir de conectar a um host inalcançável
+        self.aleatorio = random.Random(semente)
+        self.ouvintes = {}  # mapeia endereço -> tratar(reader, writer)
+        self.enlaces = {}  # mapeia frozenset({a, b}) -> {"latencia": ..., "perda": ...} (enlaces diferentes)
+        self.grupos = {}  # mapeia endereço -> grupo da partição (ausente = grupo 0)
+        self.fora = set()  # hosts derrubados
+        self.uplink = {}  # mapeia endereço -> instante em que o host termina de enviar o que já tem
+        self.tarefas = set()
+        self.contadores = {"conexoes": 0, "segmentos": 0, "bytes": 0, "retransmissoes": 0, "perdidos": 0}
+
+    def transporte(self, endereco):
+        return TransporteSimulado(self, endereco)
+
+    # Latência e perda diferentes entre dois hosts (ex.: outro datacenter)
+    def definir_enlace(self, a, b, latencia=None, perda=None):
+        self.enlaces[frozenset((a, b))] = {"latencia": latencia, "perda": perda}
+
+    # Cada grupo é uma lista de endereços; quem não está em nenhum fica no grupo 0
+    def particionar(self, *grupos):
+        self.grupos = {endereco: i + 1 for i, grupo in enumerate(grupos) for endereco in grupo}
+
+    def curar(self):
+        self.grupos = {}
+
+    def derrubar(self, endereco):
+        self.fora.add(endereco)
+        self.ouvintes.pop(endereco, None)
+
+    def alcanca(self, a, b):
+        return a not in self.fora and b not in self.fora and self.grupos.get(a, 0) == self.grupos.get(b, 0)
+
+    # Instante em que um segmento de tamanho bytes enviado agora de origem chega ao destino
+    def chegada(self, origem, destino, tamanho):
+        enlace = self.enlaces.get(frozenset((origem, destino)), {})
+        latencia = enlace.get("latencia")
+        if latencia is None:
+            latencia = self.latencia
+        perda = enlace.get("perda")
+        if perda is None:
+            perda = self.perda
+
+        envio = self.loop.time()
+        if self.banda:
+            envio = max(envio, self.uplink.get(origem, 0.0)) + tamanho / self.banda
+            self.uplink[origem] = envio
+        atraso = latencia(self.aleatorio) if callable(latencia) else latencia
+        rto = self.rto
+        while perda and self.aleatorio.random() < perda:
+            atraso += rto
+            rto *= 2
+            self.contadores["retransmissoes"] += 1
+        return envio + atraso
+
+    # Quanto tempo quem envia de origem espera em drain() (o que passa de buffer bytes)
+    def fila_envio(self, origem):
+        if not self.banda:
+            return 0.0
+        return self.uplink.get(origem, 0.0) - self.loop.time() - self.buffer / self.banda
+
+    def transmitir(self, escritor, dados):
+        if not self.alcanca(escritor.origem, escritor.destino):
+            escritor.quebrado = True
+            self.contadores["perdidos"] += 1
+            return
+        chegada = max(self.chegada(escritor.origem, escritor.destino, len(dados) if dados else 0), escritor.ultima_chegada)
+        escritor.ultima_chegada = chegada
+        escritor.em_transito.append(dados)
+        self.loop.call_at(chegada, self.entregar, escritor)
+
+    # Entrega sempre o segmento mais antigo da conexão: eventos agendados para o mesmo
+    # instante não saem do loop necessariamente na ordem em que foram agendados
+    def entregar(self, escritor):
+        dados = escritor.em_transito.popleft()
+        # O destino pode ter caído (ou ficado do outro lado de uma partição) no caminho
+        if not self.alcanca(escritor.origem, escritor.destino):
+            escritor.quebrado = True
+            self.contadores["perdidos"] += 1
+            return
+        leitor = escritor.leitor_remoto
+        if leitor.at_eof():
+            return
+        if dados is None:
+            leitor.feed_eof()
+        else:
+            self.contadores["segmentos"] += 1
+            self.contadores["bytes"] += len(dados)
+            leitor.feed_data(dados)
+
+    def ouvir(self, endereco, tratar):
+        if endereco in self.ouvintes:
+            raise OSError(f"Endereço em uso na simulação: {endereco[0]}:{endereco[1]}")
+        self.fora.discard(endereco)
+        self.ouvintes[endereco] = tratar
+        return ServidorSimulado(self, endereco)
+
+    # Abre uma conexão: meia volta até o destino (SYN) e meia volta de volta (SYN-ACK)
+    async def conectar(self, origem, destino):
+        self.contadores["conexoes"] += 1
+        if not self.alcanca(origem, destino):
+            await asyncio.sleep(self.timeout_conexao)
+            raise TimeoutError(f"{destino[0]}:{destino[1]} inalcançável (simulação)")
+        await asyncio.sleep(self.chegada(origem, destino, 0) - self.loop.time())
+        tratar = self.ouvintes.get(destino)
+        if tratar is None or not self.alcanca(origem, destino):
+            await asyncio.sleep(self.chegada(destino, origem, 0) - self.loop.time())
+            raise ConnectionRefusedError(f"Ninguém ouvindo em {destino[0]}:{destino[1]} (simulação)")
+
+        leitor_cliente = asyncio.StreamReader()
+        leitor_servidor = asyncio.StreamReader()
+        escritor_cliente = EscritorSimulado(self, origem, destino, leitor_servidor)
+        escritor_servidor = EscritorSimulado(self, destino, origem, leitor_cliente)
+        tarefa = self.loop.create_task(tratar(leitor_servidor, escritor_servidor))
+        self.tarefas.add(tarefa)
+        tarefa.add_done_callback(self.tarefas.discard)
+        await asyncio.sleep(self.chegada(destino, origem, 0) - self.loop.time())
+        return leitor_cliente, escritor_cliente
+
+# =======================================================================
+# Simulação: o loop virtual, a rede e os peers (AsyncPeer). Enquanto ela
+# existe, o relógio do protocolo (relogio em peer.py) é o relógio virtual
+# =======================================================================
+class Simulacao:
+    def __init__(self, semente=0, **opcoes_rede):
+        random.seed(semente)  # o sorteio do gossip e o jitter dos peers também ficam determinísticos
+        self.loop = LoopVirtual()
+        self.inicio = self.loop.time()
+        asyncio.set_event_loop(self.loop)
+        relogio.usar(SimpleNamespace(time=self.loop.time, monotonic=self.loop.time))
+        self.rede = RedeSimulada(self.loop, semente=semente, **opcoes_rede)
+        self.peers = []
+
+    @property
+    def agora(self):
+        return self.loop.time()
+
+    # Cria um peer em um host próprio (10.x.y.z, porta 5000) e agenda a entrada dele
+    # na rede do coordenador informado (ou a criação de uma rede nova)
+    def criar_peer(self, nome, coordenador=None, classe=AsyncPeer, **opcoes):
+        n = len(self.peers) + 1
+        endereco = (f"10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}", 5000)
+        p = classe(nome, endereco[0], endereco[1], transporte=self.rede.transporte(endereco), **opcoes)
+        self.peers.append(p)
+        tarefa = self.loop.create_task(p.iniciar_async(coordenador))
+        self.rede.tarefas.add(tarefa)
+        tarefa.add_done_callback(self.rede.tarefas.discard)
+        return p
+
+    # Queda sem aviso: o host some da rede e as rotinas do peer param
+    def derrubar(self, p):
+        self.rede.derrubar(p.endereco)
+        p.parar()
+
+    def executar(self, duracao):
+        self.loop.run_until_complete(asyncio.sleep(duracao))
+
+    # Avança até condicao() ser verdadeira (verificada a cada passo segundos virtuais) ou
+    # até limite segundos. Retorna o tempo virtual decorrido, ou None se não aconteceu
+    def ate(self, condicao, limite, passo=0.01):
+        inicio = self.agora
+        while not condicao():
+            if self.agora - inicio >= limite:
+                return None
+            self.executar(passo)
+        return self.agora - inicio
+
+    def fechar(self):
+        for p in self.peers:
+            p.parar()
+        pendentes = asyncio.all_tasks(self.loop)
+        for tarefa in pendentes:
+            tarefa.cancel()
+        self.loop.run_until_complete(asyncio.gather(*pendentes, return_exceptions=True))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        relogio.usar(time)
+
+# ============================================================
+# Cenários: cada um monta uma sala simulada e devolve as medidas
+# (tempos virtuais em ms) e o tempo real que a simulação levou
+# ============================================================
+def montar_sala(args, sim):
+    opcoes = {
+        "intervalo_heartbeat": args.heartbeat,
+        "limiar_phi": args.limiar_phi,
+        "timeout_eleicao": args.timeout_eleicao,
+        "disseminacao": args.disseminacao,
+    }
+    coordenador = sim.criar_peer("peer0", **opcoes)
+    sim.executar(0.01)
+    # As entradas se espalham por janela_entrada segundos, como peers que ligam quase juntos
+    inicio = sim.agora
+    instantes = sorted(sim.rede.aleatorio.uniform(0, args.janela_entrada) for _ in range(args.peers - 1))
+    for i, instante in enumerate(instantes, 1):
+        sim.executar(max(0.0, inicio + instante - sim.agora))
+        sim.criar_peer(f"peer{i}", coordenador.endereco, **opcoes)
+    convergencia = sim.ate(lambda: all(len(p.membros) == args.peers for p in sim.peers), args.limite)
+    return inicio, convergencia
+
+def cenario_entrada(args, sim):
+    inicio, convergencia = montar_sala(args, sim)
+    return {
+        "convergiu": convergencia is not None,
+        "convergencia_ms": (sim.agora - inicio) * 1000 if convergencia is not None else None,
+        "membros_min": min(len(p.membros) for p in sim.peers),
+    }
+
+# O coordenador cai sem aviso; mede a detecção e o acordo sobre o novo coordenador
+def cenario_failover(args, sim):
+    _, convergencia = montar_sala(args, sim)
+    if convergencia is None:
+        return {"sala_formada": False, "concluido": False}
+    sim.executar(args.heartbeat * 3)  # o detector de falhas aprende os intervalos de heartbeat
+    antigo = sim.peers[0]
+    restantes = sim.peers[1:]
+    inicio = sim.agora
+    sim.derrubar(antigo)
+
+    def acordo():
+        atuais = {p.coordenador_atual for p in restantes}
+        if len(atuais) != 1:
+            return False
+        novo = atuais.pop()
+        return novo != antigo.endereco and any(p.coordenador and p.endereco == novo for p in restantes)
+
+    failover = sim.ate(acordo, args.limite)
+    deteccoes = [p.inicio_eleicao for p in restantes if p.inicio_eleicao]
+    return {
+        "sala_formada": True,
+        "concluido": failover is not None,
+        "deteccao_ms": (min(deteccoes) - inicio) * 1000 if deteccoes else None,
+        "failover_ms": failover * 1000 if failover is not None else None,
+        "eleicoes": sum(1 for p in restantes if p.inicio_eleicao),
+        "limite_eleicao_ms": restantes[0].tempo_max_eleicao() * 1000,
+    }
+
+# Uma fração dos peers (sem o coordenador) fica isolada por duracao_particao segundos;
+# mede quantos coordenadores passam a existir e se a sala volta a ter um só depois
+def cenario_particao(args, sim):
+    _, convergencia = montar_sala(args, sim)
+    if convergencia is None:
+        return {"sala_formada": False, "convergiu": False}
+    sim.executar(args.heartbeat * 3)
+    isolados = sim.peers[len(sim.peers) - max(1, int(len(sim.peers) * args.fracao_particao)):]
+    sim.rede.particionar([p.endereco for p in isolados])
+    sim.executar(args.duracao_particao)
+    durante = len({p.coordenador_atual for p in sim.peers})
+    sim.rede.curar()
+    reconvergencia = sim.ate(
+        lambda: len({p.coordenador_atual for p in sim.peers}) == 1 and all(len(p.membros) == args.peers for p in sim.peers),
+        args.limite,
+    )
+    return {
+        "sala_formada": True,
+        "convergiu": reconvergencia is not None,
+        "isolados": len(isolados),
+        "coordenadores_durante": durante,
+        "coordenadores_depois": len({p.coordenador_atual for p in sim.peers}),
+        "reconvergencia_ms": reconvergencia * 1000 if reconvergencia is not None else None,
+        "membros_min_depois": min(len(p.membros) for p in sim.peers),
+    }
+
+CENARIOS = {
+    "entrada": cenario_entrada,
+    "failover": cenario_failover,
+    "particao": cenario_particao,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Simula salas do chat (AsyncPeer) em uma rede em memória, em tempo virtual, com resultado em JSON.")
+    parser.add_argument("--cenarios", default="entrada,failover", help="cenários separados por vírgula: " + ", ".join(CENARIOS))
+    parser.add_argument("--peers", type=int, default=100, help="tamanho da sala")
+    parser.add_argument("--latencia", type=float, default=5.0, help="latência média de um sentido (ms)")
+    parser.add_argument("--jitter", type=float, default=1.0, help="variação da latência (ms; desvio, ou meia largura na uniforme)")
+    parser.add_argument("--distribuicao", default="normal", choices=list(DISTRIBUICOES))
+    parser.add_argument("--perda", type=float, default=0.0, help="chance de perda de cada segmento (retransmitido depois do RTO)")
+    parser.add_argument("--banda", type=float, default=0, help="banda de saída de cada host (bytes/s); 0 = sem limite")
+    parser.add_argument("--heartbeat", type=float, default=1.0, help="intervalo de heartbeat (s)")
+    parser.add_argument("--limiar-phi", type=float, default=8.0)
+    parser.add_argument("--timeout-eleicao", type=float, default=1.0)
+    parser.add_argument("--disseminacao", default="direta", choices=["direta", "arvore", "gossip"])
+    parser.add_argument("--janela-entrada", type=float, default=1.0, help="segundos virtuais em que as entradas se espalham")
+    parser.add_argument("--fracao-particao", type=float, default=0.3, help="fração dos peers isolada no cenário particao")
+    parser.add_argument("--duracao-particao", type=float, default=10.0, help="segundos virtuais de partição")
+    parser.add_argument("--limite", type=float, default=120.0, help="tempo virtual máximo (s) de espera em cada etapa")
+    parser.add_argument("--semente", type=int, default=0)
+    parser.add_argument("--log", default="WARNING", help="nível do log dos peers")
+    parser.add_argument("--saida", help="arquivo onde salvar o JSON (padrão: saída padrão)")
+    args = parser.parse_args()
+    configurar_log(args.log)
+
+    latencia = DISTRIBUICOES[args.distribuicao](args.latencia / 1000, args.jitter / 1000)
+    resultado = {"simulacao": "peer_async", "versao": 1, "parametros": vars(args), "resultados": {}}
+    for nome in args.cenarios.split(","):
+        inicio = time.perf_counter()
+        sim = Simulacao(semente=args.semente, latencia=latencia, perda=args.perda, banda=args.banda or None)
+        try:
+            medidas = CENARIOS[nome](args, sim)
+            medidas["tempo_virtual_s"] = sim.agora - sim.inicio
+            medidas["tempo_real_s"] = time.perf_counter() - inicio
+            medidas["rede"] = dict(sim.rede.contadores)
+        finally:
+            sim.fechar()
+        resultado["resultados"][nome] = medidas
+
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as arquivo:
+            arquivo.write(texto + "\n")
+    else:
+        print(texto)
+
+if __name__ == "__main__":
+    main()